@@ -0,0 +1,83 @@
+import os
+import time
+from dotenv import load_dotenv
+from fastapi import Depends, HTTPException
+from app.dependencies import get_db
+from app.metrics import cache_counters
+from app.security import Principal, get_principal
+
+load_dotenv()
+
+# How long an owner's guild set is trusted before it goes back to the DB
+OWNER_INDEX_TTL = float(os.getenv('OWNER_INDEX_TTL', '300'))
+
+cache_hit, cache_miss = cache_counters("guild_access")
+
+# owner_id -> guild ids the owner may manage
+_index: dict[str, set[str]] = {}
+# guild_id -> owner_id, so revocations don't have to scan every owner
+_owners: dict[str, str] = {}
+_loaded_at: dict[str, float] = {}
+
+async def warm():
+  db = await get_db()
+  guilds = await db.guild.find_many(where={"moderate": True})
+  await db.disconnect()
+
+  now = time.monotonic()
+  _index.clear()
+  _owners.clear()
+  _loaded_at.clear()
+  for guild in guilds:
+    if guild.owner_id is None:
+      continue
+    _index.setdefault(guild.owner_id, set()).add(guild.guild_id)
+    _owners[guild.guild_id] = guild.owner_id
+    _loaded_at[guild.owner_id] = now
+
+async def _load_owner(owner_id: str) -> set[str]:
+  db = await get_db()
+  guilds = await db.guild.find_many(where={"owner_id": owner_id, "moderate": True})
+  await db.disconnect()
+
+  guild_ids = {guild.guild_id for guild in guilds}
+  for guild_id in _index.get(owner_id, ()):
+    if guild_id not in guild_ids and _owners.get(guild_id) == owner_id:
+      del _owners[guild_id]
+  for guild_id in guild_ids:
+    _owners[guild_id] = owner_id
+
+  _index[owner_id] = guild_ids
+  _loaded_at[owner_id] = time.monotonic()
+  return guild_ids
+
+def grant(owner_id: str, guild_id: str):
+  previous = _owners.get(guild_id)
+  if previous is not None and previous != owner_id:
+    _index.get(previous, set()).discard(guild_id)
+  _index.setdefault(owner_id, set()).add(guild_id)
+  _owners[guild_id] = owner_id
+
+def revoke(guild_id: str):
+  owner_id = _owners.pop(guild_id, None)
+  if owner_id is not None:
+    _index.get(owner_id, set()).discard(guild_id)
+
+def invalidate():
+  _loaded_at.clear()
+
+async def has_access(owner_id: str, guild_id: str) -> bool:
+  # Hits and misses are only trusted while the owner's entry is fresh, grants and
+  # revocations on other workers reach us when it's next reloaded
+  loaded_at = _loaded_at.get(owner_id)
+  if loaded_at is not None and time.monotonic() - loaded_at < OWNER_INDEX_TTL:
+    cache_hit.inc()
+    return guild_id in _index.get(owner_id, ())
+
+  cache_miss.inc()
+  return guild_id in await _load_owner(owner_id)
+
+async def require_guild_access(guild_id: str, principal: Principal = Depends(get_principal)) -> Principal:
+  if not await has_access(principal.user_id, guild_id):
+    raise HTTPException(status_code=401, detail="Unauthorised to access this guild")
+  return principal
@@ -0,0 +1,191 @@
+import argparse
+import json
+import os
+import random
+import time
+from types import SimpleNamespace
+import numpy as np
+from dotenv import load_dotenv
+from app.bench.stats import git_commit
+from app.metrics import latency_summary
+from app.bench.synthetic import LABELS, build_model
+
+# Trains and calibrates the first-stage cascade classifier on labelled JSONL
+# ({"text": ..., "label": "OK"} per line, label optional with --teacher):
+#   python -m app.bench.cascade train --data messages.jsonl --output cascade.npz --teacher
+#   python -m app.bench.cascade calibrate --data holdout.jsonl --weights cascade.npz
+# Both score with MODEL_PATH / TOKENIZER_PATH unless --synthetic is given.
+
+def _floats(value: str) -> list[float]:
+  return [float(part) for part in value.split(",") if part]
+
+def load_rows(path: str) -> list[dict]:
+  with open(path) as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+def teacher_scores(texts: list[str], batch_size: int) -> tuple[list[dict[str, float]], list[float]]:
+  # Transformer probabilities for every text, plus the time each batch took per message
+  from transformers import AutoModelForSequenceClassification, AutoTokenizer
+  from app.inference import predict
+
+  model = AutoModelForSequenceClassification.from_pretrained(os.getenv("MODEL_PATH")).eval()
+  tokenizer = AutoTokenizer.from_pretrained(os.getenv("TOKENIZER_PATH"))
+
+  scores = []
+  timings = []
+  for start in range(0, len(texts), batch_size):
+    batch = texts[start:start + batch_size]
+    started = time.perf_counter()
+    results = predict(batch, model, tokenizer)
+    timings.extend([(time.perf_counter() - started) / len(batch)] * len(batch))
+    scores.extend(dict(label_prob_pairs) for label_prob_pairs in results)
+  return scores, timings
+
+def train(args):
+  from app.cascade import HashedLinearModel, features
+
+  rows = load_rows(args.data)
+  texts = [row["text"] for row in rows]
+
+  if args.teacher:
+    # Distilling the transformer keeps stage one agreeing with what it would have said
+    scores, _ = teacher_scores(texts, args.batch_size)
+    labels = list(scores[0])
+    targets = np.array([[score[label] for label in labels] for score in scores], dtype=np.float32)
+  else:
+    labels = sorted({row["label"] for row in rows} | set(LABELS), key=lambda label: (label != "OK", label))
+    targets = np.zeros((len(rows), len(labels)), dtype=np.float32)
+    for i, row in enumerate(rows):
+      targets[i, labels.index(row["label"])] = 1.0
+
+  model = HashedLinearModel.create(labels, args.features)
+  samples = [features(text, model.n_features) for text in texts]
+  order = list(range(len(samples)))
+  rng = random.Random(args.seed)
+
+  for epoch in range(args.epochs):
+    rng.shuffle(order)
+    lr = args.lr / (1 + epoch)
+    loss = 0.0
+    for i in order:
+      indices, values = samples[i]
+      weights = model.weights[indices]
+      logits = values @ weights + model.bias
+      logits -= logits.max()
+      probabilities = np.exp(logits)
+      probabilities /= probabilities.sum()
+      loss -= float(targets[i] @ np.log(probabilities + 1e-12))
+
+      gradient = probabilities - targets[i]
+      model.weights[indices] = weights - lr * (np.outer(values, gradient) + args.l2 * weights)
+      model.bias -= lr * gradient
+    print(json.dumps({"epoch": epoch + 1, "loss": loss / len(samples)}))
+
+  model.save(args.output)
+  print(json.dumps({"saved": args.output, "labels": labels, "features": model.n_features, "samples": len(samples)}))
+
+def calibrate(args):
+  from app.cascade import HashedLinearModel, confidently_ok, eligible
+  from app.inference import harmful_probability
+
+  rows = load_rows(args.data)
+  texts = [row["text"] for row in rows]
+  model = HashedLinearModel.load(args.weights)
+  # Every label enabled, the strictest setting a guild can pick
+  settings = SimpleNamespace(confidence_limit=args.confidence_limit, **{"enable_" + label.lower(): True for label in model.labels})
+
+  stage_one = []
+  stage_one_times = []
+  for text in texts:
+    started = time.perf_counter()
+    stage_one.append(model.predict(text))
+    stage_one_times.append(time.perf_counter() - started)
+
+  scores, transformer_times = teacher_scores(texts, args.batch_size)
+  flagged = [harmful_probability(list(score.items()), settings) >= args.confidence_limit / 100 for score in scores]
+  harmful = [row.get("label", "OK") != "OK" for row in rows] if all("label" in row for row in rows) else None
+  stage_one_mean = float(np.mean(stage_one_times))
+  transformer_mean = float(np.mean(transformer_times))
+
+  results = []
+  for threshold in args.thresholds:
+    for margin in args.margins:
+      cleared = [
+        eligible(text) and confidently_ok(label_prob_pairs, settings, threshold, margin)
+        for text, label_prob_pairs in zip(texts, stage_one)
+      ]
+      cleared_fraction = sum(cleared) / len(cleared)
+      missed = sum(1 for c, f in zip(cleared, flagged) if c and f)
+      result = {
+        "threshold": threshold,
+        "margin": margin,
+        "cleared_fraction": cleared_fraction,
+        # Messages the transformer would have moderated that stage one let through
+        "transformer_recall": 1 - missed / sum(flagged) if any(flagged) else 1.0,
+        "estimated_speedup": transformer_mean / (stage_one_mean + (1 - cleared_fraction) * transformer_mean)
+      }
+      if harmful is not None:
+        caught = sum(1 for c, f, h in zip(cleared, flagged, harmful) if h and f and not c)
+        result["label_recall"] = caught / sum(harmful) if any(harmful) else 1.0
+      results.append(result)
+
+  report = {
+    "benchmark": "cascade",
+    "commit": git_commit(),
+    "samples": len(rows),
+    "confidence_limit": args.confidence_limit,
+    "stage_one": latency_summary(stage_one_times),
+    "transformer": latency_summary(transformer_times),
+    "transformer_flagged": sum(flagged),
+    "results": results
+  }
+
+  output = json.dumps(report, indent=2)
+  print(output)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output + "\n")
+
+def main():
+  load_dotenv()
+
+  parser = argparse.ArgumentParser(description="Train and calibrate the first-stage cascade classifier")
+  parser.add_argument("--synthetic", action="store_true", help="score with a tiny random model instead of MODEL_PATH")
+  parser.add_argument("--batch-size", type=int, default=32)
+  parser.add_argument("--seed", type=int, default=0)
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  train_parser = commands.add_parser("train")
+  train_parser.add_argument("--data", required=True)
+  train_parser.add_argument("--output", required=True)
+  train_parser.add_argument("--teacher", action="store_true", help="fit the transformer's probabilities instead of the labels")
+  train_parser.add_argument("--features", type=int, default=1 << 16, help="hash buckets, a power of two")
+  train_parser.add_argument("--epochs", type=int, default=5)
+  train_parser.add_argument("--lr", type=float, default=0.5)
+  train_parser.add_argument("--l2", type=float, default=1e-6)
+
+  calibrate_parser = commands.add_parser("calibrate")
+  calibrate_parser.add_argument("--data", required=True)
+  calibrate_parser.add_argument("--weights", required=True)
+  calibrate_parser.add_argument("--confidence-limit", type=float, default=50)
+  calibrate_parser.add_argument("--thresholds", type=_floats, default=[0.9, 0.95, 0.98, 0.99])
+  calibrate_parser.add_argument("--margins", type=_floats, default=[0.25, 0.5, 0.75])
+  calibrate_parser.add_argument("--output", help="also write the JSON report to this file")
+
+  args = parser.parse_args()
+
+  if args.command == "train" and args.features & (args.features - 1):
+    parser.error("--features must be a power of two")
+
+  if args.synthetic:
+    os.environ["MODEL_PATH"] = os.environ["TOKENIZER_PATH"] = build_model(seed=args.seed)
+  elif not os.getenv("MODEL_PATH") or not os.getenv("TOKENIZER_PATH"):
+    parser.error("MODEL_PATH and TOKENIZER_PATH must be set, or pass --synthetic")
+
+  if args.command == "train":
+    train(args)
+  else:
+    calibrate(args)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,136 @@
+import argparse
+import copy
+import json
+import os
+import random
+import time
+import torch
+from dotenv import load_dotenv
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from app.bench.stats import git_commit, peak_rss_mb, rss_mb
+from app.metrics import latency_summary
+from app.bench.synthetic import WORDS, build_model
+
+# Sweeps batch size, sequence length, thread count and backend over the moderation model:
+#   python -m app.bench.inference --batch-sizes 1,8,32 --seq-lens 16,64 --threads 1,4
+# Uses MODEL_PATH / TOKENIZER_PATH unless --synthetic is given.
+
+BACKENDS = ("eager", "int8", "bf16", "compile")
+
+def _ints(value: str) -> list[int]:
+  return [int(part) for part in value.split(",") if part]
+
+def _names(value: str) -> list[str]:
+  names = [part for part in value.split(",") if part]
+  for name in names:
+    if name not in BACKENDS:
+      raise argparse.ArgumentTypeError("unknown backend %s, expected one of %s" % (name, ", ".join(BACKENDS)))
+  return names
+
+def prepare(model, backend: str):
+  model = copy.deepcopy(model).eval()
+  if backend == "int8":
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+  if backend == "bf16":
+    return model.to(torch.bfloat16)
+  if backend == "compile":
+    return torch.compile(model)
+  return model
+
+def make_texts(batch_size: int, seq_len: int, rng: random.Random) -> list[str]:
+  # Enough words that truncation, not the text, decides the final length
+  return [" ".join(rng.choice(WORDS) for _ in range(seq_len)) for _ in range(batch_size)]
+
+def bench(model, tokenizer, texts: list[str], seq_len: int, warmup: int, iterations: int) -> dict:
+  tokenize_times = []
+  forward_times = []
+  tokens = 0
+
+  for i in range(warmup + iterations):
+    started = time.perf_counter()
+    inputs = tokenizer(texts, return_tensors="pt", padding="max_length", truncation=True, max_length=seq_len)
+    tokenized = time.perf_counter()
+    with torch.inference_mode():
+      model(**inputs).logits.softmax(dim=-1)
+    finished = time.perf_counter()
+
+    if i >= warmup:
+      tokenize_times.append(tokenized - started)
+      forward_times.append(finished - tokenized)
+      tokens += int(inputs["attention_mask"].sum())
+
+  totals = [a + b for a, b in zip(tokenize_times, forward_times)]
+  elapsed = sum(totals)
+  return {
+    "latency": latency_summary(totals),
+    "tokenize": latency_summary(tokenize_times),
+    "forward": latency_summary(forward_times),
+    "messages_per_second": len(texts) * iterations / elapsed if elapsed else 0.0,
+    "tokens_per_second": tokens / elapsed if elapsed else 0.0
+  }
+
+def main():
+  load_dotenv()
+
+  parser = argparse.ArgumentParser(description="Inference micro-benchmark for the moderation model")
+  parser.add_argument("--synthetic", action="store_true", help="benchmark a tiny random model instead of MODEL_PATH")
+  parser.add_argument("--batch-sizes", type=_ints, default=[1, 8, 32])
+  parser.add_argument("--seq-lens", type=_ints, default=[16, 64, 128])
+  parser.add_argument("--threads", type=_ints, default=[torch.get_num_threads()])
+  parser.add_argument("--backends", type=_names, default=["eager"])
+  parser.add_argument("--warmup", type=int, default=3)
+  parser.add_argument("--iterations", type=int, default=20)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--output", help="also write the JSON report to this file")
+  args = parser.parse_args()
+
+  if args.synthetic:
+    model_path = tokenizer_path = build_model(seed=args.seed)
+  else:
+    model_path = os.getenv("MODEL_PATH")
+    tokenizer_path = os.getenv("TOKENIZER_PATH")
+    if not model_path or not tokenizer_path:
+      parser.error("MODEL_PATH and TOKENIZER_PATH must be set, or pass --synthetic")
+
+  base_model = AutoModelForSequenceClassification.from_pretrained(model_path)
+  tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+  max_length = getattr(base_model.config, "max_position_embeddings", 512)
+  rng = random.Random(args.seed)
+
+  results = []
+  for backend in args.backends:
+    model = prepare(base_model, backend)
+    for threads in args.threads:
+      torch.set_num_threads(threads)
+      for seq_len in args.seq_lens:
+        for batch_size in args.batch_sizes:
+          texts = make_texts(batch_size, seq_len, rng)
+          result = bench(model, tokenizer, texts, min(seq_len, max_length), args.warmup, args.iterations)
+          results.append({
+            "backend": backend,
+            "threads": threads,
+            "seq_len": seq_len,
+            "batch_size": batch_size,
+            **result,
+            "rss_mb": rss_mb()
+          })
+    del model
+
+  report = {
+    "benchmark": "inference",
+    "commit": git_commit(),
+    "model": "synthetic" if args.synthetic else model_path,
+    "results": results,
+    "peak_rss_mb": peak_rss_mb()
+  }
+  if torch.cuda.is_available():
+    report["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / (1024 * 1024)
+
+  output = json.dumps(report, indent=2)
+  print(output)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output + "\n")
+
+if __name__ == "__main__":
+  main()
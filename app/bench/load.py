@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+import httpx
+from app.bench.stats import git_commit, peak_rss_mb, rss_mb
+from app.metrics import latency_summary
+from app.bench.synthetic import build_model
+
+# Offline load test against an in-process app:
+#   python -m app.bench.load --requests 5000 --concurrency 32 --output bench.json
+# DATABASE_URL should point at a scratch Postgres, or pass --sqlite for a throwaway file DB.
+# Rate limits are raised for the run unless --keep-rate-limits is given; 429s are counted apart.
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "prisma", "schema.prisma")
+
+MESSAGES = [
+  "gg", "lol", "hello everyone", "anyone up for a game tonight?", "thanks for the help",
+  "you are so stupid", "free nitro join this server now", "i will kill you", "nice play",
+  "what time is the event", "this is the worst server ever, i hate all of you", "ok"
+]
+
+# Edge buckets large enough that the bursts measure moderation rather than rejections
+BENCH_RATE_LIMITS = {
+  "GUILD_BUCKET_CAPACITY": "100000",
+  "GUILD_BUCKET_RATE": "100000",
+  "AUTHOR_BUCKET_CAPACITY": "100000",
+  "AUTHOR_BUCKET_RATE": "100000"
+}
+
+# Background work that only runs against Postgres
+BENCH_SQLITE_ENV = {
+  "JOB_WORKERS": "0",
+  "RISK_PERSIST": "false",
+  "RATE_LIMIT_BACKEND": "memory"
+}
+
+SCENARIOS = {
+  "moderate": 0.6,
+  "moderate_burst": 0.05,
+  "dashboard": 0.3,
+  "onboarding": 0.05
+}
+
+def discord_mock(request: httpx.Request) -> httpx.Response:
+  # The OAuth code is the owner id, and it round trips through the access token
+  if request.url.path.endswith("/oauth2/token"):
+    form = parse_qs(request.content.decode())
+    return httpx.Response(200, json={
+      "access_token": "bench-" + form["code"][0],
+      "refresh_token": "bench-refresh",
+      "token_type": "Bearer",
+      "scope": "identify guilds",
+      "expires_in": 604800
+    })
+  if request.url.path.endswith("/users/@me"):
+    owner_id = request.headers["Authorization"].removeprefix("Bearer bench-")
+    return httpx.Response(200, json={"id": owner_id, "username": owner_id})
+  return httpx.Response(404, json={"message": "Unknown route"})
+
+def prepare_database(args):
+  if args.sqlite:
+    # A separate SQLite client is generated next to the throwaway database, the installed one is left alone
+    workdir = tempfile.mkdtemp(prefix="aidle-bench-db-")
+    with open(SCHEMA_PATH) as f:
+      schema = f.read().replace('provider = "postgresql"', 'provider = "sqlite"')
+    schema = schema.replace(
+      'provider             = "prisma-client-py"',
+      'provider             = "prisma-client-py"\n  output               = "%s"' % os.path.join(workdir, "prisma")
+    )
+    schema_path = os.path.join(workdir, "schema.prisma")
+    with open(schema_path, "w") as f:
+      f.write(schema)
+    os.environ["DATABASE_URL"] = "file:" + os.path.join(workdir, "bench.db")
+    subprocess.run(["prisma", "db", "push", "--schema", schema_path, "--skip-generate", "--accept-data-loss"], check=True)
+    subprocess.run(["prisma", "generate", "--schema", schema_path], check=True)
+    # Nothing has imported prisma yet, so the app picks up this client instead of the installed one
+    sys.path.insert(0, workdir)
+    # The job queue claim and the author risk upsert are Postgres SQL, and neither is exercised here
+    os.environ.update(BENCH_SQLITE_ENV)
+  elif args.push_schema:
+    subprocess.run(["prisma", "db", "push", "--schema", SCHEMA_PATH, "--skip-generate"], check=True)
+
+class Workload:
+  def __init__(self, client: httpx.AsyncClient, cookie_name: str, seed: int):
+    self.client = client
+    self.cookie_name = cookie_name
+    self.rng = random.Random(seed)
+    self.base_id = self.rng.randrange(10 ** 15, 10 ** 17)
+    self.next_id = 0
+    self.owners: list[str] = []
+    self.tokens: dict[str, str] = {}
+    self.guilds: dict[str, list[str]] = {}
+    self.latencies = {name: [] for name in SCENARIOS}
+    self.errors = {name: 0 for name in SCENARIOS}
+    self.rate_limited = {name: 0 for name in SCENARIOS}
+
+  def new_id(self) -> int:
+    self.next_id += 1
+    return self.base_id + self.next_id
+
+  async def add_guild(self, owner_id: str) -> httpx.Response:
+    guild_id = str(self.new_id())
+    r = await self.client.post("/guild", json={
+      "owner_id": owner_id,
+      "owner_name": owner_id,
+      "guild_name": "bench guild %s" % guild_id,
+      "guild_id": guild_id,
+      "moderate": True
+    })
+    if not r.is_error:
+      self.guilds.setdefault(owner_id, []).append(guild_id)
+    return r
+
+  async def seed(self, owners: int, guilds_per_owner: int):
+    for i in range(owners):
+      owner_id = "bench-%d-%d" % (self.base_id, i)
+      self.owners.append(owner_id)
+      for _ in range(guilds_per_owner):
+        (await self.add_guild(owner_id)).raise_for_status()
+
+      r = await self.client.post("/auth", params={"code": owner_id, "redirect_uri": "http://localhost"})
+      r.raise_for_status()
+      self.tokens[owner_id] = r.text
+
+  def moderation_payload(self, guild_id: str) -> dict:
+    return {
+      "input_text": self.rng.choice(MESSAGES),
+      "metadata": {
+        "message_id": self.new_id(),
+        "author_id": self.rng.randrange(1, 50),
+        "author_name": "bench author",
+        "guild_id": guild_id
+      }
+    }
+
+  def random_guild(self) -> tuple[str, str]:
+    owner_id = self.rng.choice(self.owners)
+    return owner_id, self.rng.choice(self.guilds[owner_id])
+
+  async def moderate(self) -> list[httpx.Response]:
+    _, guild_id = self.random_guild()
+    return [await self.client.post("/moderate", json=self.moderation_payload(guild_id))]
+
+  async def moderate_burst(self) -> list[httpx.Response]:
+    # One busy channel: a burst of messages for the same guild at once
+    _, guild_id = self.random_guild()
+    return await asyncio.gather(*(
+      self.client.post("/moderate", json=self.moderation_payload(guild_id)) for _ in range(20)
+    ))
+
+  async def dashboard(self) -> list[httpx.Response]:
+    owner_id, guild_id = self.random_guild()
+    headers = {self.cookie_name: self.tokens[owner_id]}
+    return await asyncio.gather(
+      self.client.get("/me", headers=headers),
+      self.client.get("/guilds", headers=headers),
+      self.client.get("/guilds/%s" % guild_id, headers=headers),
+      self.client.get("/message-stats", headers=headers)
+    )
+
+  async def onboarding(self) -> list[httpx.Response]:
+    return [await self.add_guild(self.rng.choice(self.owners))]
+
+  async def run(self, requests: int, concurrency: int) -> float:
+    names = list(SCENARIOS)
+    weights = [SCENARIOS[name] for name in names]
+    remaining = requests
+
+    async def worker():
+      nonlocal remaining
+      while remaining > 0:
+        remaining -= 1
+        name = self.rng.choices(names, weights)[0]
+        started = time.perf_counter()
+        try:
+          responses = await getattr(self, name)()
+        except httpx.HTTPError:
+          responses = None
+        elapsed = time.perf_counter() - started
+        if responses is None or any(r.is_error and r.status_code != 429 for r in responses):
+          self.errors[name] += 1
+        elif any(r.status_code == 429 for r in responses):
+          # Rejections return early, keep them out of the latency numbers
+          self.rate_limited[name] += 1
+          continue
+        self.latencies[name].append(elapsed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+async def run(args) -> dict:
+  from app.main import api
+  from app import discord_client
+  from app.dependencies import get_db
+  from app.security import USER_COOKIE_NAME
+
+  discord_client._client = httpx.AsyncClient(
+    base_url=discord_client.API_ENDPOINT,
+    transport=httpx.MockTransport(discord_mock)
+  )
+
+  async with api.router.lifespan_context(api):
+    transport = httpx.ASGITransport(app=api)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+      workload = Workload(client, USER_COOKIE_NAME, args.seed)
+      await workload.seed(args.owners, args.guilds_per_owner)
+
+      # The daily plan cap would otherwise turn most of the run into 429s. Only the plans of
+      # the owners seeded above are lifted, and they're put back afterwards
+      db = await get_db()
+      users = await db.user.find_many(where={"owner_id": {"in": workload.owners}}, include={"plan": True})
+      plans = {user.plan.id: user.plan.max_requests for user in users}
+      await db.plan.update_many(where={"id": {"in": list(plans)}}, data={"max_requests": 2 ** 31 - 1})
+
+      try:
+        rss_before = rss_mb()
+        elapsed = await workload.run(args.requests, args.concurrency)
+      finally:
+        async with db.batch_() as batcher:
+          for plan_id, max_requests in plans.items():
+            batcher.plan.update(where={"id": plan_id}, data={"max_requests": max_requests})
+        await db.disconnect()
+
+  total = sum(len(latencies) for latencies in workload.latencies.values())
+  return {
+    "benchmark": "load",
+    "commit": git_commit(),
+    "config": {
+      "requests": args.requests,
+      "concurrency": args.concurrency,
+      "owners": args.owners,
+      "guilds_per_owner": args.guilds_per_owner,
+      "database": "sqlite" if args.sqlite else "postgresql",
+      "rate_limits": "configured" if args.keep_rate_limits else "raised",
+      "mix": SCENARIOS
+    },
+    "elapsed_seconds": elapsed,
+    "throughput_rps": total / elapsed if elapsed else 0.0,
+    "scenarios": {
+      name: {**latency_summary(workload.latencies[name]), "errors": workload.errors[name], "rate_limited": workload.rate_limited[name]}
+      for name in SCENARIOS
+    },
+    "rss_mb": {
+      "before_run": rss_before,
+      "after_run": rss_mb(),
+      "peak": peak_rss_mb()
+    }
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description="Offline load test for the moderation API")
+  parser.add_argument("--requests", type=int, default=2000, help="scenario executions to run")
+  parser.add_argument("--concurrency", type=int, default=16)
+  parser.add_argument("--owners", type=int, default=10)
+  parser.add_argument("--guilds-per-owner", type=int, default=5)
+  parser.add_argument("--model", help="use this model directory instead of a synthetic one")
+  parser.add_argument("--sqlite", action="store_true", help="use a throwaway SQLite database")
+  parser.add_argument("--push-schema", action="store_true", help="run prisma db push against DATABASE_URL first")
+  parser.add_argument("--keep-rate-limits", action="store_true", help="keep the configured edge rate limits instead of raising them")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--output", help="also write the JSON report to this file")
+  args = parser.parse_args()
+
+  model_path = args.model or build_model(seed=args.seed)
+  os.environ["MODEL_PATH"] = model_path
+  os.environ["TOKENIZER_PATH"] = model_path
+  os.environ["API_ENDPOINT"] = "http://discord.mock/api/v10"
+  os.environ.setdefault("JWT_SECRET_KEY", "bench-secret")
+  if not args.keep_rate_limits:
+    os.environ.update(BENCH_RATE_LIMITS)
+
+  prepare_database(args)
+
+  report = asyncio.run(run(args))
+  output = json.dumps(report, indent=2)
+  print(output)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output + "\n")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,80 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import httpx
+from app.metrics import latency_summary
+
+# Replays the "bot added to N guilds" storm against a running API:
+#   python -m app.bench.onboarding --url http://localhost:8000 --guilds 5000
+
+def build_payloads(guilds: int, owners: int, seed: int) -> list[dict]:
+  rng = random.Random(seed)
+  base = rng.randrange(10 ** 17, 10 ** 18 - guilds)
+  payloads = []
+  for i in range(guilds):
+    owner = rng.randrange(owners)
+    payloads.append({
+      "owner_id": "bench-owner-%d" % owner,
+      "owner_name": "owner %d" % owner,
+      "guild_name": "bench guild %d" % i,
+      "guild_id": str(base + i),
+      "moderate": True
+    })
+  return payloads
+
+async def replay(client: httpx.AsyncClient, payloads: list[dict], concurrency: int, rejoin: float, seed: int) -> dict:
+  rng = random.Random(seed)
+  queue = list(payloads)
+  # Some guilds are announced twice in parallel, like a reconnect racing a join
+  queue += [payload for payload in payloads if rng.random() < rejoin]
+  rng.shuffle(queue)
+
+  latencies = []
+  errors = 0
+  semaphore = asyncio.Semaphore(concurrency)
+
+  async def post(payload):
+    nonlocal errors
+    async with semaphore:
+      started = time.perf_counter()
+      try:
+        r = await client.post("/guild", json=payload)
+        if r.is_error:
+          errors += 1
+      except httpx.HTTPError:
+        errors += 1
+      latencies.append(time.perf_counter() - started)
+
+  started = time.perf_counter()
+  await asyncio.gather(*(post(payload) for payload in queue))
+  elapsed = time.perf_counter() - started
+
+  return {
+    "requests": len(queue),
+    "errors": errors,
+    "elapsed_seconds": elapsed,
+    "throughput_rps": len(queue) / elapsed if elapsed else 0.0,
+    "latency": latency_summary(latencies)
+  }
+
+async def main():
+  parser = argparse.ArgumentParser(description="Replay a bulk guild onboarding storm")
+  parser.add_argument("--url", default="http://localhost:8000")
+  parser.add_argument("--guilds", type=int, default=5000)
+  parser.add_argument("--owners", type=int, default=500)
+  parser.add_argument("--concurrency", type=int, default=50)
+  parser.add_argument("--rejoin", type=float, default=0.05, help="fraction of guilds announced twice concurrently")
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+
+  payloads = build_payloads(args.guilds, args.owners, args.seed)
+  limits = httpx.Limits(max_connections=args.concurrency)
+  async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+    report = await replay(client, payloads, args.concurrency, args.rejoin, args.seed)
+
+  print(json.dumps({"benchmark": "onboarding", **report}, indent=2))
+
+if __name__ == "__main__":
+  asyncio.run(main())
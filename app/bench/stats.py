@@ -0,0 +1,20 @@
+import resource
+import subprocess
+
+def rss_mb() -> float:
+  try:
+    with open("/proc/self/statm") as f:
+      pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / (1024 * 1024)
+  except OSError:
+    return peak_rss_mb()
+
+def peak_rss_mb() -> float:
+  # ru_maxrss is KiB on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def git_commit() -> str | None:
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
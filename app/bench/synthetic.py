@@ -0,0 +1,43 @@
+import os
+import string
+import tempfile
+import torch
+from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+
+# Same label set the production model exposes through id2label
+LABELS = ["OK", "H", "V", "S", "H2", "V2", "S3", "HR", "SH"]
+
+WORDS = [
+  "the", "a", "you", "i", "is", "are", "and", "to", "of", "in", "it", "that", "this", "lol", "gg",
+  "hello", "hi", "thanks", "good", "bad", "game", "play", "server", "discord", "message", "hate",
+  "kill", "stupid", "nice", "wow", "ok", "no", "yes", "what", "why", "when", "join", "free", "nitro"
+]
+
+def build_model(path: str | None = None, hidden_size: int = 32, layers: int = 2, heads: int = 2, max_length: int = 128, seed: int = 0) -> str:
+  # A tiny randomly initialised classifier, good enough to exercise the serving path offline
+  path = path or tempfile.mkdtemp(prefix="aidle-synthetic-")
+
+  vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS + list(string.ascii_lowercase + string.digits + string.punctuation)
+  vocab += ["##" + c for c in string.ascii_lowercase + string.digits]
+  vocab_file = os.path.join(path, "vocab.txt")
+  with open(vocab_file, "w") as f:
+    f.write("\n".join(vocab) + "\n")
+
+  tokenizer = BertTokenizerFast(vocab_file=vocab_file, do_lower_case=True, model_max_length=max_length)
+  tokenizer.save_pretrained(path)
+
+  torch.manual_seed(seed)
+  config = BertConfig(
+    vocab_size=len(vocab),
+    hidden_size=hidden_size,
+    num_hidden_layers=layers,
+    num_attention_heads=heads,
+    intermediate_size=hidden_size * 4,
+    max_position_embeddings=max_length,
+    num_labels=len(LABELS),
+    id2label=dict(enumerate(LABELS)),
+    label2id={label: idx for idx, label in enumerate(LABELS)}
+  )
+  BertForSequenceClassification(config).save_pretrained(path)
+
+  return path
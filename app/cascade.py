@@ -0,0 +1,108 @@
+import os
+import re
+import zlib
+from time import perf_counter
+import numpy as np
+from dotenv import load_dotenv
+from app.fingerprint import normalize
+from app.inference import harmful_probability
+from app.metrics import Counter, Histogram
+
+load_dotenv()
+
+# Weights produced by `python -m app.bench.cascade train`, the cascade is off without them
+CASCADE_WEIGHTS_PATH = os.getenv('CASCADE_WEIGHTS_PATH')
+# Stage one must be at least this sure the message is "OK"...
+CASCADE_OK_THRESHOLD = float(os.getenv('CASCADE_OK_THRESHOLD', '0.95'))
+# ...and its harmful score must sit this far under the guild's own confidence_limit
+CASCADE_MARGIN = float(os.getenv('CASCADE_MARGIN', '0.5'))
+# Only short chatter is eligible, anything longer always goes to the transformer
+CASCADE_MAX_LENGTH = int(os.getenv('CASCADE_MAX_LENGTH', '64'))
+
+DEFAULT_FEATURES = 1 << 16
+
+cascade_decisions = Counter("aidle_cascade_decisions_total", "First-stage classifier decisions", labelnames=("decision",))
+cascade_cleared = cascade_decisions.labels("cleared")
+cascade_escalated = cascade_decisions.labels("escalated")
+cascade_duration = Histogram("aidle_cascade_duration_seconds", "First-stage classifier latency", buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005))
+
+# Links and mentions are what raids are made of, never clear them early
+_NEVER_CLEAR = re.compile(r"https?://|discord\.gg/|<@|@everyone|@here")
+
+def features(text: str, n_features: int) -> tuple[np.ndarray, np.ndarray]:
+  # Hashed word unigrams, word bigrams and character trigrams, L2 normalised
+  normalized = normalize(text)
+  words = normalized.split()
+  grams = words + [a + " " + b for a, b in zip(words, words[1:])]
+  padded = " %s " % normalized
+  grams += ["#" + padded[i:i + 3] for i in range(len(padded) - 2)]
+  if not grams:
+    grams = [""]
+
+  mask = n_features - 1
+  indices, counts = np.unique(
+    np.fromiter((zlib.crc32(gram.encode()) & mask for gram in grams), dtype=np.int64, count=len(grams)),
+    return_counts=True
+  )
+  values = counts.astype(np.float32)
+  values /= np.linalg.norm(values)
+  return indices, values
+
+class HashedLinearModel:
+  def __init__(self, weights: np.ndarray, bias: np.ndarray, labels: list[str]):
+    self.weights = weights
+    self.bias = bias
+    self.labels = labels
+    self.n_features = weights.shape[0]
+
+  @classmethod
+  def create(cls, labels: list[str], n_features: int = DEFAULT_FEATURES) -> "HashedLinearModel":
+    return cls(np.zeros((n_features, len(labels)), dtype=np.float32), np.zeros(len(labels), dtype=np.float32), labels)
+
+  @classmethod
+  def load(cls, path: str) -> "HashedLinearModel":
+    data = np.load(path)
+    return cls(data["weights"], data["bias"], [str(label) for label in data["labels"]])
+
+  def save(self, path: str):
+    np.savez_compressed(path, weights=self.weights, bias=self.bias, labels=np.array(self.labels))
+
+  def probabilities(self, text: str) -> np.ndarray:
+    indices, values = features(text, self.n_features)
+    logits = values @ self.weights[indices] + self.bias
+    logits -= logits.max()
+    exp = np.exp(logits)
+    return exp / exp.sum()
+
+  def predict(self, text: str) -> list[tuple[str, float]]:
+    label_prob_pairs = list(zip(self.labels, self.probabilities(text).tolist()))
+    label_prob_pairs.sort(key=lambda item: item[1], reverse=True)
+    return label_prob_pairs
+
+def eligible(text: str) -> bool:
+  return len(text) <= CASCADE_MAX_LENGTH and not _NEVER_CLEAR.search(text)
+
+def confidently_ok(label_prob_pairs: list[tuple[str, float]], settings, threshold: float = CASCADE_OK_THRESHOLD, margin: float = CASCADE_MARGIN) -> bool:
+  # Judged against this guild's enabled labels and confidence_limit, like the transformer would be
+  ok_probability = next((probability for label, probability in label_prob_pairs if label == "OK"), 0.0)
+  if ok_probability < threshold:
+    return False
+  return harmful_probability(label_prob_pairs, settings) < (settings.confidence_limit / 100) * margin
+
+model = HashedLinearModel.load(CASCADE_WEIGHTS_PATH) if CASCADE_WEIGHTS_PATH else None
+
+def clear(text: str, settings) -> list[tuple[str, float]] | None:
+  # Stage one: returns probabilities when the message is obviously fine, None to escalate
+  if model is None or not eligible(text):
+    return None
+
+  started = perf_counter()
+  label_prob_pairs = model.predict(text)
+  cleared = confidently_ok(label_prob_pairs, settings)
+  cascade_duration.observe(perf_counter() - started)
+
+  if cleared:
+    cascade_cleared.inc()
+    return label_prob_pairs
+  cascade_escalated.inc()
+  return None
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import time
+import httpx
+from dotenv import load_dotenv
+from fastapi import Depends, HTTPException
+from app.discord_client import get_client
+from app.metrics import Counter
+from app.security import Principal, get_principal
+from app.sessions import SessionData, store
+
+load_dotenv()
+
+client_id = os.getenv('CLIENT_ID')
+client_secret = os.getenv('CLIENT_SECRET')
+
+# Refresh this long before the access token actually expires
+REFRESH_MARGIN = float(os.getenv('TOKEN_REFRESH_MARGIN', '86400'))
+REFRESH_INTERVAL = float(os.getenv('TOKEN_REFRESH_INTERVAL', '60'))
+# A rejected refresh waits this long for another worker's rotation to land before logging the user out
+ROTATION_GRACE = float(os.getenv('TOKEN_ROTATION_GRACE', '2'))
+
+refreshes = Counter("aidle_token_refresh_total", "Discord token refresh attempts", labelnames=("outcome",))
+refresh_success = refreshes.labels("success")
+refresh_failure = refreshes.labels("failure")
+refresh_revoked = refreshes.labels("revoked")
+
+# session_id -> expires_at for every session this worker has handed out
+_tracked: dict[str, float] = {}
+# (user_id, session_id) -> running refresh, so concurrent callers share one round trip
+_inflight: dict[tuple[str, str], asyncio.Task] = {}
+_task: asyncio.Task | None = None
+
+def track(session: SessionData):
+  _tracked[session.session_id] = session.expires_at
+
+async def _refresh(session: SessionData) -> SessionData | None:
+  # Another worker may already have rotated the token, so read past this worker's cache
+  current = await store.get_fresh(session.session_id)
+  if current is None:
+    _tracked.pop(session.session_id, None)
+    return None
+  if current.expires_at - REFRESH_MARGIN > time.time():
+    track(current)
+    return current
+  if not current.refresh_token:
+    _tracked.pop(session.session_id, None)
+    return current
+
+  data = {
+    'grant_type': 'refresh_token',
+    'refresh_token': current.refresh_token
+  }
+
+  try:
+    r = await get_client().post('/oauth2/token', data=data, auth=(client_id, client_secret))
+  except httpx.HTTPError as e:
+    print(f"Error refreshing Discord token: {e}")
+    refresh_failure.inc()
+    return current
+
+  if r.status_code in (400, 401):
+    # Either another worker rotated the refresh token first, or the grant was revoked
+    latest = await _rotated(current)
+    if latest is not None:
+      track(latest)
+      return latest
+    refresh_revoked.inc()
+    _tracked.pop(session.session_id, None)
+    await store.delete(session.session_id)
+    return None
+
+  if r.is_error:
+    print(f"Error refreshing Discord token: {r.status_code}")
+    refresh_failure.inc()
+    return current
+
+  body = r.json()
+  refreshed = current.model_copy(update={
+    'access_token': body['access_token'],
+    'refresh_token': body.get('refresh_token', current.refresh_token),
+    'token_type': body.get('token_type', current.token_type),
+    'scope': body.get('scope', current.scope),
+    'expires_at': time.time() + body.get('expires_in', 604800)
+  })
+  await store.set(refreshed)
+  track(refreshed)
+  refresh_success.inc()
+  return refreshed
+
+async def _rotated(current: SessionData) -> SessionData | None:
+  # The session as another worker left it, or None if nobody has replaced our refresh token
+  for attempt in range(2):
+    if attempt:
+      await asyncio.sleep(ROTATION_GRACE)
+    latest = await store.get_fresh(current.session_id)
+    if latest is None:
+      return None
+    if latest.refresh_token != current.refresh_token:
+      return latest
+  return None
+
+def _finished(key: tuple[str, str], task: asyncio.Task):
+  _inflight.pop(key, None)
+  # Background refreshes have nobody awaiting them, so log failures here rather than lose them
+  if not task.cancelled() and task.exception() is not None:
+    refresh_failure.inc()
+    print(f"Error refreshing Discord token: {task.exception()}")
+
+def refresh(session: SessionData) -> asyncio.Task:
+  key = (session.user_id, session.session_id)
+  task = _inflight.get(key)
+  if task is None:
+    task = asyncio.create_task(_refresh(session))
+    _inflight[key] = task
+    task.add_done_callback(lambda task: _finished(key, task))
+  return task
+
+async def _refresh_due():
+  deadline = time.time() + REFRESH_MARGIN
+  due = [session_id for session_id, expires_at in _tracked.items() if expires_at <= deadline]
+
+  for session_id in due:
+    session = await store.get(session_id)
+    if session is None:
+      _tracked.pop(session_id, None)
+      continue
+    refresh(session)
+
+async def _refresh_loop():
+  while True:
+    await asyncio.sleep(REFRESH_INTERVAL)
+    try:
+      await _refresh_due()
+    except Exception as e:
+      # A session store outage mustn't stop refreshes for good, try again next interval
+      print(f"Error refreshing Discord tokens: {e}")
+
+def start():
+  global _task
+  if _task is None:
+    _task = asyncio.create_task(_refresh_loop())
+
+async def stop():
+  global _task
+  if _task is not None:
+    _task.cancel()
+    try:
+      await _task
+    except asyncio.CancelledError:
+      pass
+    _task = None
+
+async def get_credentials(principal: Principal = Depends(get_principal)) -> SessionData:
+  session = await store.get(principal.session_id)
+  if session is None or session.user_id != principal.user_id:
+    raise HTTPException(status_code=401, detail="Session expired")
+
+  track(session)
+
+  # Only blocks when the background refresh did not get there in time
+  if session.expires_at <= time.time():
+    session = await refresh(session)
+    if session is None or session.expires_at <= time.time():
+      raise HTTPException(status_code=401, detail="Session expired")
+
+  return session
@@ -1,20 +1,62 @@
-import os
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from time import perf_counter
 from prisma import Prisma
 from dotenv import load_dotenv
+from app import tracing
+from app.metrics import record_query
 
 load_dotenv()
 
-model = AutoModelForSequenceClassification.from_pretrained(os.getenv("MODEL_PATH"))
-tokenizer = AutoTokenizer.from_pretrained(os.getenv("TOKENIZER_PATH"))
+_RAW_ACTIONS = {"query_raw", "query_first", "execute_raw"}
 
-def get_model():
-  return model
+class _InstrumentedActions:
+  def __init__(self, model_name: str, actions):
+    self._model_name = model_name
+    self._actions = actions
 
-def get_tokenizer():
-  return tokenizer
+  def __getattr__(self, action: str):
+    method = getattr(self._actions, action)
+
+    async def timed(*args, **kwargs):
+      started = perf_counter()
+      result = None
+      try:
+        result = await method(*args, **kwargs)
+        return result
+      finally:
+        duration = perf_counter() - started
+        record_query(self._model_name, action, duration)
+        tracing.record(self._model_name, action, duration, result)
+
+    return timed
+
+class _InstrumentedTransaction:
+  def __init__(self, manager):
+    self._manager = manager
+
+  async def __aenter__(self):
+    return InstrumentedPrisma(await self._manager.__aenter__())
+
+  async def __aexit__(self, *exc_info):
+    return await self._manager.__aexit__(*exc_info)
+
+class InstrumentedPrisma:
+  # Times every model action and raw query, everything else passes straight through
+  def __init__(self, client: Prisma):
+    self._client = client
+
+  def __getattr__(self, name: str):
+    attr = getattr(self._client, name)
+    if type(attr).__name__.endswith("Actions"):
+      attr = _InstrumentedActions(name, attr)
+      setattr(self, name, attr)
+    elif name in _RAW_ACTIONS:
+      attr = getattr(_InstrumentedActions("raw", self._client), name)
+    return attr
+
+  def tx(self, *args, **kwargs):
+    return _InstrumentedTransaction(self._client.tx(*args, **kwargs))
 
 async def get_db():
   db = Prisma()
   await db.connect()
-  return db
\ No newline at end of file
+  return InstrumentedPrisma(db)
@@ -0,0 +1,46 @@
+import os
+import re
+import httpx
+from time import perf_counter
+from dotenv import load_dotenv
+from app.metrics import upstream_latency
+
+load_dotenv()
+
+API_ENDPOINT = os.getenv('API_ENDPOINT', 'https://discord.com/api/v10')
+
+_SNOWFLAKE = re.compile(r"/\d{15,}")
+
+# One pooled client per worker so logins reuse warm TLS connections
+_client: httpx.AsyncClient | None = None
+
+def route_template(path: str) -> str:
+  # Collapse ids so the route label stays low cardinality
+  return _SNOWFLAKE.sub("/:id", path.removeprefix(httpx.URL(API_ENDPOINT).path))
+
+def observe_upstream(method: str, path: str, status: int, seconds: float):
+  upstream_latency.labels(method, route_template(path), "%dxx" % (status // 100)).observe(seconds)
+
+async def _on_request(request: httpx.Request):
+  request.extensions["aidle_started"] = perf_counter()
+
+async def _on_response(response: httpx.Response):
+  request = response.request
+  observe_upstream(request.method, request.url.path, response.status_code, perf_counter() - request.extensions["aidle_started"])
+
+def get_client() -> httpx.AsyncClient:
+  global _client
+  if _client is None:
+    _client = httpx.AsyncClient(
+      base_url=API_ENDPOINT,
+      timeout=httpx.Timeout(10.0, connect=5.0),
+      limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+      event_hooks={"request": [_on_request], "response": [_on_response]}
+    )
+  return _client
+
+async def close_client():
+  global _client
+  if _client is not None:
+    await _client.aclose()
+    _client = None
@@ -0,0 +1,158 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+from app.metrics import Counter, Gauge, cache_counters
+
+load_dotenv()
+
+# Keep the pooled hidden state from each forward pass for similarity search
+EMBEDDINGS_ENABLED = os.getenv('EMBEDDINGS_ENABLED', 'false').lower() == 'true'
+# Recently computed embeddings, keyed by model version and text
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', '10000'))
+# Past messages kept per guild, the oldest are overwritten once full
+EMBEDDING_STORE_SIZE = int(os.getenv('EMBEDDING_STORE_SIZE', '20000'))
+EMBEDDING_TOP_K = int(os.getenv('EMBEDDING_TOP_K', '10'))
+# Process-wide cap on the per-guild stores, the least recently used guilds are dropped whole
+EMBEDDING_MEMORY_BUDGET_MB = float(os.getenv('EMBEDDING_MEMORY_BUDGET_MB', '1024'))
+
+# Rows converted to float32 at a time while searching, bounds the scratch memory
+_SEARCH_CHUNK = 8192
+_INITIAL_CAPACITY = 256
+
+cache_hit, cache_miss = cache_counters("embedding")
+store_bytes = Gauge("aidle_embedding_store_bytes", "Memory held by per-guild embedding stores")
+stores_evicted = Counter("aidle_embedding_stores_evicted_total", "Guild embedding stores dropped to stay within the memory budget")
+
+# (version, digest) -> unit float16 vector; written from the inference thread
+_cache: OrderedDict[tuple[str, bytes], np.ndarray] = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _digest(text: str) -> bytes:
+  return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+def remember(version: str, texts: list[str], vectors: np.ndarray):
+  with _cache_lock:
+    for text, vector in zip(texts, vectors):
+      key = (version, _digest(text))
+      _cache[key] = vector
+      _cache.move_to_end(key)
+    while len(_cache) > EMBEDDING_CACHE_SIZE:
+      _cache.popitem(last=False)
+
+def contains(version: str, text: str) -> bool:
+  with _cache_lock:
+    return (version, _digest(text)) in _cache
+
+def lookup(version: str, text: str) -> np.ndarray | None:
+  key = (version, _digest(text))
+  with _cache_lock:
+    vector = _cache.get(key)
+    if vector is not None:
+      _cache.move_to_end(key)
+  if vector is None:
+    cache_miss.inc()
+  else:
+    cache_hit.inc()
+  return vector
+
+class GuildEmbeddings:
+  # Compact ring of unit vectors, cosine similarity is a plain dot product
+  def __init__(self, version: str, dims: int):
+    capacity = min(_INITIAL_CAPACITY, EMBEDDING_STORE_SIZE)
+    self.version = version
+    self.vectors = np.zeros((capacity, dims), dtype=np.float16)
+    self.message_ids = np.zeros(capacity, dtype=np.int64)
+    self.author_ids = np.zeros(capacity, dtype=np.int64)
+    self.created = np.zeros(capacity, dtype=np.float64)
+    self.size = 0
+    self.next = 0
+
+  @property
+  def nbytes(self) -> int:
+    return self.vectors.nbytes + self.message_ids.nbytes + self.author_ids.nbytes + self.created.nbytes
+
+  def _grow(self):
+    capacity = min(len(self.vectors) * 2, EMBEDDING_STORE_SIZE)
+    for name in ("vectors", "message_ids", "author_ids", "created"):
+      array = getattr(self, name)
+      grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+      grown[:len(array)] = array
+      setattr(self, name, grown)
+
+  def add(self, message_id: int, author_id: int, vector: np.ndarray):
+    if self.next == len(self.vectors) and len(self.vectors) < EMBEDDING_STORE_SIZE:
+      self._grow()
+    index = self.next % len(self.vectors)
+    self.vectors[index] = vector
+    self.message_ids[index] = message_id
+    self.author_ids[index] = author_id
+    self.created[index] = time.time()
+    self.size = min(self.size + 1, len(self.vectors))
+    self.next = index + 1
+
+  def search(self, vector: np.ndarray, k: int) -> list[tuple[int, float]]:
+    if not self.size:
+      return []
+    query = vector.astype(np.float32)
+    scores = np.empty(self.size, dtype=np.float32)
+    for start in range(0, self.size, _SEARCH_CHUNK):
+      scores[start:start + _SEARCH_CHUNK] = self.vectors[start:min(start + _SEARCH_CHUNK, self.size)].astype(np.float32) @ query
+
+    k = min(k, self.size)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(int(index), float(scores[index])) for index in top]
+
+  def export(self) -> bytes:
+    buffer = io.BytesIO()
+    np.savez_compressed(
+      buffer,
+      vectors=self.vectors[:self.size],
+      message_ids=self.message_ids[:self.size],
+      author_ids=self.author_ids[:self.size],
+      created=self.created[:self.size],
+      version=np.array(self.version)
+    )
+    return buffer.getvalue()
+
+# guild_id -> store, least recently used first
+_stores: OrderedDict[str, GuildEmbeddings] = OrderedDict()
+_total_bytes = 0
+
+def store(guild_id: str) -> GuildEmbeddings | None:
+  current = _stores.get(guild_id)
+  if current is not None:
+    _stores.move_to_end(guild_id)
+  return current
+
+def _resize(delta: int):
+  global _total_bytes
+  _total_bytes += delta
+  store_bytes.inc(delta)
+
+def _evict():
+  budget = EMBEDDING_MEMORY_BUDGET_MB * 1024 * 1024
+  # The store just written to is last, it's kept even if it alone is over budget
+  while _total_bytes > budget and len(_stores) > 1:
+    _, evicted = _stores.popitem(last=False)
+    _resize(-evicted.nbytes)
+    stores_evicted.inc()
+
+def add(guild_id: str, version: str, message_id: int, author_id: int, vector: np.ndarray):
+  current = _stores.get(guild_id)
+  # A different model means a different vector space, start over rather than mix them
+  if current is None or current.version != version or current.vectors.shape[1] != vector.shape[0]:
+    if current is not None:
+      _resize(-current.nbytes)
+    current = _stores[guild_id] = GuildEmbeddings(version, vector.shape[0])
+    _resize(current.nbytes)
+  _stores.move_to_end(guild_id)
+  before = current.nbytes
+  current.add(message_id, author_id, vector)
+  _resize(current.nbytes - before)
+  _evict()
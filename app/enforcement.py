@@ -0,0 +1,337 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from time import perf_counter
+import openapi_client
+from dotenv import load_dotenv
+from openapi_client.models.ban_user_from_guild_request import BanUserFromGuildRequest
+from openapi_client.models.bulk_delete_messages_request import BulkDeleteMessagesRequest
+from openapi_client.models.update_guild_member_request import UpdateGuildMemberRequest
+from openapi_client.rest import ApiException
+from app.dependencies import get_db
+from app.discord_client import API_ENDPOINT, observe_upstream
+from app.metrics import Counter, Gauge
+
+load_dotenv()
+
+# Enforcement runs as the bot, it stays off until a token is configured
+DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
+# Actions collected for this long go out together, so a burst becomes one bulk delete per channel
+ENFORCEMENT_FLUSH_MS = float(os.getenv('ENFORCEMENT_FLUSH_MS', '250'))
+ENFORCEMENT_CONCURRENCY = int(os.getenv('ENFORCEMENT_CONCURRENCY', '4'))
+ENFORCEMENT_MAX_ATTEMPTS = int(os.getenv('ENFORCEMENT_MAX_ATTEMPTS', '3'))
+ENFORCEMENT_MAX_PENDING = int(os.getenv('ENFORCEMENT_MAX_PENDING', '10000'))
+# Recent history removed along with a ban
+ENFORCEMENT_BAN_DELETE_SECONDS = int(os.getenv('ENFORCEMENT_BAN_DELETE_SECONDS', '0'))
+
+BULK_DELETE_LIMIT = 100
+# channel_id -> guild_id lookups kept, channels don't move between guilds
+_CHANNEL_CACHE_SIZE = 10000
+
+enforcement_actions = Counter("aidle_enforcement_actions_total", "Discord enforcement calls by action and outcome", labelnames=("action", "result"))
+enforcement_pending = Gauge("aidle_enforcement_pending", "Enforcement actions waiting to be sent")
+enforcement_dropped = Counter("aidle_enforcement_dropped_total", "Enforcement actions dropped because the queue was full")
+enforcement_rate_limited = Counter("aidle_enforcement_rate_limited_total", "Discord 429s seen by the enforcement queue")
+
+class MemberAction:
+  __slots__ = ("ban", "timeout", "message_ids", "attempts")
+
+  def __init__(self):
+    self.ban = False
+    self.timeout = 0
+    self.message_ids: set[int] = set()
+    self.attempts = 0
+
+class Enforcer:
+  def __init__(self, token: str):
+    configuration = openapi_client.Configuration()
+    configuration.host = API_ENDPOINT
+    configuration.api_key['BotToken'] = token
+    configuration.api_key_prefix['BotToken'] = 'Bot'
+    self.api = openapi_client.DefaultApi(openapi_client.ApiClient(configuration))
+    # The generated client is synchronous, its calls run here
+    self._executor = ThreadPoolExecutor(max_workers=ENFORCEMENT_CONCURRENCY, thread_name_prefix="enforcement")
+    self._slots = asyncio.Semaphore(ENFORCEMENT_CONCURRENCY)
+
+    # (guild_id, channel_id) -> message_id -> attempts; a message is only deleted once
+    self._deletes: dict[tuple[str, str], dict[int, int]] = {}
+    # (guild_id, user_id) -> strongest pending action against that member
+    self._members: dict[tuple[str, int], MemberAction] = {}
+    self._pending = 0
+    # channel_id -> the guild it belongs to, "" when the bot can't see it
+    self._channels: OrderedDict[str, str] = OrderedDict()
+    # Discord rate limit bucket -> monotonic time it opens again
+    self._blocked: dict[str, float] = {}
+    self._wakeup = asyncio.Event()
+    self._task: asyncio.Task | None = None
+    self._db = None
+
+  def submit(self, settings, guild_id: str, channel_id: str | None, message_id: int, author_id: int) -> list[str]:
+    actions = []
+    if settings.enforce_delete and channel_id:
+      actions.append("delete")
+    if settings.enforce_ban:
+      actions.append("ban")
+    elif settings.enforce_timeout:
+      actions.append("timeout")
+    if not actions:
+      return actions
+
+    if self._pending >= ENFORCEMENT_MAX_PENDING:
+      enforcement_dropped.inc()
+      return []
+
+    if "delete" in actions:
+      messages = self._deletes.setdefault((guild_id, channel_id), {})
+      if message_id not in messages:
+        messages[message_id] = 0
+        self._pending += 1
+    if "ban" in actions or "timeout" in actions:
+      member = self._members.get((guild_id, author_id))
+      if member is None:
+        member = self._members[(guild_id, author_id)] = MemberAction()
+        self._pending += 1
+      member.ban = member.ban or settings.enforce_ban
+      member.timeout = max(member.timeout, settings.enforce_timeout)
+      member.message_ids.add(message_id)
+
+    enforcement_pending.set(self._pending)
+    self.start()
+    self._wakeup.set()
+    return actions
+
+  def _is_blocked(self, bucket: str, now: float) -> bool:
+    return self._blocked.get("global", 0) > now or self._blocked.get(bucket, 0) > now
+
+  def _block(self, bucket: str, headers):
+    if headers is None:
+      return
+    try:
+      if headers.get("x-ratelimit-remaining") == "0" or headers.get("retry-after"):
+        reset_after = float(headers.get("retry-after") or headers.get("x-ratelimit-reset-after") or 1)
+        scope = "global" if headers.get("x-ratelimit-global") == "true" else bucket
+        self._blocked[scope] = max(self._blocked.get(scope, 0), time.monotonic() + reset_after)
+    except ValueError:
+      pass
+
+  async def _call(self, action: str, bucket: str, path: str, method: str, fn, *args) -> tuple[bool | None, int]:
+    # (True, status) on success, (None, status) to retry later, (False, status) to give up
+    loop = asyncio.get_running_loop()
+    async with self._slots:
+      started = perf_counter()
+      try:
+        response = await loop.run_in_executor(self._executor, partial(fn, *args))
+      except ApiException as e:
+        status = e.status or 500
+        observe_upstream(method, path, status, perf_counter() - started)
+        self._block(bucket, e.headers)
+        if status == 429:
+          enforcement_rate_limited.inc()
+          enforcement_actions.labels(action, "retried").inc()
+          return None, status
+        if status >= 500:
+          enforcement_actions.labels(action, "retried").inc()
+          return None, status
+        # Already gone, or the bot lacks permission; neither gets better with retries
+        print(f"Enforcement {action} failed: {status} {e.reason}")
+        enforcement_actions.labels(action, "failed").inc()
+        return False, status
+      except Exception as e:
+        print(f"Enforcement {action} failed: {e}")
+        enforcement_actions.labels(action, "retried").inc()
+        return None, 0
+
+    observe_upstream(method, path, response.status_code, perf_counter() - started)
+    self._block(bucket, response.headers)
+    enforcement_actions.labels(action, "ok").inc()
+    return True, response.status_code
+
+  async def _channel_guild(self, channel_id: str) -> str | None:
+    # None when Discord couldn't answer right now
+    guild_id = self._channels.get(channel_id)
+    if guild_id is not None:
+      self._channels.move_to_end(channel_id)
+      return guild_id
+
+    path = "/channels/%s" % channel_id
+    loop = asyncio.get_running_loop()
+    async with self._slots:
+      started = perf_counter()
+      try:
+        response = await loop.run_in_executor(self._executor, self.api.get_channel_with_http_info, channel_id)
+      except ApiException as e:
+        status = e.status or 500
+        observe_upstream("GET", path, status, perf_counter() - started)
+        self._block("channel:%s" % channel_id, e.headers)
+        if status == 429 or status >= 500:
+          return None
+        guild_id = ""
+      except Exception as e:
+        print(f"Error looking up channel {channel_id}: {e}")
+        return None
+      else:
+        observe_upstream("GET", path, response.status_code, perf_counter() - started)
+        guild_id = getattr(response.data.actual_instance, "guild_id", None) or ""
+
+    self._channels[channel_id] = guild_id
+    if len(self._channels) > _CHANNEL_CACHE_SIZE:
+      self._channels.popitem(last=False)
+    return guild_id
+
+  async def _delete(self, guild_id: str, channel_id: str, messages: dict[int, int]) -> list[int]:
+    # The channel comes from the request, never delete outside the guild being enforced
+    channel_guild = await self._channel_guild(channel_id)
+    if channel_guild is None:
+      self._requeue_deletes(guild_id, channel_id, messages)
+      return []
+    if channel_guild != guild_id:
+      print(f"Enforcement delete skipped: channel {channel_id} is not in guild {guild_id}")
+      enforcement_actions.labels("delete", "rejected").inc(len(messages))
+      return []
+
+    ids = list(messages)
+    bucket = "channel:%s" % channel_id
+    if len(ids) == 1:
+      ok, _ = await self._call(
+        "delete", bucket, "/channels/%s/messages/%s" % (channel_id, ids[0]), "DELETE",
+        self.api.delete_message_with_http_info, channel_id, str(ids[0])
+      )
+    else:
+      ok, status = await self._call(
+        "bulk_delete", bucket, "/channels/%s/messages/bulk-delete" % channel_id, "POST",
+        self.api.bulk_delete_messages_with_http_info, channel_id, BulkDeleteMessagesRequest(messages=[str(i) for i in ids])
+      )
+      if ok is False and status == 400:
+        # One bad id fails the whole bulk call, send them one at a time instead
+        done = []
+        for message_id in ids:
+          done += await self._delete(guild_id, channel_id, {message_id: messages[message_id]})
+        return done
+
+    if ok:
+      return ids
+    if ok is None:
+      self._requeue_deletes(guild_id, channel_id, messages)
+    return []
+
+  def _requeue_deletes(self, guild_id: str, channel_id: str, messages: dict[int, int]):
+    pending = self._deletes.setdefault((guild_id, channel_id), {})
+    for message_id, attempts in messages.items():
+      if attempts + 1 < ENFORCEMENT_MAX_ATTEMPTS and message_id not in pending:
+        pending[message_id] = attempts + 1
+        self._pending += 1
+
+  async def _member(self, guild_id: str, user_id: int, member: MemberAction) -> list[int]:
+    bucket = "guild:%s" % guild_id
+    if member.ban:
+      ok, _ = await self._call(
+        "ban", bucket, "/guilds/%s/bans/%s" % (guild_id, user_id), "PUT",
+        self.api.ban_user_from_guild_with_http_info, guild_id, str(user_id),
+        BanUserFromGuildRequest(delete_message_seconds=ENFORCEMENT_BAN_DELETE_SECONDS)
+      )
+    else:
+      until = datetime.now(timezone.utc) + timedelta(seconds=member.timeout)
+      ok, _ = await self._call(
+        "timeout", bucket, "/guilds/%s/members/%s" % (guild_id, user_id), "PATCH",
+        self.api.update_guild_member_with_http_info, guild_id, str(user_id),
+        UpdateGuildMemberRequest(communication_disabled_until=until)
+      )
+
+    if ok:
+      return list(member.message_ids)
+    if ok is None and member.attempts + 1 < ENFORCEMENT_MAX_ATTEMPTS:
+      member.attempts += 1
+      current = self._members.get((guild_id, user_id))
+      if current is None:
+        self._members[(guild_id, user_id)] = member
+        self._pending += 1
+      else:
+        # Merge with anything that arrived meanwhile
+        current.ban = current.ban or member.ban
+        current.timeout = max(current.timeout, member.timeout)
+        current.message_ids |= member.message_ids
+    return []
+
+  async def _flush(self):
+    now = time.monotonic()
+    calls = []
+
+    for key in list(self._deletes):
+      guild_id, channel_id = key
+      if self._is_blocked("channel:%s" % channel_id, now):
+        continue
+      messages = self._deletes.pop(key)
+      self._pending -= len(messages)
+      ids = list(messages)
+      for start in range(0, len(ids), BULK_DELETE_LIMIT):
+        chunk = {message_id: messages[message_id] for message_id in ids[start:start + BULK_DELETE_LIMIT]}
+        calls.append(self._delete(guild_id, channel_id, chunk))
+
+    for key in list(self._members):
+      guild_id, user_id = key
+      if self._is_blocked("guild:%s" % guild_id, now):
+        continue
+      member = self._members.pop(key)
+      self._pending -= 1
+      calls.append(self._member(guild_id, user_id, member))
+
+    enforcement_pending.set(self._pending)
+    if not calls:
+      return
+
+    enforced = {message_id for done in await asyncio.gather(*calls) for message_id in done}
+    enforcement_pending.set(self._pending)
+
+    if enforced:
+      if self._db is None:
+        self._db = await get_db()
+      await self._db.message.update_many(
+        where={
+          "message_id": {
+            "in": list(enforced)
+          }
+        },
+        data={
+          "Moderated": True
+        }
+      )
+
+  async def _run(self):
+    while True:
+      if not self._pending:
+        self._wakeup.clear()
+        await self._wakeup.wait()
+      await asyncio.sleep(ENFORCEMENT_FLUSH_MS / 1000)
+      try:
+        await self._flush()
+      except Exception as e:
+        print(f"Error flushing enforcement actions: {e}")
+
+  def start(self):
+    if self._task is None:
+      self._task = asyncio.create_task(self._run())
+
+  async def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      try:
+        await self._task
+      except asyncio.CancelledError:
+        pass
+      self._task = None
+    if self._db is not None:
+      await self._db.disconnect()
+      self._db = None
+    self._executor.shutdown(wait=False)
+
+enforcer = Enforcer(DISCORD_BOT_TOKEN) if DISCORD_BOT_TOKEN else None
+
+def submit(settings, guild_id: str, channel_id: str | None, message_id: int, author_id: int) -> list[str]:
+  # Actions queued for this verdict, the HTTP response never waits on Discord
+  if enforcer is None:
+    return []
+  return enforcer.submit(settings, guild_id, channel_id, message_id, author_id)
@@ -0,0 +1,65 @@
+import asyncio
+import os
+from collections import deque
+from dotenv import load_dotenv
+from app.metrics import Counter, Gauge
+
+load_dotenv()
+
+EVENT_BUFFER_SIZE = int(os.getenv('EVENT_BUFFER_SIZE', '100'))
+
+events_published = Counter("aidle_events_published_total", "Dashboard events delivered to subscriber buffers")
+events_dropped = Counter("aidle_events_dropped_total", "Dashboard events dropped from full subscriber buffers")
+subscribers = Gauge("aidle_event_subscribers", "Open dashboard event streams")
+
+class Subscription:
+  def __init__(self, owner_id: str, size: int = EVENT_BUFFER_SIZE):
+    self.owner_id = owner_id
+    # A slow dashboard loses its oldest events rather than growing without bound
+    self.events: deque[tuple[str, dict]] = deque(maxlen=size)
+    self.dropped = 0
+    self.ready = asyncio.Event()
+
+  def push(self, event: tuple[str, dict]):
+    if len(self.events) == self.events.maxlen:
+      self.dropped += 1
+      events_dropped.inc()
+    self.events.append(event)
+    self.ready.set()
+
+  async def drain(self, timeout: float) -> tuple[list[tuple[str, dict]], int]:
+    try:
+      await asyncio.wait_for(self.ready.wait(), timeout)
+    except asyncio.TimeoutError:
+      return [], 0
+
+    self.ready.clear()
+    events = list(self.events)
+    self.events.clear()
+    dropped, self.dropped = self.dropped, 0
+    return events, dropped
+
+# owner_id -> open subscriptions
+_subscriptions: dict[str, set[Subscription]] = {}
+
+def subscribe(owner_id: str) -> Subscription:
+  subscription = Subscription(owner_id)
+  _subscriptions.setdefault(owner_id, set()).add(subscription)
+  subscribers.inc()
+  return subscription
+
+def unsubscribe(subscription: Subscription):
+  owner_subscriptions = _subscriptions.get(subscription.owner_id)
+  if owner_subscriptions is not None:
+    owner_subscriptions.discard(subscription)
+    if not owner_subscriptions:
+      del _subscriptions[subscription.owner_id]
+  subscribers.dec()
+
+def publish(owner_id: str, event: str, data: dict):
+  owner_subscriptions = _subscriptions.get(owner_id)
+  if not owner_subscriptions:
+    return
+  for subscription in owner_subscriptions:
+    subscription.push((event, data))
+    events_published.inc()
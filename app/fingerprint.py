@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import os
+import re
+import time
+import unicodedata
+import zlib
+from collections import deque
+import numpy as np
+from dotenv import load_dotenv
+from app.metrics import Counter, Gauge
+
+load_dotenv()
+
+FINGERPRINT_ENABLED = os.getenv('FINGERPRINT_ENABLED', 'true').lower() == 'true'
+# Only messages scored within this many seconds are reused
+FINGERPRINT_WINDOW = float(os.getenv('FINGERPRINT_WINDOW', '300'))
+FINGERPRINT_MAX_ENTRIES = int(os.getenv('FINGERPRINT_MAX_ENTRIES', '50000'))
+# Estimated Jaccard similarity above which two messages count as the same
+FINGERPRINT_SIMILARITY = float(os.getenv('FINGERPRINT_SIMILARITY', '0.8'))
+# Shorter messages ("gg", "lol") only ever match exactly
+FINGERPRINT_MIN_LENGTH = int(os.getenv('FINGERPRINT_MIN_LENGTH', '20'))
+# Spread across this many guilds or authors inside the window makes it a raid. Reported
+# alongside the verdict, guilds opt in to having it moderate on its own
+RAID_GUILD_THRESHOLD = int(os.getenv('RAID_GUILD_THRESHOLD', '3'))
+RAID_AUTHOR_THRESHOLD = int(os.getenv('RAID_AUTHOR_THRESHOLD', '5'))
+
+SHINGLE_SIZE = 5
+PERMUTATIONS = 64
+BANDS = 16
+ROWS = PERMUTATIONS // BANDS
+_PRIME = (1 << 61) - 1
+
+_rng = np.random.default_rng(0x41d1e)
+_a = _rng.integers(1, 1 << 31, size=(PERMUTATIONS, 1), dtype=np.uint64)
+_b = _rng.integers(0, 1 << 31, size=(PERMUTATIONS, 1), dtype=np.uint64)
+
+dedup_lookups = Counter("aidle_dedup_lookups_total", "Fingerprint lookups ahead of inference", labelnames=("result",))
+dedup_exact = dedup_lookups.labels("exact")
+dedup_near = dedup_lookups.labels("near")
+dedup_miss = dedup_lookups.labels("miss")
+raids_flagged = Counter("aidle_raid_flagged_total", "Messages recognised as raid spam")
+index_size = Gauge("aidle_fingerprint_index_entries", "Recently scored messages held for dedup")
+
+_URL = re.compile(r"https?://\S+")
+_REPEATS = re.compile(r"(.)\1{2,}")
+_NON_WORD = re.compile(r"[\W_]+")
+
+def normalize(text: str) -> str:
+  # Fold the usual evasions: case, width, accents, repeated letters, spacing and punctuation
+  text = unicodedata.normalize("NFKD", text).casefold()
+  text = "".join(c for c in text if not unicodedata.combining(c))
+  text = _URL.sub(lambda m: m.group(0).split("?")[0], text)
+  text = _REPEATS.sub(r"\1\1", text)
+  return _NON_WORD.sub(" ", text).strip()
+
+class Fingerprint:
+  __slots__ = ("exact", "signature", "bands")
+
+  def __init__(self, text: str):
+    normalized = normalize(text)
+    self.exact = hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+    self.signature = None
+    self.bands = ()
+
+    if len(normalized) >= FINGERPRINT_MIN_LENGTH:
+      encoded = normalized.encode()
+      shingles = {zlib.crc32(encoded[i:i + SHINGLE_SIZE]) for i in range(len(encoded) - SHINGLE_SIZE + 1)}
+      hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+      self.signature = ((_a * hashes + _b) % _PRIME).min(axis=1)
+      self.bands = tuple(
+        (band, self.signature[band * ROWS:(band + 1) * ROWS].tobytes()) for band in range(BANDS)
+      )
+
+class Entry:
+  __slots__ = ("fingerprint", "results", "seen_at", "guilds", "authors")
+
+  def __init__(self, fingerprint: Fingerprint, guild_id: str, author_id):
+    self.fingerprint = fingerprint
+    # (version, digest) -> probabilities from those exact weights. Empty while only the cascade
+    # has seen it, its answer depends on the guild so isn't shared. Raids count across versions
+    self.results: dict[tuple, list[tuple[str, float]]] = {}
+    self.seen_at = time.monotonic()
+    self.guilds = {guild_id}
+    self.authors = {(guild_id, author_id)}
+
+  def seen(self, guild_id: str, author_id):
+    self.guilds.add(guild_id)
+    self.authors.add((guild_id, author_id))
+
+  @property
+  def is_raid(self) -> bool:
+    # Short chatter is repeated everywhere legitimately, never call it a raid
+    if self.fingerprint.signature is None:
+      return False
+    return len(self.guilds) >= RAID_GUILD_THRESHOLD or len(self.authors) >= RAID_AUTHOR_THRESHOLD
+
+class FingerprintIndex:
+  def __init__(self):
+    self._exact: dict[bytes, Entry] = {}
+    self._bands: dict[tuple[int, bytes], set[Entry]] = {}
+    self._order: deque[Entry] = deque()
+
+  def _evict(self):
+    cutoff = time.monotonic() - FINGERPRINT_WINDOW
+    while self._order and (self._order[0].seen_at < cutoff or len(self._order) > FINGERPRINT_MAX_ENTRIES):
+      entry = self._order.popleft()
+      if self._exact.get(entry.fingerprint.exact) is entry:
+        del self._exact[entry.fingerprint.exact]
+      for key in entry.fingerprint.bands:
+        bucket = self._bands.get(key)
+        if bucket is not None:
+          bucket.discard(entry)
+          if not bucket:
+            del self._bands[key]
+
+  def match(self, fingerprint: Fingerprint) -> Entry | None:
+    self._evict()
+
+    entry = self._exact.get(fingerprint.exact)
+    if entry is not None:
+      return entry
+
+    if fingerprint.signature is not None:
+      candidates = set()
+      for key in fingerprint.bands:
+        candidates.update(self._bands.get(key, ()))
+      best, best_similarity = None, FINGERPRINT_SIMILARITY
+      for candidate in candidates:
+        similarity = float(np.mean(candidate.fingerprint.signature == fingerprint.signature))
+        if similarity >= best_similarity:
+          best, best_similarity = candidate, similarity
+      return best
+
+    return None
+
+  def add(self, fingerprint: Fingerprint, guild_id: str, author_id) -> Entry:
+    entry = Entry(fingerprint, guild_id, author_id)
+    self._exact[fingerprint.exact] = entry
+    for key in fingerprint.bands:
+      self._bands.setdefault(key, set()).add(entry)
+    self._order.append(entry)
+    self._evict()
+    index_size.set(len(self._order))
+    return entry
+
+index = FingerprintIndex()
+
+# (model key, exact hash) -> entry future for messages currently being scored, so a burst of
+# copies waits on the first forward pass instead of each running its own
+_pending: dict[tuple, asyncio.Future] = {}
+
+def _model_key(model) -> tuple:
+  # A reload changes the digest, so scores from the old weights stop being reused
+  return (model.name, model.digest) if model is not None else ()
+
+async def score(text: str, guild_id: str, author_id, predict, clear=None, model=None) -> tuple[list[tuple[str, float]], bool]:
+  # clear is the cheap first stage, run after the lookup so raids are tracked even for messages it lets through.
+  # model is the version the guild is routed to, probabilities are only reused from those same weights
+  cleared = None
+  if not FINGERPRINT_ENABLED:
+    cleared = clear(text) if clear is not None else None
+    return cleared if cleared is not None else await predict(text), False
+
+  fingerprint = Fingerprint(text)
+  entry = index.match(fingerprint)
+  pending_key = (_model_key(model), fingerprint.exact)
+
+  if entry is None or _model_key(model) not in entry.results:
+    pending = _pending.get(pending_key)
+    if pending is not None:
+      try:
+        entry = await asyncio.shield(pending)
+      except asyncio.CancelledError:
+        if not pending.cancelled():
+          raise
+      except Exception:
+        # The first copy failed, score this one on its own
+        pass
+
+  raid = False
+  if entry is not None:
+    entry.seen(guild_id, author_id)
+    raid = entry.is_raid
+    if raid:
+      raids_flagged.inc()
+    label_prob_pairs = entry.results.get(_model_key(model))
+    if label_prob_pairs is not None:
+      if entry.fingerprint.exact == fingerprint.exact:
+        dedup_exact.inc()
+      else:
+        dedup_near.inc()
+      return label_prob_pairs, raid
+
+  if clear is not None:
+    cleared = clear(text)
+  if cleared is not None:
+    if entry is None:
+      index.add(fingerprint, guild_id, author_id)
+    return cleared, raid
+
+  dedup_miss.inc()
+  future = asyncio.get_running_loop().create_future()
+  _pending[pending_key] = future
+  # Keyed before the call so a reload mid-predict doesn't file old weights under the new digest,
+  # a version loaded on first use only has its digest afterwards
+  model_key = _model_key(model) if model is None or model.digest else None
+  try:
+    label_prob_pairs = await predict(text)
+    if entry is None:
+      entry = index.add(fingerprint, guild_id, author_id)
+    entry.results[model_key or _model_key(model)] = label_prob_pairs
+    future.set_result(entry)
+  except asyncio.CancelledError:
+    future.cancel()
+    raise
+  except Exception as e:
+    future.set_exception(e)
+    # Nobody may be waiting, don't let asyncio warn about it
+    future.exception()
+    raise
+  finally:
+    del _pending[pending_key]
+
+  return label_prob_pairs, raid
@@ -0,0 +1,146 @@
+import asyncio
+import os
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from dotenv import load_dotenv
+from app.metrics import Histogram
+
+load_dotenv()
+
+INFERENCE_MAX_BATCH = int(os.getenv('INFERENCE_MAX_BATCH', '32'))
+INFERENCE_MAX_WAIT_MS = float(os.getenv('INFERENCE_MAX_WAIT_MS', '5'))
+
+inference_duration = Histogram("aidle_inference_duration_seconds", "Model inference time by stage", labelnames=("stage",))
+tokenize_time = inference_duration.labels("tokenize")
+forward_time = inference_duration.labels("forward")
+postprocess_time = inference_duration.labels("postprocess")
+batch_sizes = Histogram("aidle_inference_batch_size", "Messages per model forward pass", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+def _forward(texts: list[str], model, tokenizer, embed: bool):
+  started = perf_counter()
+  inputs = tokenizer(texts, return_tensors="pt", padding=True, truncation=True)
+  tokenized = perf_counter()
+
+  with torch.inference_mode():
+    outputs = model(**inputs, output_hidden_states=embed)
+    logits = outputs.logits
+    vectors = None
+    if embed:
+      # Mean of the last hidden layer over real tokens, unit length so cosine is a dot product
+      mask = inputs["attention_mask"].unsqueeze(-1).to(outputs.hidden_states[-1].dtype)
+      pooled = (outputs.hidden_states[-1] * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+      vectors = torch.nn.functional.normalize(pooled.float(), dim=-1).to(torch.float16).numpy()
+  forwarded = perf_counter()
+
+  # Apply softmax to get probabilities (scores), then pair them with labels
+  probabilities = logits.softmax(dim=-1).tolist()
+  id2label = model.config.id2label
+
+  results = []
+  for row in probabilities:
+    label_prob_pairs = [(id2label[idx], probability) for idx, probability in enumerate(row)]
+    label_prob_pairs.sort(key=lambda item: item[1], reverse=True)
+    results.append(label_prob_pairs)
+  finished = perf_counter()
+
+  tokenize_time.observe(tokenized - started)
+  forward_time.observe(forwarded - tokenized)
+  postprocess_time.observe(finished - forwarded)
+  batch_sizes.observe(len(texts))
+
+  return results, vectors
+
+def predict(texts: list[str], model, tokenizer) -> list[list[tuple[str, float]]]:
+  return _forward(texts, model, tokenizer, False)[0]
+
+def predict_with_embeddings(texts: list[str], model, tokenizer):
+  # Same forward pass, plus a float16 pooled embedding per text
+  return _forward(texts, model, tokenizer, True)
+
+def harmful_probability(label_prob_pairs: list[tuple[str, float]], settings) -> float:
+  # Sum of every label the guild has enabled, "OK" never counts
+  total_probability = 0.0
+  for label, probability in label_prob_pairs:
+    if label != "OK" and getattr(settings, "enable_" + label.lower(), False):
+      total_probability += probability
+  return total_probability
+
+class InferenceBatcher:
+  # Coalesces concurrent predictions into one forward pass, off the event loop
+  def __init__(self, predict_fn, max_batch: int, max_wait: float):
+    self.predict_fn = predict_fn
+    self.max_batch = max_batch
+    self.max_wait = max_wait
+    self._queue: asyncio.Queue | None = None
+    self._task: asyncio.Task | None = None
+    # torch already parallelises a single forward pass, so run one at a time
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+
+  def start(self):
+    if self._task is None:
+      self._queue = asyncio.Queue()
+      self._task = asyncio.create_task(self._run())
+
+  async def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      try:
+        await self._task
+      except asyncio.CancelledError:
+        pass
+      self._task = None
+
+  async def run(self, fn, *args):
+    # Queued behind the batch in progress, so side work like warm-up never competes with it for CPU
+    return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+  async def drain(self):
+    # Forward passes run one at a time on our thread, so this returns once every batch started before it has finished
+    await asyncio.get_running_loop().run_in_executor(self._executor, lambda: None)
+
+  async def predict(self, text: str) -> list[tuple[str, float]]:
+    self.start()
+    future = asyncio.get_running_loop().create_future()
+    await self._queue.put((text, future))
+    return await future
+
+  async def _collect(self) -> list:
+    batch = [await self._queue.get()]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + self.max_wait
+
+    while len(batch) < self.max_batch:
+      if not self._queue.empty():
+        batch.append(self._queue.get_nowait())
+        continue
+      timeout = deadline - loop.time()
+      if timeout <= 0:
+        break
+      try:
+        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+      except asyncio.TimeoutError:
+        break
+
+    return batch
+
+  async def _run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      batch = await self._collect()
+      # Callers that gave up (cancelled) don't need a slot in the forward pass
+      batch = [(text, future) for text, future in batch if not future.done()]
+      if not batch:
+        continue
+
+      try:
+        results = await loop.run_in_executor(self._executor, self.predict_fn, [text for text, _ in batch])
+      except Exception as e:
+        for _, future in batch:
+          if not future.done():
+            future.set_exception(e)
+        continue
+
+      for (_, future), result in zip(batch, results):
+        if not future.done():
+          future.set_result(result)
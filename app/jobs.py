@@ -0,0 +1,175 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from app.dependencies import get_db
+from app.metrics import COUNT_BUCKETS, Counter, Histogram
+from app.moderation import ModerationRequest, moderate
+from app.webhooks import dispatcher
+
+load_dotenv()
+
+# Workers per process draining the queue, 0 leaves it to other processes
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+# Jobs claimed per round trip, scored concurrently so the inference batcher sees them together
+JOB_BATCH_SIZE = int(os.getenv('JOB_BATCH_SIZE', '128'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+# A claimed job that isn't finished by then is handed to another worker
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '120'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# Finished jobs are kept this long for polling
+JOB_RETENTION_HOURS = float(os.getenv('JOB_RETENTION_HOURS', '24'))
+
+jobs_enqueued = Counter("aidle_jobs_enqueued_total", "Moderation jobs accepted in async mode")
+jobs_finished = Counter("aidle_jobs_finished_total", "Moderation jobs finished by the worker pool", labelnames=("status",))
+jobs_done = jobs_finished.labels("done")
+jobs_failed = jobs_finished.labels("failed")
+jobs_retried = jobs_finished.labels("retried")
+job_wait = Histogram("aidle_job_wait_seconds", "Time from enqueue to claim", buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+job_batch_sizes = Histogram("aidle_job_batch_size", "Jobs claimed per worker round trip", buckets=COUNT_BUCKETS)
+
+# Oldest first, including jobs whose worker died holding them
+CLAIM_SQL = '''
+  UPDATE "ModerationJob" SET
+    "status" = 'running',
+    "attempts" = "attempts" + 1,
+    "locked_until" = now() + make_interval(secs => $2),
+    "updated_date" = now()
+  WHERE "id" IN (
+    SELECT "id" FROM "ModerationJob"
+    WHERE "status" = 'queued' OR ("status" = 'running' AND "locked_until" < now())
+    ORDER BY "created_date"
+    LIMIT $1
+    FOR UPDATE SKIP LOCKED
+  )
+  RETURNING "id", "request", "callback_url", "authenticated", "attempts", EXTRACT(EPOCH FROM now() - "created_date") AS "waited"
+'''
+
+_wakeup = asyncio.Event()
+_workers: list[asyncio.Task] = []
+
+async def enqueue(db, item: ModerationRequest, callback_url: str | None, authenticated: bool = False) -> str:
+  job = await db.moderationjob.create(
+    data={
+      "request": item.model_dump_json(),
+      "callback_url": callback_url,
+      "authenticated": authenticated
+    }
+  )
+  jobs_enqueued.inc()
+  # Our own workers don't need to wait for their next poll
+  _wakeup.set()
+  return job.id
+
+def serialize(job) -> dict:
+  response = {
+    "job_id": job.id,
+    "status": job.status,
+    "created_date": job.created_date.isoformat(),
+    "updated_date": job.updated_date.isoformat()
+  }
+  if job.result is not None:
+    response["result"] = json.loads(job.result)
+  if job.error is not None:
+    response["error"] = job.error
+    response["status_code"] = job.status_code
+  return response
+
+async def _run(db, job: dict) -> dict:
+  request = job["request"]
+  if isinstance(request, str):
+    request = json.loads(request)
+
+  try:
+    item = ModerationRequest.model_validate(request)
+    result = await moderate(db, item, job["authenticated"])
+    return {"status": "done", "result": {"message_id": item.metadata.message_id, **result}}
+  except HTTPException as e:
+    # Answers like "guild not found" or the daily plan limit won't change on a retry
+    return {"status": "failed", "error": e.detail, "status_code": e.status_code}
+  except Exception as e:
+    print(f"Error running moderation job {job['id']}: {e}")
+    if job["attempts"] < JOB_MAX_ATTEMPTS:
+      return {"status": "queued", "locked_until": None}
+    return {"status": "failed", "error": "Moderation failed", "status_code": 500}
+
+async def _drain(db) -> int:
+  claimed = await db.query_raw(CLAIM_SQL, JOB_BATCH_SIZE, JOB_LEASE_SECONDS)
+  if not claimed:
+    return 0
+
+  job_batch_sizes.observe(len(claimed))
+  for job in claimed:
+    job_wait.observe(float(job["waited"]))
+
+  outcomes = await asyncio.gather(*(_run(db, job) for job in claimed))
+
+  async with db.batch_() as batcher:
+    for job, outcome in zip(claimed, outcomes):
+      data = {**outcome, "updated_date": datetime.now()}
+      if "result" in data:
+        data["result"] = json.dumps(data["result"])
+      batcher.moderationjob.update(
+        where={"id": job["id"]},
+        data=data
+      )
+
+  for job, outcome in zip(claimed, outcomes):
+    if outcome["status"] == "queued":
+      jobs_retried.inc()
+      continue
+    (jobs_done if outcome["status"] == "done" else jobs_failed).inc()
+    payload = {"job_id": job["id"], "status": outcome["status"]}
+    if outcome["status"] == "done":
+      payload["result"] = outcome["result"]
+    else:
+      payload["error"], payload["status_code"] = outcome["error"], outcome["status_code"]
+    if job["callback_url"]:
+      # Batched per destination with the other verdicts headed there
+      dispatcher.send(job["callback_url"], payload)
+
+  return len(claimed)
+
+async def _cleanup(db):
+  await db.moderationjob.delete_many(
+    where={
+      "status": {"in": ["done", "failed"]},
+      "updated_date": {"lt": datetime.now() - timedelta(hours=JOB_RETENTION_HOURS)}
+    }
+  )
+
+async def _worker(index: int):
+  db = await get_db()
+  rounds = 0
+  try:
+    while True:
+      try:
+        claimed = await _drain(db)
+        rounds += 1
+        if index == 0 and rounds % 1000 == 1:
+          await _cleanup(db)
+      except Exception as e:
+        print(f"Error draining moderation jobs: {e}")
+        claimed = 0
+
+      # A full batch means there's probably more waiting
+      if claimed < JOB_BATCH_SIZE:
+        _wakeup.clear()
+        try:
+          await asyncio.wait_for(_wakeup.wait(), JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+          pass
+  finally:
+    await db.disconnect()
+
+def start():
+  if not _workers:
+    _workers.extend(asyncio.create_task(_worker(index)) for index in range(JOB_WORKERS))
+
+async def stop():
+  for task in _workers:
+    task.cancel()
+  await asyncio.gather(*_workers, return_exceptions=True)
+  _workers.clear()
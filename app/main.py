@@ -1,4 +1,5 @@
 import os
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
@@ -10,8 +11,53 @@ from .routes import discord
 from .routes import me
 from .routes import messages
 from .routes import test
+from .routes import events
+from .routes import models
+from .routes import embeddings
+from .routes import webhooks as webhook_routes
+from .routes import risk as risk_routes
+from . import authorization
+from . import credentials
+from . import discord_client
+from . import enforcement
+from . import jobs
+from . import metrics
+from . import ratelimit
+from . import registry
+from . import result_cache
+from . import risk
+from . import sessions
+from . import tracing
+from . import webhooks
 
-api = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  metrics.instrument_routes(app)
+  try:
+    await authorization.warm()
+  except Exception as e:
+    print(f"Failed to warm guild authorization index: {e}")
+  credentials.start()
+  sessions.start()
+  registry.registry.start()
+  jobs.start()
+  risk.start()
+  ratelimit.start()
+  yield
+  await jobs.stop()
+  await risk.stop()
+  await webhooks.dispatcher.stop()
+  if enforcement.enforcer is not None:
+    await enforcement.enforcer.stop()
+  await registry.registry.stop()
+  await credentials.stop()
+  await sessions.stop()
+  await ratelimit.stop()
+  await discord_client.close_client()
+  if result_cache.result_cache is not None:
+    result_cache.result_cache.close()
+
+api = FastAPI(lifespan=lifespan)
 load_dotenv()
 
 origins = [
@@ -26,6 +72,12 @@ api.add_middleware(
   allow_headers=["*"],
 )
 
+if tracing.DB_TRACE != 'off':
+  api.add_middleware(tracing.QueryTraceMiddleware)
+
+# Added last so it runs first, ahead of any DB or model work
+api.add_middleware(ratelimit.RateLimitMiddleware)
+
 api.include_router(moderation.router)
 api.include_router(guild.router)
 api.include_router(auth.router)
@@ -33,6 +85,12 @@ api.include_router(discord.router)
 api.include_router(me.router)
 api.include_router(messages.router)
 api.include_router(test.router)
+api.include_router(events.router)
+api.include_router(models.router)
+api.include_router(embeddings.router)
+api.include_router(webhook_routes.router)
+api.include_router(risk_routes.router)
+api.include_router(metrics.router)
 
 @api.get("/")
 async def root():
@@ -0,0 +1,233 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRoute
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+_registry = []
+
+class _CounterChild:
+  __slots__ = ("value",)
+
+  def __init__(self):
+    self.value = 0.0
+
+  def inc(self, amount: float = 1.0):
+    self.value += amount
+
+class Counter:
+  def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = labelnames
+    self._children = {}
+    if not labelnames:
+      self._children[()] = _CounterChild()
+    _registry.append(self)
+
+  def labels(self, *values) -> _CounterChild:
+    child = self._children.get(values)
+    if child is None:
+      child = self._children[values] = _CounterChild()
+    return child
+
+  def inc(self, amount: float = 1.0):
+    self._children[()].inc(amount)
+
+  def render(self):
+    yield "# HELP %s %s" % (self.name, self.documentation)
+    yield "# TYPE %s counter" % self.name
+    for values, child in self._children.items():
+      labels = ",".join('%s="%s"' % pair for pair in zip(self.labelnames, values))
+      yield "%s%s %s" % (self.name, "{%s}" % labels if labels else "", child.value)
+
+class _GaugeChild:
+  __slots__ = ("value",)
+
+  def __init__(self):
+    self.value = 0.0
+
+  def inc(self, amount: float = 1.0):
+    self.value += amount
+
+  def dec(self, amount: float = 1.0):
+    self.value -= amount
+
+  def set(self, value: float):
+    self.value = value
+
+class Gauge:
+  def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = labelnames
+    self._children = {}
+    if not labelnames:
+      self._children[()] = _GaugeChild()
+    _registry.append(self)
+
+  def labels(self, *values) -> _GaugeChild:
+    child = self._children.get(values)
+    if child is None:
+      child = self._children[values] = _GaugeChild()
+    return child
+
+  def inc(self, amount: float = 1.0):
+    self._children[()].inc(amount)
+
+  def dec(self, amount: float = 1.0):
+    self._children[()].dec(amount)
+
+  def set(self, value: float):
+    self._children[()].set(value)
+
+  def render(self):
+    yield "# HELP %s %s" % (self.name, self.documentation)
+    yield "# TYPE %s gauge" % self.name
+    for values, child in self._children.items():
+      labels = ",".join('%s="%s"' % pair for pair in zip(self.labelnames, values))
+      yield "%s%s %s" % (self.name, "{%s}" % labels if labels else "", child.value)
+
+class _HistogramChild:
+  __slots__ = ("buckets", "counts", "sum", "count")
+
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value: float):
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+class Histogram:
+  def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = labelnames
+    self.buckets = tuple(sorted(buckets))
+    self._children = {}
+    if not labelnames:
+      self._children[()] = _HistogramChild(self.buckets)
+    _registry.append(self)
+
+  def labels(self, *values) -> _HistogramChild:
+    child = self._children.get(values)
+    if child is None:
+      child = self._children[values] = _HistogramChild(self.buckets)
+    return child
+
+  def observe(self, value: float):
+    self._children[()].observe(value)
+
+  def render(self):
+    yield "# HELP %s %s" % (self.name, self.documentation)
+    yield "# TYPE %s histogram" % self.name
+    for values, child in self._children.items():
+      labels = ",".join('%s="%s"' % pair for pair in zip(self.labelnames, values))
+      prefix = labels + "," if labels else ""
+      cumulative = 0
+      for bound, count in zip(self.buckets, child.counts):
+        cumulative += count
+        yield '%s_bucket{%sle="%s"} %d' % (self.name, prefix, bound, cumulative)
+      yield '%s_bucket{%sle="+Inf"} %d' % (self.name, prefix, child.count)
+      suffix = "{%s}" % labels if labels else ""
+      yield "%s_sum%s %s" % (self.name, suffix, child.sum)
+      yield "%s_count%s %d" % (self.name, suffix, child.count)
+
+def percentile(values: list[float], pct: float) -> float:
+  if not values:
+    return 0.0
+  ordered = sorted(values)
+  index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+  return ordered[index]
+
+def latency_summary(latencies: list[float]) -> dict:
+  return {
+    "count": len(latencies),
+    "p50_ms": percentile(latencies, 50) * 1000,
+    "p95_ms": percentile(latencies, 95) * 1000,
+    "p99_ms": percentile(latencies, 99) * 1000,
+    "max_ms": max(latencies, default=0.0) * 1000
+  }
+
+def render() -> str:
+  lines = []
+  for metric in _registry:
+    lines.extend(metric.render())
+  return "\n".join(lines) + "\n"
+
+request_latency = Histogram("aidle_http_request_duration_seconds", "HTTP request latency by route", labelnames=("method", "route", "status"))
+requests_in_flight = Gauge("aidle_http_requests_in_flight", "HTTP requests currently being handled", labelnames=("method", "route"))
+db_queries_per_request = Histogram("aidle_db_queries_per_request", "DB queries issued per HTTP request", labelnames=("method", "route"), buckets=COUNT_BUCKETS)
+db_time_per_request = Histogram("aidle_db_time_per_request_seconds", "Total DB time per HTTP request", labelnames=("method", "route"))
+db_query_duration = Histogram("aidle_db_query_duration_seconds", "DB query latency by model and action", labelnames=("model", "action"))
+upstream_latency = Histogram("aidle_upstream_request_duration_seconds", "Discord API latency by route", labelnames=("method", "route", "status"))
+cache_requests = Counter("aidle_cache_requests_total", "Cache lookups by cache and result", labelnames=("cache", "result"))
+
+class RequestStats:
+  __slots__ = ("queries", "query_time")
+
+  def __init__(self):
+    self.queries = 0
+    self.query_time = 0.0
+
+request_stats: ContextVar[RequestStats | None] = ContextVar("aidle_request_stats", default=None)
+
+def cache_counters(cache: str):
+  return cache_requests.labels(cache, "hit"), cache_requests.labels(cache, "miss")
+
+def record_query(model: str, action: str, duration: float):
+  db_query_duration.labels(model, action).observe(duration)
+  stats = request_stats.get()
+  if stats is not None:
+    stats.queries += 1
+    stats.query_time += duration
+
+def _instrument(app, method: str, route: str):
+  # Every label set for this route is resolved once, up front
+  latency = [request_latency.labels(method, route, "%dxx" % i) for i in range(6)]
+  in_flight = requests_in_flight.labels(method, route)
+  queries = db_queries_per_request.labels(method, route)
+  query_time = db_time_per_request.labels(method, route)
+
+  async def instrumented(scope, receive, send):
+    status = 500
+
+    async def send_with_status(message):
+      nonlocal status
+      if message["type"] == "http.response.start":
+        status = message["status"]
+      await send(message)
+
+    stats = RequestStats()
+    token = request_stats.set(stats)
+    in_flight.inc()
+    started = perf_counter()
+    try:
+      await app(scope, receive, send_with_status)
+    finally:
+      in_flight.dec()
+      latency[min(status // 100, 5)].observe(perf_counter() - started)
+      queries.observe(stats.queries)
+      query_time.observe(stats.query_time)
+      request_stats.reset(token)
+
+  return instrumented
+
+def instrument_routes(app):
+  for route in app.routes:
+    if isinstance(route, APIRoute) and route.path != "/metrics":
+      route.app = _instrument(route.app, ",".join(sorted(route.methods)), route.path)
+
+router = APIRouter()
+
+@router.get("/metrics", tags=["metrics"], response_class=PlainTextResponse)
+async def get_metrics():
+  return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
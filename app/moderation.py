@@ -0,0 +1,145 @@
+from functools import partial
+from app import cascade, embeddings, enforcement, events, fingerprint, ratelimit, risk
+from app.inference import harmful_probability
+from app.registry import registry
+from datetime import datetime
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+class ModerationRequestMetaData(BaseModel):
+  message_id: int
+  author_id: int
+  author_name: str
+  guild_id: str
+  # Needed to delete the message when server-side enforcement is on
+  channel_id: str | None = None
+
+class ModerationRequest(BaseModel):
+  input_text: str
+  metadata: ModerationRequestMetaData
+
+async def moderate(db, item: ModerationRequest, authenticated: bool = False) -> dict:
+  metadata = item.metadata
+
+  # Check to see if they've hit their plan limit
+  guild = await db.guild.find_unique(
+    where={
+      "guild_id": metadata.guild_id
+    },
+    include={
+      "owner": True
+    }
+  )
+
+  settings = await db.settings.find_unique(
+    where={
+      "guild_id": metadata.guild_id
+    }
+  )
+  
+  if not guild or not guild.owner or not settings:
+    raise HTTPException(status_code=404, detail="Guild not found")
+
+  owner = guild.owner
+
+  plan = await db.plan.find_unique(
+    where={
+      "id": owner.plan_id
+    }
+  )
+
+  all_guilds = await db.guild.find_many(
+    where={
+      "owner_id": owner.owner_id
+    }
+  )
+  guildIds = []
+
+  for x in range(len(all_guilds)):
+    guildIds.append(all_guilds[x].guild_id)
+
+  messages = await db.message.find_many(
+    where={
+      "created_date": {
+        "gte": datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+      },
+      "guild_id": {
+        "in": guildIds
+      }
+    }
+  )
+
+  ratelimit.set_guild_plan(metadata.guild_id, plan.max_requests)
+
+  if len(messages) + 1 > plan.max_requests:
+    raise HTTPException(status_code=429, detail="You are rate limited until midnight.")
+
+  # Recently scored copies reuse their probabilities and widespread ones are raids. Otherwise obvious
+  # chatter is cleared by the cheap first stage and everything else goes to the transformer
+  predict = partial(registry.predict, guild_id=metadata.guild_id)
+  clear = partial(cascade.clear, settings=settings)
+  label_prob_pairs, raid = await fingerprint.score(
+    item.input_text, metadata.guild_id, metadata.author_id, predict, clear, registry.route(metadata.guild_id)
+  )
+  total_probability = harmful_probability(label_prob_pairs, settings)
+  confidence_limit = settings.confidence_limit
+
+  # Prepare the response
+  response = [{"label": label, "probability": probability} for label, probability in label_prob_pairs]
+
+  # Store the response in the database
+  message = await db.message.create(
+    data={
+      "message_id": metadata.message_id,
+      "guild_id": metadata.guild_id,
+      "author_id": metadata.author_id,
+      "author_name": metadata.author_name,
+      "channel_id": metadata.channel_id,
+      "score": total_probability
+    }
+  )
+
+  # Copy-pasted text is often harmless, so a raid alone only moderates where the guild asked for it
+  moderated = total_probability >= (confidence_limit / 100) or (raid and settings.moderate_raids)
+
+  # Repeat offenders stand out without scanning their message history
+  author_risk = await risk.record(metadata.guild_id, metadata.author_id, metadata.author_name, total_probability, moderated)
+
+  # Queued, not awaited; Message.Moderated flips once Discord confirms. Only the bot's own
+  # requests are acted on, and only in guilds it is still in
+  enforced = []
+  if moderated and authenticated and guild.moderate:
+    enforced = enforcement.submit(settings, metadata.guild_id, metadata.channel_id, metadata.message_id, metadata.author_id)
+
+  # Keep the pooled embedding from the forward pass for similarity search
+  if embeddings.EMBEDDINGS_ENABLED:
+    version = registry.route(metadata.guild_id).name
+    vector = embeddings.lookup(version, item.input_text)
+    if vector is not None:
+      embeddings.add(metadata.guild_id, version, metadata.message_id, metadata.author_id, vector)
+
+  # Push the delta to any open dashboards for this owner
+  events.publish(owner.owner_id, "message", {
+    "message_id": str(message.message_id),
+    "guild_id": message.guild_id,
+    "author_id": str(message.author_id),
+    "author_name": message.author_name,
+    "score": message.score,
+    "moderate": moderated,
+    "author_risk": author_risk,
+    "created_date": message.created_date.isoformat()
+  })
+  events.publish(owner.owner_id, "counters", {
+    "guild_id": message.guild_id,
+    "messages_today": len(messages) + 1,
+    "max_requests": plan.max_requests
+  })
+
+  return {
+    "results": response,
+    "moderate": moderated,
+    "moderation_message": settings.moderation_message,
+    "raid": raid,
+    "enforced": enforced,
+    "author_risk": author_risk
+  }
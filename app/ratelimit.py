@@ -0,0 +1,257 @@
+import asyncio
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from dotenv import load_dotenv
+from app.dependencies import get_db
+from app.metrics import Counter
+
+load_dotenv()
+
+# "memory" keeps buckets per worker, "postgres" shares them across workers
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_SHARDS = int(os.getenv('RATE_LIMIT_SHARDS', '16'))
+# Seconds between deleting Postgres buckets that have fully refilled
+RATE_LIMIT_PURGE_INTERVAL = float(os.getenv('RATE_LIMIT_PURGE_INTERVAL', '300'))
+
+# Default (capacity, refill per second) for each scope
+DEFAULT_LIMITS = {
+  "guild": (float(os.getenv('GUILD_BUCKET_CAPACITY', '50')), float(os.getenv('GUILD_BUCKET_RATE', '10'))),
+  "author": (float(os.getenv('AUTHOR_BUCKET_CAPACITY', '10')), float(os.getenv('AUTHOR_BUCKET_RATE', '1')))
+}
+
+# Per-plan overrides keyed by the plan's max_requests, e.g.
+# {"1000": {"guild": [200, 50], "author": [20, 2]}}; the largest key <= max_requests applies
+RATE_LIMIT_TIERS = {
+  int(max_requests): {scope: tuple(limits) for scope, limits in tier.items()}
+  for max_requests, tier in json.loads(os.getenv('RATE_LIMIT_TIERS', '{}')).items()
+}
+
+rate_limited = Counter("aidle_rate_limited_total", "Requests rejected by the edge rate limiter", labelnames=("scope",))
+guild_limited = rate_limited.labels("guild")
+author_limited = rate_limited.labels("author")
+rate_limit_errors = Counter("aidle_rate_limit_errors_total", "Rate limit checks let through because the bucket backend failed")
+
+def _gcra(limits: tuple[float, float]) -> tuple[float, float]:
+  # A token bucket of `capacity` refilled at `rate`/s, expressed as GCRA:
+  # one emission interval per request and a burst tolerance of capacity - 1 intervals
+  capacity, rate = limits
+  interval = 1 / rate
+  return interval, (capacity - 1) * interval
+
+class BucketBackend(ABC):
+  # Returns 0 when the request may proceed, otherwise seconds until it would
+  @abstractmethod
+  async def take(self, key: str, interval: float, tolerance: float) -> float:
+    ...
+
+class MemoryBucketBackend(BucketBackend):
+  def __init__(self, shards: int = RATE_LIMIT_SHARDS):
+    self._shards: list[dict[str, float]] = [{} for _ in range(shards)]
+    self._calls = 0
+    self._sweep_shard = 0
+
+  async def take(self, key: str, interval: float, tolerance: float) -> float:
+    now = time.monotonic()
+    shard = self._shards[hash(key) % len(self._shards)]
+
+    # Theoretical arrival time of the next request
+    tat = shard.get(key, now)
+    if tat < now:
+      tat = now
+    if tat - now > tolerance:
+      return tat - now - tolerance
+    shard[key] = tat + interval
+
+    # Amortised cleanup: every so often drop the full buckets from one shard
+    self._calls += 1
+    if self._calls & 1023 == 0:
+      self._sweep(now)
+
+    return 0.0
+
+  def _sweep(self, now: float):
+    shard = self._shards[self._sweep_shard]
+    self._sweep_shard = (self._sweep_shard + 1) % len(self._shards)
+    for key in [key for key, tat in shard.items() if tat <= now]:
+      del shard[key]
+
+class PostgresBucketBackend(BucketBackend):
+  # Single-statement atomic GCRA update, so every worker sees the same buckets
+  SQL = '''
+    INSERT INTO "RateLimitBucket" ("key", "tat", "allowed") VALUES ($1, $2 + $3, true)
+    ON CONFLICT ("key") DO UPDATE SET
+      "allowed" = GREATEST("RateLimitBucket"."tat", $2) - $2 <= $4,
+      "tat" = CASE
+        WHEN GREATEST("RateLimitBucket"."tat", $2) - $2 <= $4 THEN GREATEST("RateLimitBucket"."tat", $2) + $3
+        ELSE "RateLimitBucket"."tat"
+      END
+    RETURNING "tat", "allowed"
+  '''
+
+  # A bucket whose arrival time has passed is full, the same as having no row at all
+  PURGE_SQL = 'DELETE FROM "RateLimitBucket" WHERE "tat" < $1'
+
+  def __init__(self):
+    self._db = None
+    self._lock = asyncio.Lock()
+
+  async def _connect(self):
+    # Concurrent first requests would otherwise each open a client
+    async with self._lock:
+      if self._db is None:
+        self._db = await get_db()
+    return self._db
+
+  async def take(self, key: str, interval: float, tolerance: float) -> float:
+    db = self._db or await self._connect()
+
+    now = time.time()
+    row = await db.query_first(self.SQL, key, now, interval, tolerance)
+    if row["allowed"]:
+      return 0.0
+    return max(row["tat"] - now - tolerance, 0.0)
+
+  async def purge(self) -> int:
+    db = self._db or await self._connect()
+    # "tat" is epoch seconds, not a timestamp, so compare against time.time() rather than now()
+    return await db.execute_raw(self.PURGE_SQL, time.time())
+
+  async def close(self):
+    async with self._lock:
+      if self._db is not None:
+        await self._db.disconnect()
+        self._db = None
+
+def _build_backend() -> BucketBackend:
+  if RATE_LIMIT_BACKEND == 'postgres':
+    return PostgresBucketBackend()
+  return MemoryBucketBackend()
+
+backend = _build_backend()
+
+_task: asyncio.Task | None = None
+
+async def _purge_loop(backend: PostgresBucketBackend):
+  while True:
+    await asyncio.sleep(RATE_LIMIT_PURGE_INTERVAL)
+    try:
+      await backend.purge()
+    except Exception as e:
+      print(f"Error purging rate limit buckets: {e}")
+
+def start():
+  # Memory buckets are swept as they're used, only the shared table needs this
+  global _task
+  if _task is None and isinstance(backend, PostgresBucketBackend):
+    _task = asyncio.create_task(_purge_loop(backend))
+
+async def stop():
+  global _task
+  if _task is not None:
+    _task.cancel()
+    try:
+      await _task
+    except asyncio.CancelledError:
+      pass
+    _task = None
+  if isinstance(backend, PostgresBucketBackend):
+    await backend.close()
+
+# guild_id -> plan max_requests, learned from the moderation path
+_guild_plans: dict[str, int] = {}
+_tiers = sorted(RATE_LIMIT_TIERS)
+_default_gcra = {scope: _gcra(limits) for scope, limits in DEFAULT_LIMITS.items()}
+_tier_gcra = {
+  max_requests: {scope: _gcra(tier.get(scope, DEFAULT_LIMITS[scope])) for scope in DEFAULT_LIMITS}
+  for max_requests, tier in RATE_LIMIT_TIERS.items()
+}
+
+def set_guild_plan(guild_id: str, max_requests: int):
+  _guild_plans[guild_id] = max_requests
+
+def _limits_for(guild_id: str) -> dict[str, tuple[float, float]]:
+  max_requests = _guild_plans.get(guild_id)
+  if max_requests is None:
+    return _default_gcra
+  tier = None
+  for threshold in _tiers:
+    if threshold > max_requests:
+      break
+    tier = threshold
+  return _default_gcra if tier is None else _tier_gcra[tier]
+
+async def _take(key: str, limits: tuple[float, float]) -> float:
+  try:
+    return await backend.take(key, *limits)
+  except Exception as e:
+    # Fail open, an unreachable limiter mustn't turn every moderation request into a 500
+    rate_limit_errors.inc()
+    print(f"Error checking rate limit {key}: {e}")
+    return 0.0
+
+async def check(guild_id: str, author_id) -> float:
+  limits = _limits_for(guild_id)
+
+  # Author first, so a single raider can't drain the guild's whole bucket
+  retry_after = await _take("a:%s:%s" % (guild_id, author_id), limits["author"])
+  if retry_after:
+    author_limited.inc()
+    return retry_after
+
+  retry_after = await _take("g:%s" % guild_id, limits["guild"])
+  if retry_after:
+    guild_limited.inc()
+  return retry_after
+
+class RateLimitMiddleware:
+  def __init__(self, app, paths: tuple[str, ...] = ("/moderate",)):
+    self.app = app
+    self.paths = paths
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+      await self.app(scope, receive, send)
+      return
+
+    chunks = []
+    while True:
+      message = await receive()
+      if message["type"] != "http.request":
+        # Client went away before sending the whole body
+        return
+      chunks.append(message.get("body", b""))
+      if not message.get("more_body", False):
+        break
+    body = b"".join(chunks)
+
+    try:
+      metadata = json.loads(body)["metadata"]
+      retry_after = await check(str(metadata["guild_id"]), metadata["author_id"])
+    except (ValueError, KeyError, TypeError):
+      # Malformed bodies are the endpoint's problem, it will answer 422
+      retry_after = 0.0
+
+    if retry_after:
+      await send({
+        "type": "http.response.start",
+        "status": 429,
+        "headers": [
+          (b"content-type", b"application/json"),
+          (b"retry-after", str(max(1, round(retry_after))).encode())
+        ]
+      })
+      await send({"type": "http.response.body", "body": b'{"detail":"Rate limited"}'})
+      return
+
+    replayed = False
+
+    async def replay():
+      nonlocal replayed
+      if not replayed:
+        replayed = True
+        return {"type": "http.request", "body": body, "more_body": False}
+      return await receive()
+
+    await self.app(scope, replay, send)
@@ -0,0 +1,368 @@
+import asyncio
+import gc
+import hashlib
+import itertools
+import json
+import os
+import random
+from collections import deque
+from time import monotonic, perf_counter
+import torch
+from dotenv import load_dotenv
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from watchfiles import awatch
+from app import embeddings
+from app.inference import INFERENCE_MAX_BATCH, INFERENCE_MAX_WAIT_MS, InferenceBatcher, predict, predict_with_embeddings
+from app.metrics import Counter, Gauge, Histogram, latency_summary
+from app.result_cache import model_digest, result_cache
+
+load_dotenv()
+
+# The model at MODEL_PATH is always loaded and serves anything not routed elsewhere
+MODEL_DEFAULT_VERSION = os.getenv('MODEL_DEFAULT_VERSION', 'default')
+# Extra versions, loaded on first use: {"v2": "/models/v2"} or {"v2": {"model": ..., "tokenizer": ...}}
+MODEL_VERSIONS = json.loads(os.getenv('MODEL_VERSIONS', '{}'))
+# Guilds pinned to a version: {"<guild_id>": "v2"}
+MODEL_GUILD_ROUTES = json.loads(os.getenv('MODEL_GUILD_ROUTES', '{}'))
+# Percentage of guilds sent to each version: {"v2": 10}, a guild always lands in the same bucket
+MODEL_TRAFFIC_SPLIT = json.loads(os.getenv('MODEL_TRAFFIC_SPLIT', '{}'))
+# Candidate scored in the background for comparison, never affects verdicts
+MODEL_SHADOW = os.getenv('MODEL_SHADOW')
+MODEL_SHADOW_RATE = float(os.getenv('MODEL_SHADOW_RATE', '0.05'))
+MODEL_SHADOW_MAX_IN_FLIGHT = int(os.getenv('MODEL_SHADOW_MAX_IN_FLIGHT', '32'))
+# Weights held across all versions, least recently used idle versions go first (0 = unlimited)
+MODEL_MEMORY_BUDGET_MB = float(os.getenv('MODEL_MEMORY_BUDGET_MB', '0'))
+MODEL_LATENCY_WINDOW = int(os.getenv('MODEL_LATENCY_WINDOW', '1000'))
+# Reload a resident version when files under its model path change
+MODEL_WATCH = os.getenv('MODEL_WATCH', 'false').lower() == 'true'
+# Changes are grouped until the directory has been quiet this long, so half-copied weights aren't loaded
+MODEL_WATCH_SETTLE_MS = int(os.getenv('MODEL_WATCH_SETTLE_MS', '1000'))
+MODEL_WATCH_DEBOUNCE_MS = int(os.getenv('MODEL_WATCH_DEBOUNCE_MS', '10000'))
+
+# Run through a new engine before it takes traffic, at both ends of the batch range
+WARMUP_TEXTS = ["hello everyone", "anyone up for a game tonight? this is a slightly longer message to warm up padding"]
+
+model_requests = Counter("aidle_model_requests_total", "Predictions served per model version", labelnames=("version",))
+model_latency = Histogram("aidle_model_latency_seconds", "Prediction latency per model version, batching included", labelnames=("version",))
+model_memory = Gauge("aidle_model_memory_bytes", "Weights held in memory per model version", labelnames=("version",))
+model_loads = Counter("aidle_model_loads_total", "Model versions loaded", labelnames=("version",))
+model_evictions = Counter("aidle_model_evictions_total", "Model versions evicted under memory pressure", labelnames=("version",))
+shadow_comparisons = Counter("aidle_shadow_comparisons_total", "Shadow predictions compared with the served one", labelnames=("version", "result"))
+model_reloads = Counter("aidle_model_reloads_total", "Hot model reloads", labelnames=("version", "result"))
+shadow_dropped = Counter("aidle_shadow_dropped_total", "Shadow predictions skipped because too many were already running")
+
+def model_bytes(model) -> int:
+  return sum(tensor.numel() * tensor.element_size() for tensor in itertools.chain(model.parameters(), model.buffers()))
+
+def model_labels(model) -> list[str]:
+  id2label = model.config.id2label
+  return [id2label[idx] for idx in range(len(id2label))]
+
+def load_engine(model_path: str, tokenizer_path: str) -> tuple:
+  model = AutoModelForSequenceClassification.from_pretrained(model_path).eval()
+  tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+  return model, tokenizer
+
+class ModelVersion:
+  def __init__(self, name: str, model_path: str, tokenizer_path: str, engine: tuple | None = None):
+    self.name = name
+    self.model_path = model_path
+    self.tokenizer_path = tokenizer_path
+    # (model, tokenizer), None until first use or after eviction
+    self.engine = engine
+    self.memory_bytes = model_bytes(engine[0]) if engine else 0
+    # Identifies these exact weights in the disk result cache, alongside their label order
+    self.digest = model_digest(model_path, tokenizer_path) if engine else None
+    self.labels = model_labels(engine[0]) if engine else []
+    self.batcher = InferenceBatcher(self._predict, INFERENCE_MAX_BATCH, INFERENCE_MAX_WAIT_MS / 1000)
+    self.in_flight = 0
+    self.last_used = monotonic()
+    self.latencies: deque[float] = deque(maxlen=MODEL_LATENCY_WINDOW)
+    self.requests = model_requests.labels(name)
+    self.latency = model_latency.labels(name)
+    self.memory = model_memory.labels(name)
+    self.memory.set(self.memory_bytes)
+    # Shadow agreement against whichever version served the request
+    self.compared = 0
+    self.agreed = 0
+    self.harmful_delta = 0.0
+    self._lock = asyncio.Lock()
+
+  def _predict(self, texts: list[str]) -> list[list[tuple[str, float]]]:
+    model, tokenizer = self.engine
+    if embeddings.EMBEDDINGS_ENABLED:
+      results, vectors = predict_with_embeddings(texts, model, tokenizer)
+      embeddings.remember(self.name, texts, vectors)
+      return results
+    return predict(texts, model, tokenizer)
+
+  async def _warm(self, engine: tuple):
+    model, tokenizer = engine
+    warm = predict_with_embeddings if embeddings.EMBEDDINGS_ENABLED else predict
+    # On the inference thread, one pass at a time between live batches
+    await self.batcher.run(warm, WARMUP_TEXTS[:1], model, tokenizer)
+    await self.batcher.run(warm, (WARMUP_TEXTS * INFERENCE_MAX_BATCH)[:INFERENCE_MAX_BATCH], model, tokenizer)
+
+  async def load(self):
+    async with self._lock:
+      if self.engine is not None:
+        return
+      loop = asyncio.get_running_loop()
+      engine = await loop.run_in_executor(None, load_engine, self.model_path, self.tokenizer_path)
+      digest = await loop.run_in_executor(None, model_digest, self.model_path, self.tokenizer_path)
+      self.engine, self.digest, self.labels = engine, digest, model_labels(engine[0])
+      self.memory_bytes = model_bytes(self.engine[0])
+      self.memory.set(self.memory_bytes)
+      model_loads.labels(self.name).inc()
+
+  async def reload(self, model_path: str | None = None, tokenizer_path: str | None = None):
+    async with self._lock:
+      model_path = model_path or self.model_path
+      tokenizer_path = tokenizer_path or self.tokenizer_path
+      if self.engine is None:
+        # Nothing resident, the next request loads from the new location
+        self.model_path, self.tokenizer_path = model_path, tokenizer_path
+        return
+
+      # Load and warm on the side while the current engine keeps serving
+      loop = asyncio.get_running_loop()
+      engine = await loop.run_in_executor(None, load_engine, model_path, tokenizer_path)
+      # Both copies are resident until the swap completes
+      self.memory_bytes += model_bytes(engine[0])
+      self.memory.set(self.memory_bytes)
+      try:
+        await self._warm(engine)
+        digest = await loop.run_in_executor(None, model_digest, model_path, tokenizer_path)
+      except BaseException:
+        engine = None
+        self.memory_bytes = model_bytes(self.engine[0])
+        self.memory.set(self.memory_bytes)
+        _release_memory()
+        raise
+
+      # Each batch reads the engine once as it starts, so the swap lands between batches.
+      # The registry holds the only reference, so dropping it here frees the old weights
+      self.engine, engine = engine, None
+      self.digest, self.labels = digest, model_labels(self.engine[0])
+      self.model_path, self.tokenizer_path = model_path, tokenizer_path
+
+      # Let the batch still running on the old weights finish before letting go of them
+      await self.batcher.drain()
+      _release_memory()
+      self.memory_bytes = model_bytes(self.engine[0])
+      self.memory.set(self.memory_bytes)
+
+  async def unload(self) -> bool:
+    async with self._lock:
+      if self.engine is None or self.in_flight:
+        return False
+      # Cleared first so a request arriving now waits to load again instead of queueing on a stopping batcher
+      self.engine = None
+      await self.batcher.stop()
+      self.memory_bytes = 0
+      self.memory.set(0)
+      _release_memory()
+      return True
+
+  def observe(self, seconds: float):
+    self.requests.inc()
+    self.latency.observe(seconds)
+    self.latencies.append(seconds)
+
+  def report(self) -> dict:
+    report = {
+      "loaded": self.engine is not None,
+      "memory_mb": self.memory_bytes / (1024 * 1024),
+      "in_flight": self.in_flight,
+      "requests": self.requests.value,
+      "latency": latency_summary(list(self.latencies))
+    }
+    if self.compared:
+      report["shadow"] = {
+        "compared": self.compared,
+        "top_label_agreement": self.agreed / self.compared,
+        "mean_harmful_delta": self.harmful_delta / self.compared
+      }
+    return report
+
+def _release_memory():
+  gc.collect()
+  if torch.cuda.is_available():
+    torch.cuda.empty_cache()
+
+def _harmful(label_prob_pairs: list[tuple[str, float]]) -> float:
+  return sum(probability for label, probability in label_prob_pairs if label != "OK")
+
+class ModelRegistry:
+  def __init__(self):
+    self.versions: dict[str, ModelVersion] = {
+      MODEL_DEFAULT_VERSION: ModelVersion(
+        MODEL_DEFAULT_VERSION, os.getenv("MODEL_PATH"), os.getenv("TOKENIZER_PATH"),
+        load_engine(os.getenv("MODEL_PATH"), os.getenv("TOKENIZER_PATH"))
+      )
+    }
+    for name, source in MODEL_VERSIONS.items():
+      if isinstance(source, str):
+        source = {"model": source}
+      self.versions[name] = ModelVersion(name, source["model"], source.get("tokenizer", os.getenv("TOKENIZER_PATH")))
+
+    for name in itertools.chain(MODEL_GUILD_ROUTES.values(), MODEL_TRAFFIC_SPLIT, [MODEL_SHADOW] if MODEL_SHADOW else []):
+      if name not in self.versions:
+        raise ValueError("Unknown model version %s" % name)
+    if sum(MODEL_TRAFFIC_SPLIT.values()) > 100:
+      raise ValueError("MODEL_TRAFFIC_SPLIT adds up to more than 100%")
+
+    self._split = sorted(MODEL_TRAFFIC_SPLIT.items())
+    self._shadow_tasks: set[asyncio.Task] = set()
+    self._watcher: asyncio.Task | None = None
+
+  @property
+  def default(self) -> ModelVersion:
+    return self.versions[MODEL_DEFAULT_VERSION]
+
+  def route(self, guild_id: str | None) -> ModelVersion:
+    if guild_id is None:
+      return self.default
+    pinned = MODEL_GUILD_ROUTES.get(guild_id)
+    if pinned is not None:
+      return self.versions[pinned]
+
+    bucket = int.from_bytes(hashlib.blake2b(guild_id.encode(), digest_size=8).digest(), "big") % 100
+    for name, percentage in self._split:
+      if bucket < percentage:
+        return self.versions[name]
+      bucket -= percentage
+    return self.default
+
+  async def _acquire(self, version: ModelVersion) -> ModelVersion:
+    # Counted before loading so a version can't be evicted while we wait on it
+    version.in_flight += 1
+    version.last_used = monotonic()
+    try:
+      if version.engine is None:
+        await version.load()
+        await self._evict(keep=version)
+    except BaseException:
+      version.in_flight -= 1
+      raise
+    return version
+
+  async def _evict(self, keep: ModelVersion):
+    if not MODEL_MEMORY_BUDGET_MB:
+      return
+    budget = MODEL_MEMORY_BUDGET_MB * 1024 * 1024
+    candidates = sorted(
+      (version for version in self.versions.values() if version is not keep and version is not self.default),
+      key=lambda version: version.last_used
+    )
+    for version in candidates:
+      if sum(v.memory_bytes for v in self.versions.values()) <= budget:
+        break
+      if await version.unload():
+        model_evictions.labels(version.name).inc()
+
+  async def _score(self, version: ModelVersion, text: str) -> list[tuple[str, float]]:
+    await self._acquire(version)
+    try:
+      digest, labels = version.digest, version.labels
+      # A cached result has no embedding to go with it, so only skip the model when one isn't needed
+      if result_cache is not None and (not embeddings.EMBEDDINGS_ENABLED or embeddings.contains(version.name, text)):
+        label_prob_pairs = await result_cache.get(digest, text, labels)
+        if label_prob_pairs is not None:
+          return label_prob_pairs
+
+      # Latency is only recorded for the model itself, so versions compare like for like
+      started = perf_counter()
+      label_prob_pairs = await version.batcher.predict(text)
+      version.observe(perf_counter() - started)
+
+      if result_cache is not None:
+        result_cache.put(digest, text, labels, label_prob_pairs)
+      return label_prob_pairs
+    finally:
+      version.in_flight -= 1
+
+  async def predict(self, text: str, guild_id: str | None = None) -> list[tuple[str, float]]:
+    version = self.route(guild_id)
+    label_prob_pairs = await self._score(version, text)
+
+    if MODEL_SHADOW and MODEL_SHADOW != version.name and random.random() < MODEL_SHADOW_RATE:
+      if len(self._shadow_tasks) < MODEL_SHADOW_MAX_IN_FLIGHT:
+        task = asyncio.create_task(self._shadow(self.versions[MODEL_SHADOW], text, label_prob_pairs))
+        self._shadow_tasks.add(task)
+        task.add_done_callback(self._shadow_tasks.discard)
+      else:
+        shadow_dropped.inc()
+
+    return label_prob_pairs
+
+  async def _shadow(self, shadow: ModelVersion, text: str, served: list[tuple[str, float]]):
+    try:
+      label_prob_pairs = await self._score(shadow, text)
+    except Exception as e:
+      print(f"Shadow prediction with {shadow.name} failed: {e}")
+      return
+
+    agreed = label_prob_pairs[0][0] == served[0][0]
+    shadow.compared += 1
+    shadow.agreed += agreed
+    shadow.harmful_delta += abs(_harmful(label_prob_pairs) - _harmful(served))
+    shadow_comparisons.labels(shadow.name, "agree" if agreed else "disagree").inc()
+
+  async def reload(self, name: str, model_path: str | None = None, tokenizer_path: str | None = None) -> ModelVersion:
+    version = self.versions[name]
+    started = perf_counter()
+    try:
+      await version.reload(model_path, tokenizer_path)
+    except Exception:
+      model_reloads.labels(name, "failed").inc()
+      raise
+    model_reloads.labels(name, "ok").inc()
+    print(f"Reloaded model {name} from {version.model_path} in {perf_counter() - started:.1f}s")
+    return version
+
+  async def _watch(self):
+    roots = {
+      os.path.abspath(version.model_path): version
+      for version in self.versions.values() if version.model_path and os.path.isdir(version.model_path)
+    }
+    if not roots:
+      return
+
+    async for changes in awatch(*roots, step=MODEL_WATCH_SETTLE_MS, debounce=MODEL_WATCH_DEBOUNCE_MS):
+      changed = [os.path.abspath(path) for _, path in changes]
+      for root, version in roots.items():
+        if version.engine is None or not any(path == root or path.startswith(root + os.sep) for path in changed):
+          continue
+        try:
+          await self.reload(version.name)
+        except Exception as e:
+          # Most likely still mid-copy, keep serving the old weights until the next change
+          print(f"Reloading model {version.name} failed: {e}")
+
+  def start(self):
+    for version in self.versions.values():
+      if version.engine is not None:
+        version.batcher.start()
+    if MODEL_WATCH and self._watcher is None:
+      self._watcher = asyncio.create_task(self._watch())
+
+  async def stop(self):
+    if self._watcher is not None:
+      self._watcher.cancel()
+      self._watcher = None
+    for task in list(self._shadow_tasks):
+      task.cancel()
+    for version in self.versions.values():
+      await version.batcher.stop()
+
+  def report(self) -> dict:
+    return {
+      "default": MODEL_DEFAULT_VERSION,
+      "shadow": MODEL_SHADOW,
+      "shadow_rate": MODEL_SHADOW_RATE,
+      "memory_budget_mb": MODEL_MEMORY_BUDGET_MB,
+      "versions": {name: version.report() for name, version in self.versions.items()}
+    }
+
+registry = ModelRegistry()
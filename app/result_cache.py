@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from dotenv import load_dotenv
+from app.metrics import Counter, cache_counters
+
+load_dotenv()
+
+# SQLite file shared by every worker on the host, the cache is off without it
+RESULT_CACHE_PATH = os.getenv('RESULT_CACHE_PATH')
+RESULT_CACHE_MAX_ROWS = int(os.getenv('RESULT_CACHE_MAX_ROWS', '200000'))
+# Hits only refresh their last-used time this often, so reads rarely turn into writes
+RESULT_CACHE_TOUCH_INTERVAL = float(os.getenv('RESULT_CACHE_TOUCH_INTERVAL', '600'))
+# Writes are grouped into one transaction per flush
+RESULT_CACHE_FLUSH_MS = float(os.getenv('RESULT_CACHE_FLUSH_MS', '50'))
+
+# Prune back to this fraction of the limit, so we don't prune on every insert past it
+_PRUNE_TO = 0.9
+_PRUNE_EVERY = 1000
+
+cache_hit, cache_miss = cache_counters("result")
+cache_errors = Counter("aidle_result_cache_errors_total", "Disk result cache reads and writes that failed")
+
+SCHEMA = '''
+  CREATE TABLE IF NOT EXISTS results (
+    key BLOB PRIMARY KEY,
+    probabilities BLOB NOT NULL,
+    used REAL NOT NULL
+  ) WITHOUT ROWID;
+  CREATE INDEX IF NOT EXISTS results_used ON results (used);
+'''
+
+def model_digest(model_path: str | None, tokenizer_path: str | None) -> bytes:
+  # Names, sizes and modification times rather than contents, hashing gigabytes of weights
+  # on every load would cost more than the cache saves; replacing a file changes the digest
+  digest = hashlib.blake2b(digest_size=16)
+  for path in (model_path, tokenizer_path):
+    digest.update(str(path).encode())
+    if path and os.path.isdir(path):
+      for name in sorted(os.listdir(path)):
+        stat = os.stat(os.path.join(path, name))
+        digest.update(b"%s:%d:%d" % (name.encode(), stat.st_size, stat.st_mtime_ns))
+  return digest.digest()
+
+def _key(digest: bytes, text: str) -> bytes:
+  return hashlib.blake2b(text.encode(), digest_size=16, key=digest).digest()
+
+class ResultCache:
+  def __init__(self, path: str):
+    self.path = path
+    self._local = threading.local()
+    # Reads and writes run here so the event loop never waits on the disk
+    self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="result-cache")
+    self._pending: list[tuple[bytes, bytes]] = []
+    self._flush_handle: asyncio.TimerHandle | None = None
+    self._inserted = 0
+
+  def _connection(self) -> sqlite3.Connection:
+    connection = getattr(self._local, "connection", None)
+    if connection is None:
+      connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+      # WAL lets every worker read while one of them writes
+      connection.execute("PRAGMA journal_mode=WAL")
+      connection.execute("PRAGMA synchronous=NORMAL")
+      connection.executescript(SCHEMA)
+      self._local.connection = connection
+    return connection
+
+  def _get(self, key: bytes) -> np.ndarray | None:
+    connection = self._connection()
+    row = connection.execute("SELECT probabilities, used FROM results WHERE key = ?", (key,)).fetchone()
+    if row is None:
+      return None
+    now = time.time()
+    if row[1] < now - RESULT_CACHE_TOUCH_INTERVAL:
+      connection.execute("UPDATE results SET used = ? WHERE key = ?", (now, key))
+    return np.frombuffer(row[0], dtype=np.float32)
+
+  def _put(self, rows: list[tuple[bytes, bytes]]):
+    connection = self._connection()
+    now = time.time()
+    connection.execute("BEGIN")
+    try:
+      connection.executemany(
+        "INSERT OR REPLACE INTO results (key, probabilities, used) VALUES (?, ?, ?)",
+        [(key, probabilities, now) for key, probabilities in rows]
+      )
+    except sqlite3.Error:
+      connection.execute("ROLLBACK")
+      raise
+    connection.execute("COMMIT")
+
+    self._inserted += len(rows)
+    if self._inserted >= _PRUNE_EVERY:
+      self._inserted = 0
+      self._prune(connection)
+
+  def _prune(self, connection: sqlite3.Connection):
+    # Least recently used rows go first, down to a little under the limit
+    rows = connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    if rows > RESULT_CACHE_MAX_ROWS:
+      excess = rows - int(RESULT_CACHE_MAX_ROWS * _PRUNE_TO)
+      connection.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used LIMIT ?)", (excess,))
+
+  async def get(self, digest: bytes, text: str, labels: list[str]) -> list[tuple[str, float]] | None:
+    try:
+      probabilities = await asyncio.get_running_loop().run_in_executor(self._executor, self._get, _key(digest, text))
+    except sqlite3.Error as e:
+      cache_errors.inc()
+      print(f"Error reading result cache: {e}")
+      return None
+
+    if probabilities is None or len(probabilities) != len(labels):
+      cache_miss.inc()
+      return None
+    cache_hit.inc()
+    label_prob_pairs = list(zip(labels, probabilities.tolist()))
+    label_prob_pairs.sort(key=lambda item: item[1], reverse=True)
+    return label_prob_pairs
+
+  def put(self, digest: bytes, text: str, labels: list[str], label_prob_pairs: list[tuple[str, float]]):
+    # Stored in the model's label order so a row is just the raw probability vector
+    probabilities = dict(label_prob_pairs)
+    vector = np.array([probabilities[label] for label in labels], dtype=np.float32)
+    self._pending.append((_key(digest, text), vector.tobytes()))
+    if self._flush_handle is None:
+      self._flush_handle = asyncio.get_running_loop().call_later(RESULT_CACHE_FLUSH_MS / 1000, self._flush)
+
+  def _flush(self):
+    self._flush_handle = None
+    rows, self._pending = self._pending, []
+    if rows:
+      self._executor.submit(self._put, rows).add_done_callback(self._flushed)
+
+  def _flushed(self, future):
+    e = future.exception()
+    if e is not None:
+      cache_errors.inc()
+      print(f"Error writing result cache: {e}")
+
+  def close(self):
+    if self._flush_handle is not None:
+      self._flush_handle.cancel()
+      self._flush()
+    self._executor.shutdown(wait=True)
+
+result_cache = ResultCache(RESULT_CACHE_PATH) if RESULT_CACHE_PATH else None
@@ -0,0 +1,191 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from app.dependencies import get_db
+from app.metrics import COUNT_BUCKETS, Gauge, Histogram
+
+load_dotenv()
+
+# A message's score counts half as much after this long
+RISK_HALF_LIFE_HOURS = float(os.getenv('RISK_HALF_LIFE_HOURS', '24'))
+RISK_FLUSH_INTERVAL = float(os.getenv('RISK_FLUSH_INTERVAL', '5'))
+# Off keeps scores in this worker's memory only; the AuthorRisk upsert needs Postgres
+RISK_PERSIST = os.getenv('RISK_PERSIST', 'true').lower() == 'true'
+# Authors held in memory per worker, clean ones are dropped oldest first
+RISK_MAX_ENTRIES = int(os.getenv('RISK_MAX_ENTRIES', '100000'))
+
+DECAY = math.log(2) / (RISK_HALF_LIFE_HOURS * 3600)
+# Rows per upsert statement, 7 parameters each
+_FLUSH_CHUNK = 500
+# Dirty entries passed over per eviction on the request path
+_EVICT_SCAN = 64
+
+risk_entries = Gauge("aidle_author_risk_entries", "Author risk scores held in memory")
+risk_flush_rows = Histogram("aidle_author_risk_flush_rows", "Author risk rows written per flush", buckets=COUNT_BUCKETS + (512, 1024, 4096))
+
+# Workers only ever send what they added since their last flush, decayed to when they added it.
+# Decay is linear, so the stored score and the delta are each brought to the later of the two
+# times and summed, and concurrent workers never overwrite each other
+UPSERT_SQL = '''
+  INSERT INTO "AuthorRisk" ("guild_id", "author_id", "author_name", "risk", "messages", "flagged", "updated")
+  SELECT v.guild_id, v.author_id, v.author_name, v.risk, v.messages, v.flagged, v.updated
+  FROM (VALUES %s) AS v (guild_id, author_id, author_name, risk, messages, flagged, updated)
+  ON CONFLICT ("guild_id", "author_id") DO UPDATE SET
+    "risk" = "AuthorRisk"."risk" * exp(-%r * GREATEST(EXCLUDED."updated" - "AuthorRisk"."updated", 0))
+      + EXCLUDED."risk" * exp(-%r * GREATEST("AuthorRisk"."updated" - EXCLUDED."updated", 0)),
+    "updated" = GREATEST("AuthorRisk"."updated", EXCLUDED."updated"),
+    "messages" = "AuthorRisk"."messages" + EXCLUDED."messages",
+    "flagged" = "AuthorRisk"."flagged" + EXCLUDED."flagged",
+    "author_name" = EXCLUDED."author_name"
+'''
+_ROW = "($%d::text, $%d::bigint, $%d::text, $%d::float8, $%d::int, $%d::int, $%d::float8)"
+
+def decayed(risk: float, since: float, now: float) -> float:
+  return risk * math.exp(-DECAY * max(now - since, 0.0))
+
+class AuthorRisk:
+  __slots__ = ("risk", "updated", "delta", "delta_at", "messages", "flagged", "author_name", "dirty")
+
+  def __init__(self, risk: float, updated: float):
+    # What this worker believes the score is, for responses
+    self.risk = risk
+    self.updated = updated
+    # What it has added since the last flush
+    self.delta = 0.0
+    self.delta_at = updated
+    self.messages = 0
+    self.flagged = 0
+    self.author_name = None
+    self.dirty = False
+
+  def add(self, score: float, flagged: bool, author_name: str, now: float) -> float:
+    self.risk = decayed(self.risk, self.updated, now) + score
+    self.updated = now
+    self.delta = decayed(self.delta, self.delta_at, now) + score
+    self.delta_at = now
+    self.messages += 1
+    self.flagged += flagged
+    self.author_name = author_name
+    self.dirty = True
+    return self.risk
+
+# (guild_id, author_id) -> score, least recently used first
+_entries: OrderedDict[tuple[str, int], AuthorRisk] = OrderedDict()
+_task: asyncio.Task | None = None
+_db = None
+
+async def _connection():
+  global _db
+  if _db is None:
+    _db = await get_db()
+  return _db
+
+async def _load(guild_id: str, author_id: int, now: float) -> AuthorRisk:
+  # Only the first message from an author in this worker pays for the lookup
+  db = await _connection()
+  row = await db.authorrisk.find_unique(
+    where={
+      "guild_id_author_id": {
+        "guild_id": guild_id,
+        "author_id": author_id
+      }
+    }
+  )
+  if row is None:
+    return AuthorRisk(0.0, now)
+  return AuthorRisk(decayed(row.risk, row.updated, now), now)
+
+async def record(guild_id: str, author_id: int, author_name: str, score: float, flagged: bool) -> float:
+  key = (guild_id, author_id)
+  now = time.time()
+
+  entry = _entries.get(key)
+  if entry is None:
+    loaded = await _load(guild_id, author_id, now) if RISK_PERSIST else AuthorRisk(0.0, now)
+    # Another message from the same author may have loaded it while we waited
+    entry = _entries.setdefault(key, loaded)
+    _evict()
+  _entries.move_to_end(key)
+  updated = entry.add(score, flagged, author_name, now)
+  if not RISK_PERSIST:
+    # Nothing will flush it, leave it free to evict
+    entry.dirty = False
+  return updated
+
+def current(guild_id: str, author_id: int) -> float | None:
+  entry = _entries.get((guild_id, author_id))
+  return None if entry is None else decayed(entry.risk, entry.updated, time.time())
+
+def _evict(scan: int | None = _EVICT_SCAN):
+  # Oldest first. Dirty entries stay until they've been flushed; they were touched since the last
+  # flush so go to the back. The request path only looks at a few, flush() catches up on the rest
+  skipped = 0
+  while len(_entries) > RISK_MAX_ENTRIES and skipped < (len(_entries) if scan is None else scan):
+    key, entry = _entries.popitem(last=False)
+    if entry.dirty:
+      _entries[key] = entry
+      skipped += 1
+  risk_entries.set(len(_entries))
+
+async def flush():
+  dirty = [(key, entry) for key, entry in _entries.items() if entry.dirty]
+  if not dirty:
+    return
+
+  rows = []
+  for (guild_id, author_id), entry in dirty:
+    rows.append((guild_id, author_id, entry.author_name, entry.delta, entry.messages, entry.flagged, entry.delta_at))
+    entry.delta = 0.0
+    entry.messages = 0
+    entry.flagged = 0
+    entry.dirty = False
+
+  db = await _connection()
+  try:
+    for start in range(0, len(rows), _FLUSH_CHUNK):
+      chunk = rows[start:start + _FLUSH_CHUNK]
+      values = ", ".join(_ROW % tuple(range(i * 7 + 1, i * 7 + 8)) for i in range(len(chunk)))
+      await db.execute_raw(UPSERT_SQL % (values, DECAY, DECAY), *(value for row in chunk for value in row))
+  except Exception:
+    # Put the deltas back so the next flush carries them
+    for (key, entry), row in zip(dirty, rows):
+      entry.delta = decayed(row[3], row[6], entry.delta_at) + entry.delta
+      entry.messages += row[4]
+      entry.flagged += row[5]
+      entry.dirty = True
+    raise
+  risk_flush_rows.observe(len(rows))
+  _evict(scan=None)
+
+async def _flush_loop():
+  while True:
+    await asyncio.sleep(RISK_FLUSH_INTERVAL)
+    try:
+      await flush()
+    except Exception as e:
+      print(f"Error flushing author risk scores: {e}")
+
+def start():
+  global _task
+  if _task is None and RISK_PERSIST:
+    _task = asyncio.create_task(_flush_loop())
+
+async def stop():
+  global _task, _db
+  if _task is not None:
+    _task.cancel()
+    try:
+      await _task
+    except asyncio.CancelledError:
+      pass
+    _task = None
+  try:
+    await flush()
+  except Exception as e:
+    print(f"Error flushing author risk scores: {e}")
+  if _db is not None:
+    await _db.disconnect()
+    _db = None
@@ -1,10 +1,12 @@
 from fastapi.responses import Response
-import requests
+import httpx
 import jwt
 import os
-import openapi_client
-from openapi_client.models.user_pii_response import UserPIIResponse
-from openapi_client.rest import ApiException
+import time
+from app import credentials
+from app.discord_client import get_client
+from app.metrics import Histogram
+from app.sessions import SessionData, new_session_id, store
 from dotenv import load_dotenv
 from fastapi import APIRouter, HTTPException
 
@@ -14,16 +16,21 @@ router = APIRouter()
 client_id = os.getenv('CLIENT_ID')
 client_secret = os.getenv('CLIENT_SECRET')
 
+login_latency = Histogram(
+  "aidle_login_duration_seconds",
+  "Time taken to exchange an OAuth code and fetch the Discord user",
+  labelnames=("outcome",)
+)
+login_success = login_latency.labels("success")
+login_failure = login_latency.labels("failure")
+
 @router.post("/auth", tags=["auth"])
-def authenticate(code, redirect_uri):
+async def authenticate(code, redirect_uri):
   data = {
     'grant_type': 'authorization_code',
     'code': code,
     'redirect_uri': redirect_uri
   }
-  headers = {
-    'Content-Type': 'application/x-www-form-urlencoded',
-  }
 
   responseHeaders = {
     'Content-Type': 'application/json',
@@ -33,25 +40,50 @@ def authenticate(code, redirect_uri):
     'Access-Control-Allow-Credentials': 'true'
   }
 
+  client = get_client()
+  started = time.perf_counter()
+  outcome = login_failure
+
   try:
-    r = requests.post('%s/oauth2/token' % os.getenv('API_ENDPOINT'), data=data, headers=headers, auth=(client_id, client_secret))
-    r.raise_for_status()
-    body = r.json()
-
-    configuration = openapi_client.Configuration()
-    configuration.host = os.getenv('API_ENDPOINT')
-    configuration.access_token = body['access_token']
-
-    with openapi_client.ApiClient(configuration) as api_client:
-      api_instance = openapi_client.DefaultApi(api_client)
-      try:
-        body['user_id'] = (api_instance.get_my_user()).id
-      except ApiException as e:
-        print("Exception when calling DefaultApi->get_my_user: %s\n" % e)
-        raise HTTPException(status_code=500, detail="Failed to fetch user")
-    
-    response = Response(content=jwt.encode(body, os.getenv('JWT_SECRET_KEY'), algorithm='HS256'), headers=responseHeaders)
-    return response
-  except requests.exceptions.RequestException as e:
-    print(f"Error during authentication: {e}")
-    raise HTTPException(status_code=500, detail="Authentication failed")
\ No newline at end of file
+    try:
+      r = await client.post('/oauth2/token', data=data, auth=(client_id, client_secret))
+      r.raise_for_status()
+      body = r.json()
+    except httpx.HTTPError as e:
+      print(f"Error during authentication: {e}")
+      raise HTTPException(status_code=500, detail="Authentication failed")
+
+    # Fire the user lookup as soon as the token lands, on the same warm connection
+    try:
+      me = await client.get('/users/@me', headers={'Authorization': 'Bearer %s' % body['access_token']})
+      me.raise_for_status()
+      user_id = me.json()['id']
+    except httpx.HTTPError as e:
+      print("Exception when fetching /users/@me: %s\n" % e)
+      raise HTTPException(status_code=500, detail="Failed to fetch user")
+
+    outcome = login_success
+  finally:
+    outcome.observe(time.perf_counter() - started)
+
+  # Discord credentials stay server side, the cookie only identifies the session
+  session = SessionData(
+    session_id=new_session_id(),
+    user_id=user_id,
+    access_token=body['access_token'],
+    refresh_token=body.get('refresh_token'),
+    token_type=body.get('token_type'),
+    scope=body.get('scope'),
+    expires_at=time.time() + body.get('expires_in', 604800)
+  )
+  await store.set(session)
+  credentials.track(session)
+
+  token = {
+    'sid': session.session_id,
+    'user_id': user_id,
+    'exp': int(session.ends_at)
+  }
+
+  response = Response(content=jwt.encode(token, os.getenv('JWT_SECRET_KEY'), algorithm='HS256'), headers=responseHeaders)
+  return response
@@ -1,49 +1,49 @@
-from fastapi.requests import Request
-import jwt
 import os
+from time import perf_counter
 import openapi_client
 from openapi_client.models.user_pii_response import UserPIIResponse
 from openapi_client.rest import ApiException
 from dotenv import load_dotenv
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
+from app.credentials import get_credentials
+from app.discord_client import observe_upstream
+from app.sessions import SessionData
 
 load_dotenv()
 router = APIRouter()
 
 @router.get("/discord/presence", tags=["discord"])
-def get_user_presence(request: Request):
-  auth_header = request.headers.get(os.getenv('USER_COOKIE_NAME'))
-  if not auth_header:
-    raise HTTPException(status_code=401, detail="Authorization header missing")
-  
+def get_user_presence(session: SessionData = Depends(get_credentials)):
   configuration = openapi_client.Configuration()
   configuration.host = os.getenv('API_ENDPOINT')
-  configuration.access_token = (jwt.decode(auth_header, os.getenv('JWT_SECRET_KEY'), algorithms=['HS256']))['access_token']
+  configuration.access_token = session.access_token
 
   with openapi_client.ApiClient(configuration) as api_client:
     api_instance = openapi_client.DefaultApi(api_client)
+    started = perf_counter()
     try:
       api_response = api_instance.get_my_user()
+      observe_upstream('GET', '/users/@me', 200, perf_counter() - started)
       return api_response
     except ApiException as e:
+      observe_upstream('GET', '/users/@me', e.status or 500, perf_counter() - started)
       print("Exception when calling DefaultApi->get_my_user: %s\n" % e)
       raise HTTPException(status_code=500, detail="Failed to fetch presence")
 
 @router.get("/discord/me", tags=["discord"])
-def get_user_guilds(request: Request):
-  auth_header = request.headers.get(os.getenv('USER_COOKIE_NAME'))
-  if not auth_header:
-    raise HTTPException(status_code=401, detail="Authorization header missing")
-  
+def get_user_guilds(session: SessionData = Depends(get_credentials)):
   configuration = openapi_client.Configuration()
   configuration.host = os.getenv('API_ENDPOINT')
-  configuration.access_token = (jwt.decode(auth_header, os.getenv('JWT_SECRET_KEY'), algorithms=['HS256']))['access_token']
+  configuration.access_token = session.access_token
 
   with openapi_client.ApiClient(configuration) as api_client:
     api_instance = openapi_client.DefaultApi(api_client)
+    started = perf_counter()
     try:
       api_response = api_instance.get_my_user()
+      observe_upstream('GET', '/users/@me', 200, perf_counter() - started)
       return api_response
     except ApiException as e:
+      observe_upstream('GET', '/users/@me', e.status or 500, perf_counter() - started)
       print("Exception when calling DefaultApi->get_my_user: %s\n" % e)
       raise HTTPException(status_code=500, detail="Failed to fetch user")
\ No newline at end of file
@@ -0,0 +1,59 @@
+from datetime import datetime, timezone
+from app import embeddings
+from app.authorization import require_guild_access
+from app.registry import registry
+from app.security import Principal
+from fastapi import APIRouter, Depends, HTTPException, Response
+from pydantic import BaseModel
+
+class SimilarRequest(BaseModel):
+  input_text: str
+  k: int = embeddings.EMBEDDING_TOP_K
+
+router = APIRouter()
+
+def _require_enabled():
+  if not embeddings.EMBEDDINGS_ENABLED:
+    raise HTTPException(status_code=404, detail="Embeddings are not enabled")
+
+@router.post("/guild/{guild_id}/similar", tags=["embeddings"], dependencies=[Depends(_require_enabled)])
+async def find_similar(guild_id: str, item: SimilarRequest, principal: Principal = Depends(require_guild_access)):
+  if item.k < 1 or item.k > 100:
+    raise HTTPException(status_code=422, detail="k must be between 1 and 100")
+
+  store = embeddings.store(guild_id)
+  if store is None:
+    return {"results": []}
+
+  vector = embeddings.lookup(store.version, item.input_text)
+  if vector is None:
+    # Scoring the text leaves its embedding in the cache
+    await registry.predict(item.input_text, guild_id)
+    vector = embeddings.lookup(store.version, item.input_text)
+  if vector is None:
+    raise HTTPException(status_code=503, detail="Embedding unavailable, the guild's model changed")
+
+  return {
+    "results": [
+      {
+        "message_id": str(store.message_ids[index]),
+        "author_id": str(store.author_ids[index]),
+        "similarity": similarity,
+        "created_date": datetime.fromtimestamp(store.created[index], timezone.utc).isoformat()
+      }
+      for index, similarity in store.search(vector, item.k)
+    ]
+  }
+
+@router.get("/guild/{guild_id}/embeddings", tags=["embeddings"], dependencies=[Depends(_require_enabled)])
+async def export_embeddings(guild_id: str, principal: Principal = Depends(require_guild_access)):
+  store = embeddings.store(guild_id)
+  if store is None:
+    raise HTTPException(status_code=404, detail="No embeddings stored for this guild")
+
+  # float16 vectors with message ids, author ids and timestamps, as a NumPy .npz archive
+  return Response(
+    content=store.export(),
+    media_type="application/octet-stream",
+    headers={"content-disposition": 'attachment; filename="%s-embeddings.npz"' % guild_id}
+  )
@@ -0,0 +1,39 @@
+import json
+import os
+from app import events
+from app.security import Principal, get_stream_principal
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+
+load_dotenv()
+router = APIRouter()
+
+SSE_KEEPALIVE_INTERVAL = float(os.getenv('SSE_KEEPALIVE_INTERVAL', '15'))
+
+def _format(event: str, data: dict) -> str:
+  return "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+
+async def _event_stream(subscription: events.Subscription):
+  try:
+    yield _format("ready", {"owner_id": subscription.owner_id})
+    while True:
+      batch, dropped = await subscription.drain(SSE_KEEPALIVE_INTERVAL)
+      if dropped:
+        # The dashboard fell behind, it should refetch full state
+        yield _format("dropped", {"count": dropped})
+      if not batch and not dropped:
+        yield ": keepalive\n\n"
+        continue
+      yield "".join(_format(event, data) for event, data in batch)
+  finally:
+    events.unsubscribe(subscription)
+
+@router.get('/events', tags=['me'])
+async def get_events(principal: Principal = Depends(get_stream_principal)):
+  subscription = events.subscribe(principal.user_id)
+  return StreamingResponse(
+    _event_stream(subscription),
+    media_type="text/event-stream",
+    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+  )
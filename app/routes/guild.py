@@ -1,14 +1,18 @@
-from app.dependencies import get_db
-import jwt
 import os
+from app import authorization
+from app.authorization import require_guild_access
+from app.dependencies import get_db
+from app.security import Principal, get_principal, is_bot
 from datetime import datetime
-from fastapi import APIRouter
-from pydantic import BaseModel
+from prisma.errors import UniqueViolationError
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException
 
 load_dotenv()
 
+SYNC_CHUNK_SIZE = int(os.getenv('SYNC_CHUNK_SIZE', '1000'))
+
 class GuildCreateRequest(BaseModel):
   owner_id: str
   owner_name: str | None = None
@@ -20,80 +24,216 @@ class GuildCreateRequest(BaseModel):
 
 router = APIRouter()
 
-@router.post("/guild", tags=["guild"])
-async def create_guild(item: GuildCreateRequest):
-  db = await get_db()
-
-  # Check if user exists
-  user = await db.user.find_unique(where={"owner_id": item.owner_id})
-  print("Found user:", user)
-
-  if not user:
-    print("User not found, creating new user.")
-    # Create new user
-    user = await db.user.create(
+async def _onboard(db, item: GuildCreateRequest):
+  async with db.tx() as tx:
+    # Owner and their default plan
+    user = await tx.user.upsert(
+      where={"owner_id": item.owner_id},
       data={
-        "owner_id": item.owner_id,
-        "owner_name": item.owner_name,
-        "owner_icon": item.owner_icon,
-        "plan": {
-          "create": {
-            "max_requests": 100
+        "create": {
+          "owner_id": item.owner_id,
+          "owner_name": item.owner_name,
+          "owner_icon": item.owner_icon,
+          "plan": {
+            "create": {
+              "max_requests": 100
+            }
           }
-        }
+        },
+        "update": {}
       }
     )
 
-  # Create new guild
-  guild = await db.guild.find_unique(where={"guild_id": item.guild_id})
-
-  if not guild:
-    guild = await db.guild.create(
+    settings = await tx.settings.upsert(
+      where={"guild_id": item.guild_id},
       data={
-        "guild_name": item.guild_name,
-        "guild_id": item.guild_id,
-        "guild_icon": item.guild_icon,
-        "moderate": item.moderate,
-        "owner_id": user.owner_id
+        "create": {
+          "guild_id": item.guild_id
+        },
+        "update": {}
       }
     )
-  else:
-    await db.guild.update(
-      data={
-        "moderate": True
-      },
-      where={"guild_id": item.guild_id}
-    )
 
-  settings = await db.guild.find_unique(where={"guild_id": item.guild_id})
-
-  if not settings:
-    settings = await db.settings.create(
+    # Rejoining an existing guild only reactivates it
+    guild = await tx.guild.upsert(
+      where={"guild_id": item.guild_id},
       data={
-        "guild_id": item.guild_id
+        "create": {
+          "guild_name": item.guild_name,
+          "guild_id": item.guild_id,
+          "guild_icon": item.guild_icon,
+          "moderate": item.moderate,
+          "owner_id": user.owner_id,
+          "settings_id": settings.id
+        },
+        "update": {
+          "moderate": True,
+          "settings_id": settings.id
+        }
       }
     )
 
-  await db.guild.update(
-    data={
-      "settings_id": settings.id
-    },
-    where={
-      "guild_id": guild.id
-    }
-  )
+  return guild
+
+@router.post("/guild", tags=["guild"])
+async def create_guild(item: GuildCreateRequest):
+  db = await get_db()
+
+  try:
+    guild = await _onboard(db, item)
+  except UniqueViolationError:
+    # A concurrent join won the insert race, the retry takes the update path
+    guild = await _onboard(db, item)
 
   await db.disconnect()
 
+  if guild.moderate:
+    authorization.grant(guild.owner_id, guild.guild_id)
+
   return {"status": "success", "guild_id": guild.guild_id}
 
+class GuildSyncRequest(BaseModel):
+  guilds: list[GuildCreateRequest]
+
+def _chunks(items: list, size: int):
+  for i in range(0, len(items), size):
+    yield items[i:i + size]
+
+async def _sync_owners(db, items: list[GuildCreateRequest]):
+  owner_ids = list({item.owner_id for item in items})
+  users = await db.user.find_many(where={"owner_id": {"in": owner_ids}})
+  known = {user.owner_id for user in users}
+
+  missing = {item.owner_id: item for item in items if item.owner_id not in known}
+  if not missing:
+    return
+
+  # create_many can't nest the plan, so batch the upserts into one round trip
+  async with db.batch_() as batcher:
+    for item in missing.values():
+      batcher.user.upsert(
+        where={"owner_id": item.owner_id},
+        data={
+          "create": {
+            "owner_id": item.owner_id,
+            "owner_name": item.owner_name,
+            "owner_icon": item.owner_icon,
+            "plan": {
+              "create": {
+                "max_requests": 100
+              }
+            }
+          },
+          "update": {}
+        }
+      )
+
+# Called by the bot on (re)connect with every guild it is currently in
+@router.post("/guilds/sync", tags=["guild"])
+async def sync_guilds(item: GuildSyncRequest, authenticated: bool = Depends(is_bot)):
+  # Anything missing from the list is switched off, so only the bot may send one
+  if not authenticated:
+    raise HTTPException(status_code=401, detail="Bot key required")
+  if not item.guilds:
+    raise HTTPException(status_code=400, detail="No guilds supplied")
+
+  requested = {guild.guild_id: guild for guild in item.guilds}
+  guild_ids = list(requested)
+
+  db = await get_db()
+
+  created = []
+  reactivated = []
+
+  for chunk in _chunks(guild_ids, SYNC_CHUNK_SIZE):
+    existing = await db.guild.find_many(where={"guild_id": {"in": chunk}})
+    existing_ids = {guild.guild_id for guild in existing}
+
+    inactive = [guild for guild in existing if not guild.moderate]
+    if inactive:
+      await db.guild.update_many(
+        where={"guild_id": {"in": [guild.guild_id for guild in inactive]}},
+        data={"moderate": True}
+      )
+      reactivated.extend(inactive)
+
+    new = [requested[guild_id] for guild_id in chunk if guild_id not in existing_ids]
+    if not new:
+      continue
+
+    await _sync_owners(db, new)
+
+    new_ids = [guild.guild_id for guild in new]
+    await db.settings.create_many(
+      data=[{"guild_id": guild_id} for guild_id in new_ids],
+      skip_duplicates=True
+    )
+    settings = await db.settings.find_many(where={"guild_id": {"in": new_ids}})
+    settings_ids = {row.guild_id: row.id for row in settings}
+
+    await db.guild.create_many(
+      data=[
+        {
+          "guild_name": guild.guild_name,
+          "guild_id": guild.guild_id,
+          "guild_icon": guild.guild_icon,
+          "moderate": guild.moderate,
+          "owner_id": guild.owner_id,
+          "settings_id": settings_ids[guild.guild_id]
+        }
+        for guild in new
+      ],
+      skip_duplicates=True
+    )
+    created.extend(new)
+
+  # Anything still marked active that the bot no longer reports has been left. Walked a page
+  # at a time, a single "not_in" over every reported id can exceed the bind parameter limit
+  removed_ids = []
+  cursor = 0
+  while True:
+    page = await db.guild.find_many(
+      where={
+        "moderate": True,
+        "id": {"gt": cursor}
+      },
+      order={"id": "asc"},
+      take=SYNC_CHUNK_SIZE
+    )
+    removed_ids.extend(guild.guild_id for guild in page if guild.guild_id not in requested)
+    if len(page) < SYNC_CHUNK_SIZE:
+      break
+    cursor = page[-1].id
+
+  for chunk in _chunks(removed_ids, SYNC_CHUNK_SIZE):
+    await db.guild.update_many(
+      where={"guild_id": {"in": chunk}},
+      data={"moderate": False}
+    )
+
+  await db.disconnect()
+
+  for guild in created:
+    if guild.moderate:
+      authorization.grant(guild.owner_id, guild.guild_id)
+  for guild in reactivated:
+    if guild.owner_id:
+      authorization.grant(guild.owner_id, guild.guild_id)
+  for guild_id in removed_ids:
+    authorization.revoke(guild_id)
+
+  return {
+    "status": "success",
+    "total": len(guild_ids),
+    "created": len(created),
+    "reactivated": len(reactivated),
+    "unchanged": len(guild_ids) - len(created) - len(reactivated),
+    "removed": len(removed_ids)
+  }
+
 @router.get("/guilds", tags=["guild"])
-async def get_guilds(request: Request):
-  auth_header = request.headers.get(os.getenv('USER_COOKIE_NAME'))
-  if not auth_header:
-    raise HTTPException(status_code=401, detail="Authorization header missing")
-  
-  user_id = (jwt.decode(auth_header, os.getenv('JWT_SECRET_KEY'), algorithms=['HS256']))['user_id']
+async def get_guilds(principal: Principal = Depends(get_principal)):
+  user_id = principal.user_id
 
   db = await get_db()
 
@@ -113,19 +253,12 @@ async def get_guilds(request: Request):
   return {"status": "success", "guilds": guilds}
 
 @router.get("/guilds/{guild_id}", tags=["guild"])
-async def get_guilds(guild_id: str, request: Request):
-  auth_header = request.headers.get(os.getenv('USER_COOKIE_NAME'))
-  if not auth_header:
-    raise HTTPException(status_code=401, detail="Authorization header missing")
-  
-  user_id = (jwt.decode(auth_header, os.getenv('JWT_SECRET_KEY'), algorithms=['HS256']))['user_id']
-
+async def get_guilds(guild_id: str, principal: Principal = Depends(require_guild_access)):
   db = await get_db()
 
   # Fetch all guilds
   guilds = await db.guild.find_unique(
     where={
-      "owner_id": user_id,
       "guild_id": guild_id
     },
     include={
@@ -171,6 +304,8 @@ async def delete_guild(guild_id: str):
 
   await db.disconnect()
 
+  authorization.revoke(deleted_guild.guild_id)
+
   return {"status": "success", "deleted_guild_id": deleted_guild.guild_id}
 
 class Settings(BaseModel):
@@ -184,33 +319,27 @@ class Settings(BaseModel):
   enable_s3: bool
   enable_hr: bool
   enable_sh: bool
+  # Optional so older dashboards don't reset them; timeout is in seconds, 0 for none
+  enforce_delete: bool = False
+  enforce_timeout: int = Field(0, ge=0, le=2419200)
+  enforce_ban: bool = False
+  # Moderate raid spam even when it scores under confidence_limit
+  moderate_raids: bool = False
 
-@router.post("/guild/{guild_id}/settings", tags=["guild"])
-async def update_settings(guild_id: str, item: Settings, request: Request):
-  auth_header = request.headers.get(os.getenv('USER_COOKIE_NAME'))
-  if not auth_header:
-    raise HTTPException(status_code=401, detail="Authorization header missing")
-  
-  user_id = (jwt.decode(auth_header, os.getenv('JWT_SECRET_KEY'), algorithms=['HS256']))['user_id']
+OPTIONAL_FIELDS = ("enforce_delete", "enforce_timeout", "enforce_ban", "moderate_raids")
 
+@router.post("/guild/{guild_id}/settings", tags=["guild"])
+async def update_settings(guild_id: str, item: Settings, principal: Principal = Depends(require_guild_access)):
   db = await get_db()
 
-  # Check the user has access to the guild
-  guild = await db.guild.find_unique(
-    where={
-      "owner_id": user_id,
-      "guild_id": guild_id
-    }
-  )
-
-  if not guild:
-    raise HTTPException(status_code=401, detail="Unauthorised to access this guild")
+  optional = {field: getattr(item, field) for field in OPTIONAL_FIELDS if field in item.model_fields_set}
 
   await db.settings.update(
     where={
       "guild_id": guild_id
     },
     data={
+      **optional,
       "confidence_limit": item.confidence_limit,
       "moderation_message": item.moderation_message,
       "enable_h": item.enable_h,
@@ -225,4 +354,6 @@ async def update_settings(guild_id: str, item: Settings, request: Request):
     }
   )
 
+  await db.disconnect()
+
   return {"status": "success"}
\ No newline at end of file
@@ -1,26 +1,17 @@
 from app.dependencies import get_db
-import jwt
-import os
+from app.security import Principal, get_principal
 from datetime import datetime
-from dotenv import load_dotenv
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends
 
-load_dotenv()
 router = APIRouter()
 
 @router.get('/message-stats', tags=['me'])
-async def get_me(request: Request):
-  auth_header = request.headers.get(os.getenv('USER_COOKIE_NAME'))
-  if not auth_header:
-    raise HTTPException(status_code=401, detail="Authorization header missing")
-
+async def get_me(principal: Principal = Depends(get_principal)):
   db = await get_db()
 
-  token = jwt.decode(auth_header, os.getenv('JWT_SECRET_KEY'), algorithms=['HS256'])
-
   guilds = await db.guild.find_many(
     where={
-      "owner_id": token["user_id"]
+      "owner_id": principal.user_id
     },
   )
 
@@ -0,0 +1,30 @@
+from app.registry import registry
+from app.security import require_admin
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel
+
+router = APIRouter()
+
+class ModelReloadRequest(BaseModel):
+  # Defaults to reloading from the version's current location
+  model_path: str | None = None
+  tokenizer_path: str | None = None
+
+@router.get("/models", tags=["models"], dependencies=[Depends(require_admin)])
+async def get_models():
+  # Per-version load state, memory, latency and shadow agreement
+  return registry.report()
+
+@router.post("/models/{version}/reload", tags=["models"], dependencies=[Depends(require_admin)])
+async def reload_model(version: str, item: ModelReloadRequest | None = None):
+  if version not in registry.versions:
+    raise HTTPException(status_code=404, detail="Model version not found")
+
+  item = item or ModelReloadRequest()
+  try:
+    reloaded = await registry.reload(version, item.model_path, item.tokenizer_path)
+  except Exception as e:
+    print(f"Error reloading model {version}: {e}")
+    raise HTTPException(status_code=500, detail="Model reload failed, still serving the previous weights")
+
+  return {"version": version, "model_path": reloaded.model_path, **reloaded.report()}
@@ -1,128 +1,264 @@
-from app.dependencies import get_model, get_tokenizer, get_db
-from datetime import datetime
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+import asyncio
+import json
+import os
+from app.dependencies import get_db
+from app import jobs, ratelimit, webhooks
+from app.metrics import Counter, Gauge
+from app.moderation import ModerationRequest, moderate
+from app.security import is_bot, verify_bot_key
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import ValidationError
 
-class ModerationRequestMetaData(BaseModel):
-  message_id: int
-  author_id: int
-  author_name: str
-  guild_id: str
+load_dotenv()
 
-class ModerationRequest(BaseModel):
-  input_text: str
-  metadata: ModerationRequestMetaData
+# Requests read off the stream but not yet written back to the client
+STREAM_MAX_IN_FLIGHT = int(os.getenv('STREAM_MAX_IN_FLIGHT', '64'))
+STREAM_MAX_LINE_BYTES = int(os.getenv('STREAM_MAX_LINE_BYTES', '65536'))
+WS_MAX_IN_FLIGHT = int(os.getenv('WS_MAX_IN_FLIGHT', '256'))
+WS_HEARTBEAT_INTERVAL = float(os.getenv('WS_HEARTBEAT_INTERVAL', '20'))
+WS_IDLE_TIMEOUT = float(os.getenv('WS_IDLE_TIMEOUT', '60'))
+# Plain http callbacks are only for local development
+JOB_CALLBACK_ALLOW_HTTP = os.getenv('JOB_CALLBACK_ALLOW_HTTP', 'false').lower() == 'true'
+
+ws_connections = Gauge("aidle_ws_connections", "Open bot WebSocket connections")
+ws_messages = Counter("aidle_ws_messages_total", "Moderation requests received over WebSocket")
 
 router = APIRouter()
 
 @router.post("/moderate", tags=["moderation"])
-async def moderate_text(item: ModerationRequest):
+async def moderate_text(
+  item: ModerationRequest,
+  run_async: bool = Query(False, alias="async"),
+  callback_url: str | None = None,
+  authenticated: bool = Depends(is_bot)
+):
+  if callback_url:
+    # The server makes these requests on the caller's behalf, so only the bot may set one
+    if not authenticated:
+      raise HTTPException(status_code=401, detail="callback_url requires the bot key")
+    if not (callback_url.startswith("https://") or (JOB_CALLBACK_ALLOW_HTTP and callback_url.startswith("http://"))):
+      raise HTTPException(status_code=422, detail="callback_url must be an https URL")
+    error = await webhooks.check_destination(callback_url)
+    if error is not None:
+      raise HTTPException(status_code=422, detail=error)
+
   db = await get_db()
 
-  metadata = item.metadata
+  try:
+    if run_async:
+      # Queued for the worker pool, poll /moderate/jobs/{job_id} or wait for the callback
+      job_id = await jobs.enqueue(db, item, callback_url, authenticated)
+      return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+    return await moderate(db, item, authenticated)
+  finally:
+    await db.disconnect()
 
-  # Check to see if they've hit their plan limit
-  guild = await db.guild.find_unique(
+@router.get("/moderate/jobs/{job_id}", tags=["moderation"])
+async def get_job(job_id: str):
+  db = await get_db()
+  job = await db.moderationjob.find_unique(
     where={
-      "guild_id": metadata.guild_id
-    },
-    include={
-      "owner": True
+      "id": job_id
     }
   )
+  await db.disconnect()
 
-  settings = await db.settings.find_unique(
-    where={
-      "guild_id": metadata.guild_id
-    }
-  )
-  
-  owner = guild.owner
+  if not job:
+    raise HTTPException(status_code=404, detail="Job not found")
 
-  plan = await db.plan.find_unique(
-    where={
-      "id": owner.plan_id
-    }
-  )
+  return jobs.serialize(job)
 
-  all_guilds = await db.guild.find_many(
-    where={
-      "owner_id": owner.owner_id
-    }
-  )
-  guildIds = []
+class NDJSONStreamingResponse(StreamingResponse):
+  media_type = "application/x-ndjson"
 
-  for x in range(len(all_guilds)):
-    guildIds.append(all_guilds[x].guild_id)
+  # The request body is still being read while verdicts go out, so skip the
+  # disconnect listener that would otherwise consume receive() underneath us
+  async def __call__(self, scope, receive, send):
+    await self.stream_response(send)
+    if self.background is not None:
+      await self.background()
 
-  messages = await db.message.find_many(
-    where={
-      "created_date": {
-        "gte": datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-      },
-      "guild_id": {
-        "in": guildIds
-      }
-    }
-  )
+async def _stream_verdicts(request: Request, authenticated: bool):
+  db = await get_db()
+  # Both bounds together give backpressure: a slow reader stalls the writers,
+  # which hold their slots, which stops us reading more of the request body
+  results: asyncio.Queue = asyncio.Queue(maxsize=STREAM_MAX_IN_FLIGHT)
+  slots = asyncio.Semaphore(STREAM_MAX_IN_FLIGHT)
+  tasks = set()
 
-  if len(messages) + 1 > plan.max_requests:
-    raise HTTPException(status_code=429, detail="You are rate limited until midnight.")
-
-  model = get_model()
-  tokenizer = get_tokenizer()
-
-  # Run the model on the input text
-  inputs = tokenizer(item.input_text, return_tensors="pt")
-  outputs = model(**inputs)
-
-  # Get the predicted logits
-  logits = outputs.logits
-
-  # Apply softmax to get probabilities (scores)
-  probabilities = logits.softmax(dim=-1).squeeze()
-
-  # Retrieve the labels
-  id2label = model.config.id2label
-  labels = [id2label[idx] for idx in range(len(probabilities))]
-
-  # Combine labels and probabilities, then sort
-  label_prob_pairs = list(zip(labels, probabilities))
-  label_prob_pairs.sort(key=lambda item: item[1], reverse=True) 
-
-  total_probability = 0
-  simpleSettings = {
-    "enable_ok": False,
-    "enable_h": settings.enable_h,
-    "enable_v": settings.enable_v,
-    "enable_s": settings.enable_s,
-    "enable_h2": settings.enable_h2,
-    "enable_v2": settings.enable_v2,
-    "enable_s3": settings.enable_s3,
-    "enable_hr": settings.enable_hr,
-    "enable_sh": settings.enable_sh,
-  }
-  confidence_limit = settings.confidence_limit
-  for label, probability in label_prob_pairs:
-    if label != "OK" and simpleSettings["enable_" + label.lower()] == True:
-      total_probability += float(probability)
-
-  # Prepare the response
-  response = [{"label": label, "probability": float(probability)} for label, probability in label_prob_pairs]
-
-  # Store the response in the database
-  await db.message.create(
-    data={
-      "message_id": metadata.message_id,
-      "guild_id": metadata.guild_id,
-      "author_id": metadata.author_id,
-      "author_name": metadata.author_name,
-      "score": total_probability
-    }
-  )
+  async def handle(line: bytes):
+    try:
+      item = ModerationRequest.model_validate_json(line)
+    except ValidationError as e:
+      # The raw line isn't echoed back, it may not even be text
+      await results.put({"error": "Invalid request", "status": 422, "detail": e.errors(include_url=False, include_context=False, include_input=False)})
+      return
+
+    if await ratelimit.check(item.metadata.guild_id, item.metadata.author_id):
+      await results.put({"message_id": item.metadata.message_id, "error": "Rate limited", "status": 429})
+      return
+
+    try:
+      verdict = {"message_id": item.metadata.message_id, **await moderate(db, item, authenticated)}
+    except HTTPException as e:
+      verdict = {"message_id": item.metadata.message_id, "error": e.detail, "status": e.status_code}
+    except Exception as e:
+      print(f"Error moderating streamed message: {e}")
+      verdict = {"message_id": item.metadata.message_id, "error": "Moderation failed", "status": 500}
+
+    await results.put(verdict)
+
+  async def read():
+    def finished(task):
+      tasks.discard(task)
+      slots.release()
+
+    async def submit(line: bytes):
+      if len(line) > STREAM_MAX_LINE_BYTES:
+        await results.put({"error": "Line too long", "status": 413})
+      elif line.strip():
+        await slots.acquire()
+        task = asyncio.create_task(handle(line))
+        tasks.add(task)
+        task.add_done_callback(finished)
+
+    try:
+      buffer = b""
+      # Set while throwing away the rest of a line that's already too long
+      skipping = False
+      async for chunk in request.stream():
+        if skipping:
+          end = chunk.find(b"\n")
+          if end < 0:
+            continue
+          chunk, skipping = chunk[end + 1:], False
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+          await submit(line)
+        if len(buffer) > STREAM_MAX_LINE_BYTES:
+          # Reported and skipped, the lines around it still get their verdicts
+          await results.put({"error": "Line too long", "status": 413})
+          buffer, skipping = b"", True
+      if not skipping:
+        await submit(buffer)
+      await asyncio.gather(*tasks)
+    finally:
+      await results.put(None)
+
+  reader = asyncio.create_task(read())
+  try:
+    while True:
+      verdict = await results.get()
+      if verdict is None:
+        break
+      try:
+        line = json.dumps(verdict)
+      except (TypeError, ValueError) as e:
+        # One unserialisable verdict mustn't end the stream for every line after it
+        print(f"Error serialising streamed verdict: {e}")
+        line = json.dumps({"message_id": verdict.get("message_id"), "error": "Moderation failed", "status": 500})
+      yield line + "\n"
+  finally:
+    reader.cancel()
+    for task in list(tasks):
+      task.cancel()
+    await db.disconnect()
+
+@router.post("/moderate/stream", tags=["moderation"])
+async def moderate_stream(request: Request, authenticated: bool = Depends(is_bot)):
+  return NDJSONStreamingResponse(_stream_verdicts(request, authenticated))
+
+async def _moderate_message(db, correlation_id, data) -> dict:
+  try:
+    item = ModerationRequest.model_validate(data)
+  except ValidationError as e:
+    return {"id": correlation_id, "type": "error", "status": 422, "error": "Invalid request", "detail": e.errors(include_url=False, include_context=False)}
+
+  if await ratelimit.check(item.metadata.guild_id, item.metadata.author_id):
+    return {"id": correlation_id, "type": "error", "status": 429, "error": "Rate limited"}
+
+  try:
+    return {"id": correlation_id, "type": "verdict", "data": {"message_id": item.metadata.message_id, **await moderate(db, item, authenticated=True)}}
+  except HTTPException as e:
+    return {"id": correlation_id, "type": "error", "status": e.status_code, "error": e.detail}
+  except Exception as e:
+    print(f"Error moderating WebSocket message: {e}")
+    return {"id": correlation_id, "type": "error", "status": 500, "error": "Moderation failed"}
+
+# Only reachable with the bot key, so its verdicts are enforced
+# Messages are {"id": ..., "type": "moderate", "data": ModerationRequest}, replies carry
+# the same id so the bot can match them up whatever order they finish in
+@router.websocket("/ws/moderate")
+async def moderate_socket(websocket: WebSocket):
+  if not verify_bot_key(websocket.headers.get("authorization") or websocket.query_params.get("token")):
+    await websocket.close(code=1008)
+    return
+
+  await websocket.accept()
+  ws_connections.inc()
+
+  db = await get_db()
+  send_lock = asyncio.Lock()
+  slots = asyncio.Semaphore(WS_MAX_IN_FLIGHT)
+  tasks = set()
+
+  async def send(message: dict):
+    async with send_lock:
+      await websocket.send_text(json.dumps(message))
+
+  async def handle(correlation_id, data):
+    try:
+      await send(await _moderate_message(db, correlation_id, data))
+    except (WebSocketDisconnect, RuntimeError):
+      # The bot went away before its verdict was ready
+      pass
+    finally:
+      slots.release()
+
+  async def heartbeat():
+    try:
+      while True:
+        await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+        await send({"type": "ping"})
+    except (WebSocketDisconnect, RuntimeError):
+      pass
+
+  pinger = asyncio.create_task(heartbeat())
+  try:
+    while True:
+      # Stop reading once this connection has too much outstanding work
+      await slots.acquire()
+      try:
+        message = json.loads(await asyncio.wait_for(websocket.receive_text(), WS_IDLE_TIMEOUT))
+      except asyncio.TimeoutError:
+        await websocket.close(code=1001, reason="Idle timeout")
+        break
+      except json.JSONDecodeError:
+        slots.release()
+        await send({"type": "error", "status": 400, "error": "Invalid JSON"})
+        continue
+
+      kind = message.get("type") if isinstance(message, dict) else None
+      if kind != "moderate":
+        slots.release()
+        if kind == "ping":
+          await send({"type": "pong"})
+        elif kind != "pong":
+          await send({"type": "error", "status": 400, "error": "Unknown message type"})
+        continue
 
-  return {
-    "results": response,
-    "moderate": True if total_probability >= (confidence_limit / 100) else False,
-    "moderation_message": settings.moderation_message
-  }
\ No newline at end of file
+      ws_messages.inc()
+      task = asyncio.create_task(handle(message.get("id"), message.get("data")))
+      tasks.add(task)
+      task.add_done_callback(tasks.discard)
+  except WebSocketDisconnect:
+    pass
+  finally:
+    pinger.cancel()
+    for task in list(tasks):
+      task.cancel()
+    ws_connections.dec()
+    await db.disconnect()
@@ -0,0 +1,35 @@
+import time
+from app import risk
+from app.authorization import require_guild_access
+from app.dependencies import get_db
+from app.security import Principal
+from fastapi import APIRouter, Depends
+
+router = APIRouter()
+
+# Stored scores were decayed to different times, bring them all to now before ranking
+TOP_AUTHORS_SQL = '''
+  SELECT "author_id"::text AS "author_id", "author_name", "messages", "flagged",
+    "risk" * exp(-%r * GREATEST($2 - "updated", 0)) AS "risk"
+  FROM "AuthorRisk"
+  WHERE "guild_id" = $1
+  ORDER BY 5 DESC
+  LIMIT $3
+''' % risk.DECAY
+
+@router.get("/guilds/{guild_id}/risk", tags=["guild"])
+async def get_author_risk(guild_id: str, limit: int = 50, principal: Principal = Depends(require_guild_access)):
+  # This worker's latest updates first, so the dashboard sees them
+  try:
+    await risk.flush()
+  except Exception as e:
+    print(f"Error flushing author risk scores: {e}")
+
+  db = await get_db()
+  authors = await db.query_raw(TOP_AUTHORS_SQL, guild_id, time.time(), min(max(limit, 1), 500))
+  await db.disconnect()
+
+  return {
+    "half_life_hours": risk.RISK_HALF_LIFE_HOURS,
+    "authors": authors
+  }
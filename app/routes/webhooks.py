@@ -0,0 +1,43 @@
+import json
+from app.dependencies import get_db
+from app.security import require_admin
+from app.webhooks import dispatcher
+from fastapi import APIRouter, Depends
+
+router = APIRouter()
+
+@router.get("/webhooks", tags=["webhooks"], dependencies=[Depends(require_admin)])
+async def get_webhooks():
+  # Verdicts waiting per destination
+  return dispatcher.report()
+
+@router.get("/webhooks/dead-letters", tags=["webhooks"], dependencies=[Depends(require_admin)])
+async def get_dead_letters(limit: int = 100):
+  db = await get_db()
+  letters = await db.webhookdeadletter.find_many(
+    order={
+      "created_date": "desc"
+    },
+    take=min(max(limit, 1), 1000)
+  )
+  total = await db.webhookdeadletter.count()
+  await db.disconnect()
+
+  return {
+    "total": total,
+    "dead_letters": [
+      {
+        "id": letter.id,
+        "url": letter.url,
+        "payload": json.loads(letter.payload),
+        "error": letter.error,
+        "attempts": letter.attempts,
+        "created_date": letter.created_date.isoformat()
+      }
+      for letter in letters
+    ]
+  }
+
+@router.post("/webhooks/dead-letters/redeliver", tags=["webhooks"], dependencies=[Depends(require_admin)])
+async def redeliver_dead_letters(limit: int = 1000):
+  return {"requeued": await dispatcher.redeliver(min(max(limit, 1), 10000))}
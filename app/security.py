@@ -0,0 +1,109 @@
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict
+import jwt
+from dotenv import load_dotenv
+from fastapi import HTTPException, Security
+from fastapi.security import APIKeyCookie, APIKeyHeader
+from pydantic import BaseModel
+from app.metrics import cache_counters
+
+load_dotenv()
+
+# Read once at startup rather than on every request
+USER_COOKIE_NAME = os.getenv('USER_COOKIE_NAME', 'aidle_user')
+JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY')
+JWT_ALGORITHM = 'HS256'
+JWT_CACHE_SIZE = int(os.getenv('JWT_CACHE_SIZE', '10000'))
+JWT_CACHE_TTL = float(os.getenv('JWT_CACHE_TTL', '300'))
+BOT_API_KEY = os.getenv('BOT_API_KEY')
+ADMIN_API_KEY = os.getenv('ADMIN_API_KEY')
+
+class Principal(BaseModel):
+  user_id: str
+  session_id: str
+
+# digest -> (expires_at, principal), oldest first
+_cache: OrderedDict[bytes, tuple[float, Principal]] = OrderedDict()
+
+cache_hit, cache_miss = cache_counters("jwt")
+
+token_header = APIKeyHeader(name=USER_COOKIE_NAME, auto_error=False)
+# EventSource can't set headers, so the /events stream also accepts the token as a cookie.
+# Nothing else does: a cookie rides along on cross-site requests, a header doesn't
+token_cookie = APIKeyCookie(name=USER_COOKIE_NAME, auto_error=False)
+admin_header = APIKeyHeader(name="authorization", auto_error=False)
+bot_header = APIKeyHeader(name="authorization", auto_error=False)
+
+def _digest(token: str) -> bytes:
+  return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+def decode_token(token: str) -> Principal:
+  now = time.time()
+  key = _digest(token)
+
+  cached = _cache.get(key)
+  if cached is not None:
+    expires_at, principal = cached
+    if expires_at > now:
+      _cache.move_to_end(key)
+      cache_hit.inc()
+      return principal
+    del _cache[key]
+
+  cache_miss.inc()
+
+  try:
+    claims = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+  except jwt.InvalidTokenError:
+    raise HTTPException(status_code=401, detail="Invalid authorization token")
+
+  if 'user_id' not in claims or 'sid' not in claims:
+    raise HTTPException(status_code=401, detail="Invalid authorization token")
+
+  principal = Principal(user_id=str(claims['user_id']), session_id=claims['sid'])
+
+  # Never keep a token around past its own expiry
+  expires_at = now + JWT_CACHE_TTL
+  if 'exp' in claims:
+    expires_at = min(expires_at, float(claims['exp']))
+
+  _cache[key] = (expires_at, principal)
+  if len(_cache) > JWT_CACHE_SIZE:
+    _cache.popitem(last=False)
+
+  return principal
+
+async def get_principal(token: str | None = Security(token_header)) -> Principal:
+  if not token:
+    raise HTTPException(status_code=401, detail="Authorization header missing")
+
+  return decode_token(token)
+
+async def get_stream_principal(
+  token: str | None = Security(token_header),
+  cookie: str | None = Security(token_cookie)
+) -> Principal:
+  # Only for read-only event streams
+  token = token or cookie
+  if not token:
+    raise HTTPException(status_code=401, detail="Authorization header missing")
+
+  return decode_token(token)
+
+def verify_bot_key(value: str | None) -> bool:
+  # Bot connections are disabled until a key is configured
+  if not BOT_API_KEY or not value:
+    return False
+  return hmac.compare_digest(value.removeprefix('Bot ').encode(), BOT_API_KEY.encode())
+
+async def is_bot(value: str | None = Security(bot_header)) -> bool:
+  # Optional, anyone can ask for a verdict but only the bot's requests are acted on
+  return verify_bot_key(value)
+
+async def require_admin(value: str | None = Security(admin_header)):
+  # Operational endpoints are disabled until a key is configured
+  if not ADMIN_API_KEY or not value or not hmac.compare_digest(value.removeprefix('Bearer ').encode(), ADMIN_API_KEY.encode()):
+    raise HTTPException(status_code=401, detail="Admin key required")
@@ -0,0 +1,212 @@
+import asyncio
+import os
+import secrets
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from pydantic import BaseModel, Field
+from app.dependencies import get_db
+from app.metrics import cache_counters
+
+load_dotenv()
+
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '10000'))
+SESSION_TTL = int(os.getenv('SESSION_TTL', str(30 * 24 * 60 * 60)))
+# How often expired sessions are deleted from the shared store
+SESSION_PURGE_INTERVAL = float(os.getenv('SESSION_PURGE_INTERVAL', '3600'))
+
+class SessionData(BaseModel):
+  session_id: str
+  user_id: str
+  access_token: str
+  refresh_token: str | None = None
+  token_type: str | None = None
+  scope: str | None = None
+  # Unix timestamp when the Discord access token stops being valid
+  expires_at: float
+  # Unix timestamp when the login itself ends, the same moment its JWT expires
+  ends_at: float = Field(default_factory=lambda: time.time() + SESSION_TTL)
+
+  @property
+  def ended(self) -> bool:
+    return self.ends_at <= time.time()
+
+cache_hit, cache_miss = cache_counters("session")
+
+def new_session_id() -> str:
+  return secrets.token_urlsafe(24)
+
+class SessionStore(ABC):
+  @abstractmethod
+  async def get(self, session_id: str) -> SessionData | None:
+    ...
+
+  @abstractmethod
+  async def set(self, session: SessionData):
+    ...
+
+  @abstractmethod
+  async def delete(self, session_id: str):
+    ...
+
+  async def get_fresh(self, session_id: str) -> SessionData | None:
+    # Skips any per-worker cache, for reads that have to see other workers' writes
+    return await self.get(session_id)
+
+class MemorySessionStore(SessionStore):
+  # Only valid for a single worker unless it sits in front of a shared backend
+  def __init__(self, max_size: int = SESSION_CACHE_SIZE):
+    self.max_size = max_size
+    self._sessions: OrderedDict[str, SessionData] = OrderedDict()
+
+  async def get(self, session_id: str) -> SessionData | None:
+    session = self._sessions.get(session_id)
+    if session is not None and session.ended:
+      del self._sessions[session_id]
+      session = None
+    if session is None:
+      cache_miss.inc()
+      return None
+    self._sessions.move_to_end(session_id)
+    cache_hit.inc()
+    return session
+
+  async def set(self, session: SessionData):
+    self._sessions[session.session_id] = session
+    self._sessions.move_to_end(session.session_id)
+    if len(self._sessions) > self.max_size:
+      self._sessions.popitem(last=False)
+
+  async def delete(self, session_id: str):
+    self._sessions.pop(session_id, None)
+
+class PostgresSessionStore(SessionStore):
+  async def get(self, session_id: str) -> SessionData | None:
+    db = await get_db()
+    row = await db.session.find_unique(where={"id": session_id})
+    await db.disconnect()
+
+    if not row:
+      return None
+
+    # Rows from before ends_at was stored last SESSION_TTL from their creation
+    ends_at = row.ends_at or row.created_date + timedelta(seconds=SESSION_TTL)
+    if ends_at.timestamp() <= time.time():
+      return None
+
+    return SessionData(
+      session_id=row.id,
+      user_id=row.user_id,
+      access_token=row.access_token,
+      refresh_token=row.refresh_token,
+      token_type=row.token_type,
+      scope=row.scope,
+      expires_at=row.expires_at.timestamp(),
+      ends_at=ends_at.timestamp()
+    )
+
+  async def set(self, session: SessionData):
+    data = {
+      "user_id": session.user_id,
+      "access_token": session.access_token,
+      "refresh_token": session.refresh_token,
+      "token_type": session.token_type,
+      "scope": session.scope,
+      "expires_at": datetime.fromtimestamp(session.expires_at, tz=timezone.utc),
+      "ends_at": datetime.fromtimestamp(session.ends_at, tz=timezone.utc),
+      "updated_date": datetime.now(tz=timezone.utc)
+    }
+
+    db = await get_db()
+    await db.session.upsert(
+      where={"id": session.session_id},
+      data={
+        "create": {"id": session.session_id, **data},
+        "update": data
+      }
+    )
+    await db.disconnect()
+
+  async def delete(self, session_id: str):
+    db = await get_db()
+    await db.session.delete_many(where={"id": session_id})
+    await db.disconnect()
+
+  async def purge(self) -> int:
+    now = datetime.now(tz=timezone.utc)
+    db = await get_db()
+    deleted = await db.session.delete_many(
+      where={
+        "OR": [
+          {"ends_at": {"lt": now}},
+          {"ends_at": None, "created_date": {"lt": now - timedelta(seconds=SESSION_TTL)}}
+        ]
+      }
+    )
+    await db.disconnect()
+    return deleted
+
+class CachedSessionStore(SessionStore):
+  # Read-through / write-through LRU in front of a shared backend
+  def __init__(self, backend: SessionStore, max_size: int = SESSION_CACHE_SIZE):
+    self.backend = backend
+    self.cache = MemorySessionStore(max_size)
+
+  async def get(self, session_id: str) -> SessionData | None:
+    session = await self.cache.get(session_id)
+    if session is None:
+      session = await self.backend.get(session_id)
+      if session is not None:
+        await self.cache.set(session)
+    return session
+
+  async def set(self, session: SessionData):
+    await self.backend.set(session)
+    await self.cache.set(session)
+
+  async def delete(self, session_id: str):
+    await self.cache.delete(session_id)
+    await self.backend.delete(session_id)
+
+  async def get_fresh(self, session_id: str) -> SessionData | None:
+    session = await self.backend.get_fresh(session_id)
+    if session is None:
+      await self.cache.delete(session_id)
+    else:
+      await self.cache.set(session)
+    return session
+
+def _build_store() -> SessionStore:
+  if SESSION_BACKEND == 'postgres':
+    return CachedSessionStore(PostgresSessionStore())
+  return MemorySessionStore()
+
+store = _build_store()
+_task: asyncio.Task | None = None
+
+async def _purge_loop(backend: PostgresSessionStore):
+  while True:
+    try:
+      await backend.purge()
+    except Exception as e:
+      print(f"Error purging expired sessions: {e}")
+    await asyncio.sleep(SESSION_PURGE_INTERVAL)
+
+def start():
+  # Memory sessions drop out on their own, only the shared table needs sweeping
+  global _task
+  if _task is None and isinstance(store, CachedSessionStore) and isinstance(store.backend, PostgresSessionStore):
+    _task = asyncio.create_task(_purge_loop(store.backend))
+
+async def stop():
+  global _task
+  if _task is not None:
+    _task.cancel()
+    try:
+      await _task
+    except asyncio.CancelledError:
+      pass
+    _task = None
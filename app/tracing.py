@@ -0,0 +1,104 @@
+import logging
+import os
+import random
+from collections import Counter
+from contextvars import ContextVar
+from time import perf_counter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger("aidle.db")
+
+# "off", "sampled" (DB_TRACE_SAMPLE_RATE of requests) or "full"
+DB_TRACE = os.getenv('DB_TRACE', 'off')
+DB_TRACE_SAMPLE_RATE = float(os.getenv('DB_TRACE_SAMPLE_RATE', '0.01'))
+DB_QUERY_BUDGET = int(os.getenv('DB_QUERY_BUDGET', '10'))
+# The same model.action this many times in one request looks like an N+1
+DB_REPEAT_THRESHOLD = int(os.getenv('DB_REPEAT_THRESHOLD', '5'))
+DB_TRACE_HEADER = os.getenv('DB_TRACE_HEADER', 'false').lower() == 'true'
+
+class QueryRecord:
+  __slots__ = ("model", "action", "duration", "rows")
+
+  def __init__(self, model: str, action: str, duration: float, rows: int):
+    self.model = model
+    self.action = action
+    self.duration = duration
+    self.rows = rows
+
+class RequestTrace:
+  def __init__(self, method: str, path: str):
+    self.method = method
+    self.path = path
+    self.queries: list[QueryRecord] = []
+
+  def repeated(self) -> list[tuple[str, int]]:
+    counts = Counter("%s.%s" % (query.model, query.action) for query in self.queries)
+    return [(name, count) for name, count in counts.most_common() if count >= DB_REPEAT_THRESHOLD]
+
+  def summary(self) -> str:
+    total = sum(query.duration for query in self.queries) * 1000
+    rows = sum(query.rows for query in self.queries)
+    counts = Counter("%s.%s" % (query.model, query.action) for query in self.queries)
+    breakdown = ", ".join("%s x%d" % pair for pair in counts.most_common())
+    return "%d queries, %.1fms, %d rows [%s]" % (len(self.queries), total, rows, breakdown)
+
+_trace: ContextVar[RequestTrace | None] = ContextVar("aidle_request_trace", default=None)
+
+def _row_count(result) -> int:
+  if result is None:
+    return 0
+  if isinstance(result, bool):
+    return int(result)
+  if isinstance(result, int):
+    return result
+  if isinstance(result, list):
+    return len(result)
+  return 1
+
+def record(model: str, action: str, duration: float, result):
+  trace = _trace.get()
+  if trace is not None:
+    trace.queries.append(QueryRecord(model, action, duration, _row_count(result)))
+
+def _should_trace() -> bool:
+  if DB_TRACE == 'full':
+    return True
+  return DB_TRACE == 'sampled' and random.random() < DB_TRACE_SAMPLE_RATE
+
+class QueryTraceMiddleware:
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http" or not _should_trace():
+      await self.app(scope, receive, send)
+      return
+
+    trace = RequestTrace(scope["method"], scope["path"])
+    token = _trace.set(trace)
+
+    async def send_with_trace(message):
+      # Streaming responses only report what ran before the headers went out
+      if DB_TRACE_HEADER and message["type"] == "http.response.start":
+        message.setdefault("headers", [])
+        message["headers"] = list(message["headers"]) + [(b"x-db-trace", trace.summary().encode())]
+      await send(message)
+
+    started = perf_counter()
+    try:
+      await self.app(scope, receive, send_with_trace)
+    finally:
+      _trace.reset(token)
+      elapsed = (perf_counter() - started) * 1000
+      repeated = trace.repeated()
+
+      if len(trace.queries) > DB_QUERY_BUDGET or repeated:
+        logger.warning(
+          "%s %s exceeded DB budget (%d) in %.1fms: %s%s",
+          trace.method, trace.path, DB_QUERY_BUDGET, elapsed, trace.summary(),
+          "; possible N+1: " + ", ".join("%s x%d" % pair for pair in repeated) if repeated else ""
+        )
+      else:
+        logger.debug("%s %s in %.1fms: %s", trace.method, trace.path, elapsed, trace.summary())
@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import random
+import socket
+import time
+from collections import deque
+from urllib.parse import urlsplit
+import httpx
+from dotenv import load_dotenv
+from app.dependencies import get_db
+from app.metrics import COUNT_BUCKETS, Counter, Gauge, Histogram
+
+load_dotenv()
+
+# Verdicts per POST, and how long the first one waits for company
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', '100'))
+WEBHOOK_BATCH_WAIT_MS = float(os.getenv('WEBHOOK_BATCH_WAIT_MS', '200'))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '6'))
+WEBHOOK_BACKOFF_BASE = float(os.getenv('WEBHOOK_BACKOFF_BASE', '1'))
+WEBHOOK_BACKOFF_MAX = float(os.getenv('WEBHOOK_BACKOFF_MAX', '300'))
+# Verdicts held in memory across all destinations, and per destination; the excess is dead-lettered
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', '50000'))
+WEBHOOK_MAX_PENDING_PER_DESTINATION = int(os.getenv('WEBHOOK_MAX_PENDING_PER_DESTINATION', '5000'))
+WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', '10'))
+# Receivers can check x-aidle-signature against an HMAC-SHA256 of the body
+WEBHOOK_SIGNING_SECRET = os.getenv('WEBHOOK_SIGNING_SECRET')
+# Comma separated hosts callbacks may point at; when empty, any host resolving only to public addresses
+WEBHOOK_ALLOWED_HOSTS = {host.strip().lower() for host in os.getenv('WEBHOOK_ALLOWED_HOSTS', '').split(',') if host.strip()}
+
+# A destination's sender exits after this long without work
+_IDLE_SECONDS = 60
+
+webhook_deliveries = Counter("aidle_webhook_deliveries_total", "Webhook batch POSTs by outcome", labelnames=("result",))
+delivered = webhook_deliveries.labels("delivered")
+retried = webhook_deliveries.labels("retried")
+dead_lettered = webhook_deliveries.labels("dead_lettered")
+webhook_overflow = Counter("aidle_webhook_overflow_total", "Verdicts dead-lettered because the pending buffer was full")
+webhook_pending = Gauge("aidle_webhook_pending", "Verdicts waiting for webhook delivery")
+webhook_destinations = Gauge("aidle_webhook_destinations", "Webhook destinations with an active sender")
+webhook_latency = Histogram("aidle_webhook_delivery_latency_seconds", "Time from verdict to acknowledged delivery", buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0))
+webhook_duration = Histogram("aidle_webhook_request_duration_seconds", "Webhook POST round trip")
+webhook_batch_sizes = Histogram("aidle_webhook_batch_size", "Verdicts per webhook POST", buckets=COUNT_BUCKETS)
+
+async def check_destination(url: str) -> str | None:
+  # Callback URLs come from clients, never let one point us at our own network or a metadata endpoint
+  try:
+    parts = urlsplit(url)
+    host, port = (parts.hostname or "").lower(), parts.port
+  except ValueError:
+    return "Invalid callback_url"
+  if not host:
+    return "Invalid callback_url"
+  if WEBHOOK_ALLOWED_HOSTS:
+    return None if host in WEBHOOK_ALLOWED_HOSTS else "callback_url host is not allowed"
+
+  try:
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port or 443, type=socket.SOCK_STREAM)
+  except (socket.gaierror, UnicodeError):
+    return "callback_url host does not resolve"
+  for info in infos:
+    address = ipaddress.ip_address(info[4][0].split("%")[0])
+    if address.version == 6 and address.ipv4_mapped:
+      address = address.ipv4_mapped
+    if not address.is_global:
+      return "callback_url must resolve to a public address"
+  return None
+
+class DeliveryError(Exception):
+  def __init__(self, message: str, retry: bool, retry_after: float | None = None):
+    super().__init__(message)
+    self.retry = retry
+    self.retry_after = retry_after
+
+class Destination:
+  def __init__(self, url: str):
+    self.url = url
+    # (queued_at, payload), oldest first
+    self.pending: deque[tuple[float, dict]] = deque()
+    self.ready = asyncio.Event()
+    self.task: asyncio.Task | None = None
+
+class WebhookDispatcher:
+  def __init__(self):
+    self._destinations: dict[str, Destination] = {}
+    self._pending = 0
+    self._client: httpx.AsyncClient | None = None
+    self._dead: list[dict] = []
+    self._dead_task: asyncio.Task | None = None
+
+  def _get_client(self) -> httpx.AsyncClient:
+    if self._client is None:
+      self._client = httpx.AsyncClient(
+        timeout=WEBHOOK_TIMEOUT,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60)
+      )
+    return self._client
+
+  def send(self, url: str, payload: dict):
+    destination = self._destinations.get(url)
+    if destination is None:
+      destination = self._destinations[url] = Destination(url)
+
+    if self._pending >= WEBHOOK_MAX_PENDING or len(destination.pending) >= WEBHOOK_MAX_PENDING_PER_DESTINATION:
+      # A receiver that's down mustn't grow us without bound
+      webhook_overflow.inc()
+      self._dead_letter(url, [payload], "Pending buffer full", 0)
+      return
+
+    destination.pending.append((time.monotonic(), payload))
+    self._pending += 1
+    webhook_pending.set(self._pending)
+    destination.ready.set()
+
+    if destination.task is None:
+      destination.task = asyncio.create_task(self._run(destination))
+      webhook_destinations.inc()
+
+  def _sign(self, body: bytes) -> dict:
+    headers = {"content-type": "application/json"}
+    if WEBHOOK_SIGNING_SECRET:
+      headers["x-aidle-signature"] = "sha256=" + hmac.new(WEBHOOK_SIGNING_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return headers
+
+  async def _post(self, url: str, payloads: list[dict]):
+    body = json.dumps({"verdicts": payloads}).encode()
+    started = time.perf_counter()
+    try:
+      r = await self._get_client().post(url, content=body, headers=self._sign(body))
+    except httpx.HTTPError as e:
+      raise DeliveryError(str(e) or type(e).__name__, retry=True)
+    finally:
+      webhook_duration.observe(time.perf_counter() - started)
+
+    if r.is_success:
+      return
+    retry_after = None
+    if r.status_code == 429:
+      try:
+        retry_after = float(r.headers.get("retry-after", ""))
+      except ValueError:
+        pass
+    # Other client errors mean the receiver rejects this batch, trying again won't help
+    retry = r.status_code >= 500 or r.status_code in (408, 429)
+    raise DeliveryError("HTTP %d" % r.status_code, retry=retry, retry_after=retry_after)
+
+  async def _run(self, destination: Destination):
+    try:
+      while True:
+        if not destination.pending:
+          destination.ready.clear()
+          try:
+            await asyncio.wait_for(destination.ready.wait(), _IDLE_SECONDS)
+          except asyncio.TimeoutError:
+            if not destination.pending:
+              return
+          continue
+
+        # Give the first verdict a moment to pick up company
+        if len(destination.pending) < WEBHOOK_BATCH_SIZE:
+          await asyncio.sleep(WEBHOOK_BATCH_WAIT_MS / 1000)
+
+        batch = [destination.pending[i] for i in range(min(WEBHOOK_BATCH_SIZE, len(destination.pending)))]
+        payloads = [payload for _, payload in batch]
+        attempts = await self._deliver(destination.url, payloads)
+
+        # Only now leave the queue, one batch in flight per destination keeps receivers in order
+        for _ in batch:
+          destination.pending.popleft()
+        self._pending -= len(batch)
+        webhook_pending.set(self._pending)
+
+        if attempts is not None:
+          now = time.monotonic()
+          for queued_at, _ in batch:
+            webhook_latency.observe(now - queued_at)
+    finally:
+      destination.task = None
+      webhook_destinations.dec()
+      if destination.pending:
+        # Stopped mid-flight, nothing will come back for these
+        self._dead_letter(destination.url, [payload for _, payload in destination.pending], "Dispatcher stopped", 0)
+        self._pending -= len(destination.pending)
+        destination.pending.clear()
+        webhook_pending.set(self._pending)
+      if self._destinations.get(destination.url) is destination:
+        del self._destinations[destination.url]
+
+  async def _deliver(self, url: str, payloads: list[dict]) -> int | None:
+    # Returns the attempts it took, or None once the batch has been dead-lettered
+    webhook_batch_sizes.observe(len(payloads))
+    # Checked again on delivery, DNS may have changed since the callback was accepted
+    error = await check_destination(url)
+    if error is not None:
+      dead_lettered.inc()
+      self._dead_letter(url, payloads, error, 0)
+      return None
+    for attempt in range(1, WEBHOOK_MAX_ATTEMPTS + 1):
+      try:
+        await self._post(url, payloads)
+        delivered.inc()
+        return attempt
+      except DeliveryError as e:
+        if not e.retry or attempt == WEBHOOK_MAX_ATTEMPTS:
+          dead_lettered.inc()
+          self._dead_letter(url, payloads, str(e), attempt)
+          return None
+        retried.inc()
+        # Full jitter exponential backoff, unless the receiver told us how long to wait
+        delay = e.retry_after if e.retry_after is not None else random.uniform(0, min(WEBHOOK_BACKOFF_MAX, WEBHOOK_BACKOFF_BASE * 2 ** (attempt - 1)))
+        await asyncio.sleep(min(delay, WEBHOOK_BACKOFF_MAX))
+
+  def _dead_letter(self, url: str, payloads: list[dict], error: str, attempts: int):
+    self._dead.extend({"url": url, "payload": json.dumps(payload), "error": error, "attempts": attempts} for payload in payloads)
+    if self._dead_task is None:
+      self._dead_task = asyncio.create_task(self._flush_dead())
+
+  async def _flush_dead(self):
+    db = await get_db()
+    try:
+      while self._dead:
+        rows, self._dead = self._dead, []
+        try:
+          await db.webhookdeadletter.create_many(data=rows)
+        except Exception as e:
+          print(f"Error storing {len(rows)} webhook dead letters: {e}")
+    finally:
+      self._dead_task = None
+      await db.disconnect()
+
+  async def redeliver(self, limit: int) -> int:
+    # Oldest dead letters go back on the queue
+    db = await get_db()
+    try:
+      letters = await db.webhookdeadletter.find_many(order={"created_date": "asc"}, take=limit)
+      if letters:
+        await db.webhookdeadletter.delete_many(where={"id": {"in": [letter.id for letter in letters]}})
+    finally:
+      await db.disconnect()
+
+    for letter in letters:
+      self.send(letter.url, json.loads(letter.payload))
+    return len(letters)
+
+  def report(self) -> dict:
+    return {
+      "pending": self._pending,
+      "destinations": {url: len(destination.pending) for url, destination in self._destinations.items()}
+    }
+
+  async def stop(self):
+    tasks = [destination.task for destination in self._destinations.values() if destination.task is not None]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if self._dead_task is not None:
+      await asyncio.gather(self._dead_task, return_exceptions=True)
+    if self._client is not None:
+      await self._client.aclose()
+      self._client = None
+
+dispatcher = WebhookDispatcher()